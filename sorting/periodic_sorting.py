@@ -53,15 +53,17 @@ O. Mariani, F. Marelli, C. Jaques, A. Ernst and M. Liebling, "Unequivocal cardia
 
 """
 
-import numpy as np
 import sys
-from os.path import join, basename, dirname
+import shutil
+from os.path import join, basename, dirname, abspath
 import argparse
 import logging
 from tempfile import mkdtemp
 
 from sorting import write_tsp
 from toolbox import om_toolbox
+from toolbox.cache import Cache
+from toolbox import profiling
 
 
 def parsing():
@@ -88,13 +90,66 @@ def parsing():
                              "points. Default=''")
     parser.add_argument("--show_tsp", type=bool, default=False,
                         help="Shows movie of original data, downsized data, and sorted data.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of threads computing the frame-to-frame distances. Default=1")
+    parser.add_argument("--solver", type=str, default='concorde',
+                        help="TSP solver: concorde (optimal), heuristic (in-process, for long movies) or sparse "
+                             "(heuristic on the nearest neighbours graph, for very long movies). Default=concorde")
+    parser.add_argument("--n_neighbours", type=int, default=10,
+                        help="Nearest neighbours per frame used by the heuristic solvers. Default=10")
+    parser.add_argument("--time_limit", type=float, default=30.,
+                        help="Time limit in seconds of the heuristic solvers. Default=30")
+    parser.add_argument("--previous_tour", type=str, default='',
+                        help="SOL file of a previous sorting of the first frames of the input (e.g. before the last "
+                             "acquired frames). The new frames are inserted into its tour. Default=''")
+    parser.add_argument("--refine_time", type=float, default=5.,
+                        help="With previous_tour, time limit in seconds of the refinement of the tour. Default=5")
+    parser.add_argument("--sort_per_slice", action='store_true',
+                        help="Sorts every slice with its own tour, the tours being aligned to the phase of the first "
+                             "slice. Otherwise the tour of the first slice sorts the whole stack.")
+    parser.add_argument("--channel_weights", type=float, nargs='+', default=None,
+                        help="Weight of every channel in the frame-to-frame distances. Default=the first channel only")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="With sort_per_slice, number of slices sorted at once by a process pool. Default=1")
+    parser.add_argument("--stream_distances", action='store_true',
+                        help="Writes the frame-to-frame distances to the TSP file as they are computed.")
+    parser.add_argument("--embedding", type=str, default=None,
+                        help="Compares the frames by pca or random_projection features instead of pixels. "
+                             "Default=None")
+    parser.add_argument("--n_components", type=int, default=256,
+                        help="Number of features per frame of the embedding. Default=256")
+    parser.add_argument("--report_agreement", action='store_true',
+                        help="With an embedding, also sorts without it and logs the agreement of the two tours.")
+    parser.add_argument("--cache_dir", type=str, default='',
+                        help="Directory caching the downsized data, distances and tours between runs. "
+                             "Default=sorting_cache in the input directory")
+    parser.add_argument("--cache_size", type=int, default=4096,
+                        help="Size in MB above which the least recently used cache entries are deleted. Default=4096")
+    parser.add_argument("--no_cache", action='store_true',
+                        help="Recomputes everything, without reading or writing the cache.")
+    parser.add_argument("--layout", type=str, default='',
+                        help="Storage layout of the input NPY file: xyzct, or tzcyx (time-major, every frame "
+                             "contiguous). Default=the layout recorded next to the file by the scripts, "
+                             "xyzct if none")
+    parser.add_argument("--output_layout", type=str, default='',
+                        help="Storage layout of the output NPY file, xyzct or tzcyx. Default=the input layout")
+    parser.add_argument("--chunk_size", type=int, default=256,
+                        help="Size in MB of the blocks of data read at once. Default=256")
+    parser.add_argument("--report", type=str, default='',
+                        help="JSON report of the run (time, memory, input/output of every stage). "
+                             "Default=<input>_sorting_report.json next to the input")
+    parser.add_argument("--profile", type=str, default='',
+                        help="Saves a cProfile dump of the run at this path. Default=''")
     parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
                                                                           "package. Can be INFO, WARNING, ERROR.")
     return parser.parse_args()
 
 
 def main(input_file_path, concorde_path, output_file_path='', x_down_sizing_factor=4, y_down_sizing_factor=4,
-         tsp_file='', input_tsp_path='', show_tsp=False, logging_level='INFO'):
+         tsp_file='', input_tsp_path='', show_tsp=False, logging_level='INFO', chunk_size=256, workers=1,
+         stream_distances=False, solver='concorde', time_limit=30., n_neighbours=10, embedding=None, n_components=256,
+         report_agreement=False, cache_dir='', cache_size=4096, no_cache=False, previous_tour='', refine_time=5.,
+         sort_per_slice=False, channel_weights=None, jobs=1, layout='', output_layout=''):
     """
 
     :param input_file_path: Input data path
@@ -107,12 +162,35 @@ def main(input_file_path, concorde_path, output_file_path='', x_down_sizing_fact
     :param show_tsp: plays the input data, downsized data, sorted data. Default=False
     :param logging_level: level of info printed to log file. Can be INFO, WARNING, or ERROR. Log file in input
     directory.
+    :param chunk_size: Size in MB of the blocks of data read at once. Default=256
+    :param workers: Number of threads computing the frame-to-frame distances. Default=1
+    :param stream_distances: If True, writes the distances to the TSP file without holding the distance matrix.
+    Default=False
+    :param solver: TSP solver, 'concorde', 'heuristic' or 'sparse'. Default='concorde'
+    :param time_limit: Time limit in seconds of the heuristic solvers. Default=30
+    :param n_neighbours: Nearest neighbours per frame used by the heuristic solvers. Default=10
+    :param embedding: Frame features compared instead of pixels, None, 'pca' or 'random_projection'. Default=None
+    :param n_components: Number of features per frame of the embedding. Default=256
+    :param report_agreement: If True with an embedding, logs the agreement with the tour without embedding.
+    Default=False
+    :param cache_dir: Directory of the cache of intermediate results. Default='' (sorting_cache in the input directory)
+    :param cache_size: Size in MB above which the least recently used cache entries are deleted. Default=4096
+    :param no_cache: If True, the cache is not used. Default=False
+    :param previous_tour: SOL file of a previous sorting of the first frames of the input, into whose tour the new
+    frames are inserted. Default=''
+    :param refine_time: With previous_tour, time limit in seconds of the refinement of the tour. Default=5
+    :param sort_per_slice: If True, sorts every slice with its own tour, aligned to the phase of the first slice.
+    Default=False
+    :param channel_weights: Weight of every channel in the frame-to-frame distances. Default=None (first channel only)
+    :param jobs: With sort_per_slice, number of slices sorted at once by a process pool. Default=1
+    :param layout: Storage layout of the input NPY file, 'xyzct' or time-major 'tzcyx'. Default='' (the layout
+    recorded next to the file, 'xyzct' if none)
+    :param output_layout: Storage layout of the output NPY file. Default='' (the input layout)
     :return:
     """
 
     file_path = input_file_path
     dir_data = dirname(file_path)
-    tmp_data = mkdtemp()
     filename = basename(file_path)
     logging.basicConfig(filename=join(dir_data, 'sorting.log'), level=logging_level)
 
@@ -121,29 +199,50 @@ def main(input_file_path, concorde_path, output_file_path='', x_down_sizing_fact
     else:
         tsp_path = input_tsp_path
 
-    im = om_toolbox.load_data(file_path)
-
-    if im.ndim != 5:
-        logging.error('Expecting array with 5 dimensions. Here the array has {} dimensions ({}). Exiting script.'
-                      .format(im.ndim, im.size))
-        sys.exit(-1)
-    im_mapped = np.memmap(join(tmp_data, 'tmp.npy'), dtype=im.dtype, mode='w+', shape=im.shape)
-    im_mapped[:] = im[:]
-
-    del im
-
-    logging.info('TSP solver starting...')
-
-    tsp_movie = np.memmap(join(tmp_data, 'tsp.npy'), dtype=im_mapped.dtype, mode='w+', shape=im_mapped.shape)
-    tsp_movie[:] = write_tsp.run_tsp(im_mapped, concorde_path=concorde_path, show_data=show_tsp, tsp_path=tsp_path,
-                                     y_downsizing_factor=y_down_sizing_factor,
-                                     x_downsizing_factor=x_down_sizing_factor, tsp_files_exist=tsp_file)
-
     if output_file_path == '':
         output_file_path = join(dir_data, filename[:filename.find(".")] + '_sorted.npy')
+    if abspath(output_file_path) == abspath(file_path):
+        logging.error('The output file path is the input file path {}. Exiting script.'.format(file_path))
+        sys.exit(-1)
 
-    np.save(output_file_path, tsp_movie)
-    logging.info('Saved data as {}'.format(output_file_path))
+    # holds the copy of TIFF inputs that cannot be memory-mapped, and the temporary files of Concorde, so that runs
+    # started from the same directory on data with the same name do not share them
+    tmp_data = mkdtemp()
+    try:
+        layout = om_toolbox.resolve_layout(file_path, layout)
+        # memory-mapped: the data is only read block by block
+        im_mapped = om_toolbox.load_data(file_path, memmap_path=join(tmp_data, 'tmp.npy'), mmap_mode='r',
+                                         layout=layout)
+
+        if im_mapped.ndim != 5:
+            logging.error('Expecting array with 5 dimensions. Here the array has {} dimensions ({}). Exiting script.'
+                          .format(im_mapped.ndim, im_mapped.size))
+            sys.exit(-1)
+
+        cache = None
+        if not no_cache:
+            cache = Cache(cache_dir if cache_dir else join(dir_data, 'sorting_cache'),
+                          max_size=cache_size * 1024 ** 2)
+
+        logging.info('TSP solver starting...')
+
+        # the sorted frames are written in place into the output NPY file
+        tsp_movie = om_toolbox.allocate(im_mapped.shape, im_mapped.dtype, output_file_path,
+                                        layout=output_layout or layout)
+        write_tsp.run_tsp(im_mapped, concorde_path=concorde_path, show_data=show_tsp, tsp_path=tsp_path,
+                          y_downsizing_factor=y_down_sizing_factor, x_downsizing_factor=x_down_sizing_factor,
+                          tsp_files_exist=tsp_file, output_im=tsp_movie, chunk_size=chunk_size * 1024 ** 2,
+                          workers=workers, stream_distances=stream_distances,
+                          solver=solver, time_limit=time_limit, n_neighbours=n_neighbours, embedding=embedding,
+                          n_components=n_components, report_agreement=report_agreement, cache=cache,
+                          previous_tour=previous_tour, refine_time=refine_time, sort_per_slice=sort_per_slice,
+                          channel_weights=channel_weights, jobs=jobs, work_dir=tmp_data)
+        tsp_movie.flush()
+        logging.info('Saved data as {}'.format(output_file_path))
+
+        del im_mapped, tsp_movie
+    finally:
+        shutil.rmtree(tmp_data, ignore_errors=True)
 
     logging.info('Done.')
 
@@ -152,8 +251,16 @@ if __name__ == "__main__":
 
     parse = parsing()
 
-    main(parse.input_file_path, parse.concorde, output_file_path=parse.output_file_path,
-         x_down_sizing_factor=parse.xdownsizing, y_down_sizing_factor=parse.ydownsizing, tsp_file=parse.tsp_file,
-         show_tsp=parse.show_tsp, logging_level=parse.logging_level)
+    with profiling.run(parse.report or profiling.default_report_path(parse.input_file_path, 'sorting'), parse.profile):
+        main(parse.input_file_path, parse.concorde, output_file_path=parse.output_file_path,
+             x_down_sizing_factor=parse.xdownsizing, y_down_sizing_factor=parse.ydownsizing, tsp_file=parse.tsp_file,
+             show_tsp=parse.show_tsp, logging_level=parse.logging_level, chunk_size=parse.chunk_size,
+             workers=parse.workers, stream_distances=parse.stream_distances,
+             solver=parse.solver, time_limit=parse.time_limit, n_neighbours=parse.n_neighbours,
+             embedding=parse.embedding, n_components=parse.n_components, report_agreement=parse.report_agreement,
+             cache_dir=parse.cache_dir, cache_size=parse.cache_size, no_cache=parse.no_cache,
+             previous_tour=parse.previous_tour, refine_time=parse.refine_time, sort_per_slice=parse.sort_per_slice,
+             channel_weights=parse.channel_weights, jobs=parse.jobs, layout=parse.layout,
+             output_layout=parse.output_layout)
 
 
@@ -0,0 +1,440 @@
+"""
+In-process heuristic TSP solver, an alternative to Concorde for long periodic movies.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+The tour is built by a greedy edge matching (or nearest neighbour walk) and then improved by 2-opt and Or-opt moves
+restricted to the nearest neighbours of each frame. The local optimum is then perturbed by random local double-bridge
+moves followed by the same improvement, keeping the perturbations that shorten the tour, until the time limit or too
+many unsuccessful perturbations. Unlike Concorde, the result is not guaranteed to be optimal.
+"""
+
+import numpy as np
+import time
+import logging
+
+
+def solve(distances, time_limit=30., n_neighbours=10, construction='greedy', max_failed_kicks=100, seed=0,
+          neighbours=None):
+    """
+    :param distances: Symmetric frame-to-frame distance matrix, or om_toolbox.FrameDistances for sparse sorting
+    :param time_limit: Maximal duration of the tour improvement, in seconds
+    :param n_neighbours: Number of nearest neighbours of each frame considered by the moves
+    :param construction: Initial tour, 'greedy' or 'nearest_neighbour'
+    :param max_failed_kicks: Number of consecutive perturbations without improvement after which the search stops
+    :param seed: Seed of the perturbations
+    :param neighbours: Neighbour lists (n_t, n_neighbours), closest first. Computed from distances if None
+    :return: Tour, array of the frame indices in visiting order
+    """
+    n_t = distances.shape[0]
+    if n_t <= 3:
+        return np.arange(n_t)
+
+    if neighbours is None:
+        neighbours = neighbour_lists(distances, n_neighbours)
+    if construction == 'greedy':
+        tour = greedy_tour(distances, neighbours)
+    elif construction == 'nearest_neighbour':
+        tour = nearest_neighbour_tour(distances)
+    else:
+        logging.error('Unknown tour construction {}.'.format(construction))
+        raise ValueError(construction)
+    logging.info('Initial tour length: {}'.format(tour_length(tour, distances)))
+
+    deadline = time.time() + time_limit
+    local_search(tour, distances, neighbours, deadline)
+    length = tour_length(tour, distances)
+    logging.info('Local optimum tour length: {}'.format(length))
+
+    random_state = np.random.RandomState(seed)
+    failed_kicks = 0
+    while failed_kicks < max_failed_kicks and time.time() < deadline:
+        candidate = double_bridge(tour, random_state)
+        local_search(candidate, distances, neighbours, deadline)
+        candidate_length = tour_length(candidate, distances)
+        if candidate_length < length:
+            tour, length = candidate, candidate_length
+            failed_kicks = 0
+        else:
+            failed_kicks += 1
+    logging.info('Improved tour length: {}'.format(length))
+
+    return tour
+
+
+def local_search(tour, distances, neighbours, deadline, active=None):
+    """
+    Applies 2-opt and Or-opt moves in place until none improves the tour.
+    :param tour: Tour, modified in place
+    :param distances: Frame-to-frame distance matrix
+    :param neighbours: Neighbour lists
+    :param deadline: time.time() after which the improvement stops
+    :param active: If not None, array of the frames from which the moves are tried. All frames if None
+    :return: No return
+    """
+    improved = True
+    while improved and time.time() < deadline:
+        improved = two_opt(tour, distances, neighbours, deadline, active=active)
+        improved = or_opt(tour, distances, neighbours, deadline, active=active) or improved
+
+
+def double_bridge(tour, random_state, window=50):
+    """
+    Perturbs the tour by exchanging two consecutive paths B and C of a random window: A B C D becomes A C B D.
+    :param tour: Tour
+    :param random_state: numpy RandomState
+    :param window: Length of the perturbed part of the tour
+    :return: New tour
+    """
+    n_t = tour.size
+    window = min(window, n_t - 1)
+    start = random_state.randint(0, n_t - window + 1)
+    cut_1, cut_2 = np.sort(random_state.choice(np.arange(start + 1, start + window), 2, replace=False))
+    return np.concatenate((tour[:start], tour[cut_1:cut_2], tour[start:cut_1], tour[cut_2:]))
+
+
+def tour_length(tour, distances):
+    """
+    :param tour: Frame indices in visiting order
+    :param distances: Frame-to-frame distance matrix
+    :return: Length of the closed tour
+    """
+    return np.sum(distances[tour, np.roll(tour, -1)])
+
+
+def neighbour_lists(distances, n_neighbours):
+    """
+    :param distances: Frame-to-frame distance matrix
+    :param n_neighbours: Number of neighbours per frame
+    :return: Array (n_t, n_neighbours) of the nearest frames of each frame, closest first
+    """
+    n_t = distances.shape[0]
+    n_neighbours = min(n_neighbours, n_t - 1)
+    masked = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(masked, np.inf)
+    neighbours = np.argpartition(masked, n_neighbours - 1, axis=1)[:, :n_neighbours]
+    order = np.argsort(np.take_along_axis(masked, neighbours, axis=1), axis=1)
+    return np.take_along_axis(neighbours, order, axis=1)
+
+
+def nearest_neighbour_tour(distances):
+    """
+    :param distances: Frame-to-frame distance matrix
+    :return: Tour visiting the closest unvisited frame at each step, starting from frame 0
+    """
+    n_t = distances.shape[0]
+    visited = np.zeros(n_t, dtype=bool)
+    tour = np.empty(n_t, dtype=np.int64)
+    tour[0] = 0
+    visited[0] = True
+    for i in range(1, n_t):
+        row = np.where(visited, np.inf, distances[tour[i - 1]])
+        tour[i] = np.argmin(row)
+        visited[tour[i]] = True
+    return tour
+
+
+def greedy_tour(distances, neighbours):
+    """
+    Greedy edge matching: adds the candidate edges (frame to one of its neighbours) by increasing length when they keep
+    a set of paths, then joins the path ends by nearest neighbour.
+    :param distances: Frame-to-frame distance matrix
+    :param neighbours: Neighbour lists
+    :return: Tour
+    """
+    n_t = distances.shape[0]
+    starts = np.repeat(np.arange(n_t), neighbours.shape[1])
+    ends = neighbours.ravel()
+    order = np.argsort(distances[starts, ends], kind='stable')
+
+    degree = np.zeros(n_t, dtype=np.int64)
+    links = [[] for _ in range(n_t)]
+    # union-find of the path fragments, to reject edges closing a cycle
+    parent = np.arange(n_t)
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for edge in order:
+        a, b = starts[edge], ends[edge]
+        if degree[a] < 2 and degree[b] < 2:
+            root_a, root_b = root(a), root(b)
+            if root_a != root_b:
+                parent[root_a] = root_b
+                degree[a] += 1
+                degree[b] += 1
+                links[a].append(b)
+                links[b].append(a)
+
+    visited = np.zeros(n_t, dtype=bool)
+    tour = []
+    current = int(np.argmin(degree))
+    while True:
+        # walks the fragment of current, starting from one of its ends
+        previous = -1
+        while True:
+            tour.append(current)
+            visited[current] = True
+            following = [i for i in links[current] if i != previous and not visited[i]]
+            if not following:
+                break
+            previous, current = current, following[0]
+        if len(tour) == n_t:
+            break
+        # jumps to the closest end of another fragment
+        candidates = np.where(~visited & (degree < 2))[0]
+        current = int(candidates[np.argmin(distances[current, candidates])])
+
+    return np.array(tour, dtype=np.int64)
+
+
+def two_opt(tour, distances, neighbours, deadline, active=None):
+    """
+    Improves the tour in place with 2-opt moves: replaces the edges (a, next(a)) and (c, next(c)) by (a, c) and
+    (next(a), next(c)), for c among the neighbours of a.
+    :param tour: Tour, modified in place
+    :param distances: Frame-to-frame distance matrix
+    :param neighbours: Neighbour lists
+    :param deadline: time.time() after which the improvement stops
+    :param active: If not None, array of the frames a from which the moves are tried
+    :return: True if the tour was improved
+    """
+    n_t = tour.size
+    position = np.empty(n_t, dtype=np.int64)
+    position[tour] = np.arange(n_t)
+    improved = False
+    moved = True
+    while moved and time.time() < deadline:
+        moved = False
+        for i in range(n_t) if active is None else position[active]:
+            a, b = tour[i], tour[(i + 1) % n_t]
+            d_ab = distances[a, b]
+            for c in neighbours[a]:
+                d_ac = distances[a, c]
+                if d_ac >= d_ab:
+                    break
+                j = position[c]
+                d = tour[(j + 1) % n_t]
+                if c == b or d == a:
+                    continue
+                if d_ab + distances[c, d] - d_ac - distances[b, d] > 1e-9 * d_ab:
+                    # reverses the path b .. c
+                    start, stop = (i + 1) % n_t, j
+                    if start <= stop:
+                        tour[start:stop + 1] = tour[start:stop + 1][::-1].copy()
+                        position[tour[start:stop + 1]] = np.arange(start, stop + 1)
+                    else:
+                        # the path wraps around: reverses its complement d .. a instead
+                        tour[stop + 1:start] = tour[stop + 1:start][::-1].copy()
+                        position[tour[stop + 1:start]] = np.arange(stop + 1, start)
+                    moved = improved = True
+                    break
+    return improved
+
+
+def or_opt(tour, distances, neighbours, deadline, max_segment=3, active=None):
+    """
+    Improves the tour in place with Or-opt moves: moves a path of 1 to max_segment frames, possibly reversed, between
+    two consecutive frames of the tour, next to a neighbour of one of its ends.
+    :param tour: Tour, modified in place
+    :param distances: Frame-to-frame distance matrix
+    :param neighbours: Neighbour lists
+    :param deadline: time.time() after which the improvement stops
+    :param max_segment: Longest moved path
+    :param active: If not None, array of the frames whose paths are moved
+    :return: True if the tour was improved
+    """
+    n_t = tour.size
+    if n_t <= max_segment + 2:
+        return False
+    improved = False
+    moved = True
+    while moved and time.time() < deadline:
+        moved = False
+        position = np.empty(n_t, dtype=np.int64)
+        position[tour] = np.arange(n_t)
+        for length in range(1, max_segment + 1):
+            starts = range(n_t)
+            if active is not None:
+                # the paths holding an active frame
+                starts = np.unique((position[active][:, np.newaxis] - np.arange(length)) % n_t)
+            for i in starts:
+                segment = tour[np.arange(i, i + length) % n_t]
+                first, last = segment[0], segment[-1]
+                before, after = tour[(i - 1) % n_t], tour[(i + length) % n_t]
+                removal_gain = distances[before, first] + distances[last, after] - distances[before, after]
+                if removal_gain <= 0:
+                    continue
+                best = None
+                for end, other_end in ((first, last), (last, first)):
+                    for c in neighbours[end]:
+                        if distances[end, c] >= removal_gain:
+                            break
+                        if c in segment:
+                            continue
+                        # inserts between c and either of its tour neighbours, end next to c
+                        j = position[c]
+                        for e in (tour[(j + 1) % n_t], tour[(j - 1) % n_t]):
+                            if e in segment:
+                                continue
+                            gain = removal_gain - (distances[c, end] + distances[other_end, e] - distances[c, e])
+                            if gain > 1e-9 * removal_gain and (best is None or gain > best[0]):
+                                best = (gain, c, e, end)
+                if best is not None:
+                    _, c, e, end = best
+                    rest = np.delete(tour, np.arange(i, i + length) % n_t)
+                    j = int(np.where(rest == c)[0][0])
+                    # the segment goes between c and e, starting with end on the c side
+                    path = segment if end == first else segment[::-1]
+                    if rest[(j + 1) % rest.size] == e:
+                        new_tour = np.concatenate((rest[:j + 1], path, rest[j + 1:]))
+                    else:
+                        new_tour = np.concatenate((rest[:j], path[::-1], rest[j:]))
+                    tour[:] = new_tour
+                    position[tour] = np.arange(n_t)
+                    moved = improved = True
+                if time.time() >= deadline:
+                    return improved
+    return improved
+
+
+def insert_frames(tour, distances, new_frames, n_neighbours=10, time_limit=5., window=None):
+    """
+    Extends a tour with new frames at a cost proportional to their number. Each new frame is inserted where it
+    lengthens the tour the least (cheapest insertion), then the local search improves the tour around the new frames
+    only. Only the distances from the new frames to all frames, and between frames close to the new ones along the
+    tour, are read.
+    :param tour: Tour through the frames that are not new
+    :param distances: Distances indexed like the distance matrix of all the frames, e.g. om_toolbox.FrameDistances
+    :param new_frames: Indices of the frames to insert
+    :param n_neighbours: Number of nearest neighbours of each frame considered by the moves
+    :param time_limit: Maximal duration of the local search, in seconds
+    :param window: Number of frames on each side of a new frame, along the tour, from which moves are tried.
+    n_neighbours if None
+    :return: New tour
+    """
+    tour = np.array(tour, dtype=np.int64)
+    new_frames = np.asarray(new_frames, dtype=np.int64)
+    n_t = tour.size + new_frames.size
+    if new_frames.size == 0:
+        return tour
+    window = n_neighbours if window is None else window
+    deadline = time.time() + time_limit
+
+    rows = np.asarray(distances[new_frames[:, np.newaxis], np.arange(n_t)[np.newaxis, :]], dtype=np.float64)
+    edges = np.asarray(distances[tour, np.roll(tour, -1)], dtype=np.float64)
+    for row, k in zip(rows, new_frames):
+        if tour.size < 2:
+            tour = np.append(tour, k)
+            edges = np.asarray(distances[tour, np.roll(tour, -1)], dtype=np.float64)
+            continue
+        following = np.roll(tour, -1)
+        i = int(np.argmin(row[tour] + row[following] - edges))
+        tour = np.insert(tour, i + 1, k)
+        edges = np.concatenate((edges[:i], [row[tour[i]], row[following[i]]], edges[i + 1:]))
+    logging.info('Tour length after insertion: {}'.format(np.sum(edges)))
+    if n_t <= 3:
+        return tour
+
+    n_neighbours = min(n_neighbours, n_t - 1)
+    position = np.empty(n_t, dtype=np.int64)
+    position[tour] = np.arange(n_t)
+    # far from the new frames, the neighbours are the closest frames along the tour (never read by the moves)
+    steps = np.ravel(np.column_stack((np.arange(1, n_t), -np.arange(1, n_t))))[:n_neighbours]
+    neighbours = np.empty((n_t, n_neighbours), dtype=np.int64)
+    neighbours[tour] = tour[(np.arange(n_t)[:, np.newaxis] + steps) % n_t]
+
+    offsets = np.arange(-window, window + 1)
+    active = np.union1d(new_frames, tour[(position[new_frames][:, np.newaxis] + offsets) % n_t])
+    # near the new frames, the nearest frames among the frames close along the tour and the new frames
+    masked = rows.copy()
+    masked[np.arange(new_frames.size), new_frames] = np.inf
+    nearest = np.argpartition(masked, n_neighbours - 1, axis=1)[:, :n_neighbours]
+    candidates = {a: set(tour[(position[a] + offsets) % n_t].tolist()) for a in active.tolist()}
+    for k, frames in zip(new_frames.tolist(), nearest.tolist()):
+        candidates[k].update(frames)
+        for a in frames:
+            if a in candidates:
+                candidates[a].add(k)
+    for a, frames in candidates.items():
+        frames.discard(a)
+        frames = np.array(sorted(frames), dtype=np.int64)
+        closest = frames[np.argsort(np.asarray(distances[a, frames]), kind='stable')[:n_neighbours]]
+        neighbours[a, :closest.size] = closest
+
+    local_search(tour, distances, neighbours, deadline, active=active)
+    return tour
+
+
+def align_tour(tour, reference, cross_distances):
+    """
+    Aligns the phases of two tours through different frames of the same periodic motion, e.g. two slices of a stack:
+    chooses the starting frame and direction of tour so that its frames are the closest to the frames of reference at
+    the same positions.
+    :param tour: Frame indices in visiting order
+    :param reference: Frame indices in visiting order of the reference tour, as many as in tour
+    :param cross_distances: Matrix of distances, [i, j] being the distance between frame i of tour and frame j of
+    reference
+    :return: Tuple of the aligned tour and of the mean distance between its frames and the reference frames
+    """
+    n_t = tour.size
+    best_tour, best_cost = tour, np.inf
+    for candidate in (tour, tour[::-1]):
+        matched = cross_distances[candidate][:, reference]
+        # costs[s] is the sum over j of matched[(j + s) % n_t, j], a diagonal of the matrix repeated twice
+        doubled = np.concatenate((matched, matched), axis=0)
+        costs = np.array([np.trace(doubled, offset=-shift) for shift in range(n_t)])
+        shift = int(np.argmin(costs))
+        if costs[shift] < best_cost:
+            best_tour, best_cost = np.roll(candidate, -shift), costs[shift]
+
+    return best_tour, best_cost / n_t
+
+
+def tour_agreement(tour, reference):
+    """
+    Compares two tours through the same frames, independently of their starting frame and direction.
+    :param tour: Frame indices in visiting order
+    :param reference: Frame indices in visiting order of the reference tour
+    :return: Tuple of the fraction of the reference transitions (undirected edges) found in tour, and of the mean
+    distance between the phases of each frame in the two tours, as a fraction of the period (0 for the same cycle)
+    """
+    n_t = reference.size
+
+    def edges(order):
+        a, b = order, np.roll(order, -1)
+        return np.minimum(a, b) * n_t + np.maximum(a, b)
+
+    shared_edges = np.mean(np.isin(edges(reference), edges(tour)))
+
+    position = np.empty(n_t, dtype=np.int64)
+    position[tour] = np.arange(n_t)
+    reference_position = np.empty(n_t, dtype=np.int64)
+    reference_position[reference] = np.arange(n_t)
+    phase_error = np.inf
+    for direction in (1, -1):
+        angles = 2. * np.pi * (direction * position - reference_position) / n_t
+        # phase offset between the tours, as the circular mean of the differences
+        offset = np.angle(np.mean(np.exp(1j * angles)))
+        errors = np.abs(np.angle(np.exp(1j * (angles - offset)))) / (2. * np.pi)
+        phase_error = min(phase_error, np.mean(errors))
+
+    return shared_edges, phase_error
@@ -37,10 +37,14 @@ O. Mariani, K. Chan, A. Ernst, N. Mercader and M. Liebling, "Virtual High-Framer
 import numpy as np
 import os
 import sys
+import shutil
 import subprocess
 import logging
+from tempfile import mkdtemp
+from concurrent.futures import ProcessPoolExecutor
 
-from toolbox import om_toolbox
+from toolbox import om_toolbox, profiling
+from sorting import tsp_solver
 
 HEADER_FMT = """NAME: Periodic data
 Type:TSP
@@ -48,34 +52,82 @@ COMMENT: {} frames
 TYPE: TSP
 DIMENSION: {}
 EDGE_WEIGHT_TYPE: EXPLICIT
-EDGE_WEIGHT_FORMAT: FULL_MATRIX
+EDGE_WEIGHT_FORMAT: UPPER_ROW
 EDGE_WEIGHT_SECTION
 """
+# Concorde stores tour lengths as int: the edge weights are scaled so that any tour stays below this length
+MAX_TOUR_LENGTH = 2 ** 30
 
 
-def write_tsp(concorde_data, concorde_output_path):
+@profiling.profiled('write_tsp')
+def write_tsp(concorde_data, concorde_output_path, n_t=None, max_distance=None):
     """
-    Writes the input file for the TSP solver Concorde
-    :param concorde_data: Data to sort
+    Writes the input file for the TSP solver Concorde, as the upper triangle of the distance matrix (UPPER_ROW).
+    The distances are rescaled to the largest integer weights for which no tour overflows Concorde lengths.
+    :param concorde_data: Symmetric distance matrix, or generator of (start, stop, band) bands of its upper triangle as
+    produced by om_toolbox.iter_differences, written as they come
     :param concorde_output_path: Concorde output file path
+    :param n_t: Number of frames. Only needed for bands
+    :param max_distance: Largest distance, or an upper bound. Only needed for bands
     :return: No return
     """
-    n_t = concorde_data.shape[1]
+    if isinstance(concorde_data, np.ndarray):
+        matrix = concorde_data
+        n_t = matrix.shape[1]
+        max_distance = np.max(matrix)
+        band_starts = range(0, n_t, om_toolbox.TILE_FRAMES)
+        concorde_data = ((start, min(start + om_toolbox.TILE_FRAMES, n_t),
+                          matrix[start:start + om_toolbox.TILE_FRAMES, start:]) for start in band_starts)
+    elif n_t is None or max_distance is None:
+        logging.error('Writing distance bands needs the number of frames and the largest distance.')
+        sys.exit(-1)
+
+    max_weight = MAX_TOUR_LENGTH // max(n_t, 1)
+    scale = max_weight / max_distance if max_distance > 0 else 1.
+    logging.info('TSP edge weights: distances x {}'.format(scale))
+
     dir_ = os.path.dirname(concorde_output_path)
     header = HEADER_FMT.format(n_t, n_t)
-    if not os.path.exists(dir_):
+    if dir_ and not os.path.exists(dir_):
         os.makedirs(dir_)
     with open(concorde_output_path, 'wb') as f:
         f.write(bytes(header, 'utf-8'))
-        np.savetxt(f, concorde_data, fmt='%4d')
+        for start, stop, band in concorde_data:
+            # row i holds the distances to the frames i + 1 to n_t - 1
+            upper = np.concatenate([band[i, i + 1:] for i in range(stop - start)])
+            if upper.size:
+                weights = np.clip(np.rint(upper * scale), 0, max_weight).astype(np.uint32)
+                f.write(format_integers(weights))
+                f.write(b'\n')
         f.write(bytes('EOF', 'utf-8'))
 
 
-def get_frame_sorted(sol_file_path, input_im):
+def format_integers(values):
+    """
+    Formats non-negative integers as right-aligned, space separated decimal text, all digits at once.
+    :param values: Non-negative integer array
+    :return: Text bytes
+    """
+    values = np.ravel(values).astype(np.uint32)
+    width = len(str(int(np.max(values))))
+    text = np.full((values.size, width + 1), ord(' '), dtype=np.uint8)
+    remainder = values.copy()
+    for digit in range(width - 1, -1, -1):
+        text[:, digit] = remainder % 10 + ord('0')
+        remainder //= 10
+    # blank the leading zeros, keeping at least one digit
+    for digit in range(width - 1):
+        text[values < 10 ** (width - 1 - digit), digit] = ord(' ')
+    return text.tobytes()
+
+
+def get_frame_sorted(sol_file_path, input_im, output_im=None, chunk_size=om_toolbox.CHUNK_SIZE):
     """
     Sorts the frames according to the result in the SOL file
     :param sol_file_path: solution file, concorde output
     :param input_im: data to be sorted with the solution file
+    :param output_im: Array receiving the sorted data, e.g. a memmap. Allocated if None
+    :param chunk_size: Size in bytes of the blocks of lines sorted at once
     :return: Sorted data and solution array
     """
     arr_concorde = om_toolbox.load_tsp_sol_file(sol_file_path)
@@ -85,11 +137,39 @@ def get_frame_sorted(sol_file_path, input_im):
                       'points ({} / {})'.format(arr_concorde.size, input_im.shape[-1]))
         sys.exit(-1)
 
-    return input_im[..., arr_concorde], arr_concorde
+    return sort_frames(arr_concorde, input_im, output_im=output_im, chunk_size=chunk_size), arr_concorde
+
+
+@profiling.profiled('sort_frames')
+def sort_frames(arr_concorde, input_im, output_im=None, chunk_size=om_toolbox.CHUNK_SIZE):
+    """
+    Sorts the frames in the order of a tour
+    :param arr_concorde: Frame indices in the sorted order
+    :param input_im: data to be sorted
+    :param output_im: Array receiving the sorted data, e.g. a memmap. Allocated if None
+    :param chunk_size: Size in bytes of the blocks of lines sorted at once
+    :return: Sorted data
+    """
+    if output_im is None:
+        output_im = np.empty(input_im.shape, dtype=input_im.dtype)
+    if om_toolbox.is_time_major(input_im):
+        # streams whole frames in the order of the tour
+        source = input_im.transpose(om_toolbox.TIME_MAJOR_AXES)
+        target = output_im.transpose(om_toolbox.TIME_MAJOR_AXES)
+        for start, stop in om_toolbox.chunks(input_im.shape[-1], input_im[..., 0].nbytes, chunk_size):
+            target[start:stop] = source[arr_concorde[start:stop]]
+    else:
+        for start, stop in om_toolbox.chunks(input_im.shape[0], input_im[0].nbytes, chunk_size):
+            output_im[start:stop] = input_im[start:stop][..., arr_concorde]
+
+    return output_im
 
 
 def run_tsp(input_im, concorde_path, y_downsizing_factor=1, x_downsizing_factor=1, show_data=False, tsp_path='',
-            tsp_files_exist=''):
+            tsp_files_exist='', output_im=None, chunk_size=om_toolbox.CHUNK_SIZE, workers=1, stream_distances=False,
+            solver='concorde', time_limit=30., n_neighbours=10, embedding=None, n_components=256,
+            report_agreement=False, cache=None, previous_tour='', refine_time=5., sort_per_slice=False,
+            channel_weights=None, jobs=1, work_dir=None):
     """
 
     :param input_im: Data to sort
@@ -99,32 +179,385 @@ def run_tsp(input_im, concorde_path, y_downsizing_factor=1, x_downsizing_factor=
     :param show_data: Plays movies of the input, downsized, and sorted data if True
     :param tsp_path: path to save the tsp solution files
     :param tsp_files_exist: path to an existing tsp SOL file
+    :param output_im: Array receiving the sorted data, e.g. a memmap. Allocated if None
+    :param chunk_size: Size in bytes of the blocks of data read at once
+    :param workers: Number of threads computing the frame-to-frame distances
+    :param stream_distances: If True, the distances are written to the TSP file as they are computed, without holding
+    the distance matrix. The weights are then scaled with an upper bound of the distances
+    :param solver: 'concorde' runs the Concorde executable on a TSP file, 'heuristic' solves the TSP in-process with
+    tsp_solver (near-optimal, much faster on long movies), 'sparse' runs the same solver on the graph of the nearest
+    neighbours of each frame without the distance matrix (very long movies)
+    :param time_limit: Heuristic solvers only. Maximal tour improvement duration in seconds
+    :param n_neighbours: Heuristic solvers only. Number of nearest neighbours of each frame used by the solver
+    :param embedding: None to compare the downsized frames pixel by pixel, or 'pca' / 'random_projection' to compare
+    n_components features per frame (see om_toolbox.embed_frames)
+    :param n_components: Number of features per frame of the embedding
+    :param report_agreement: If True with an embedding, also sorts the downsized frames without embedding and logs
+    how much the two tours agree. Costs the full resolution sorting
+    :param cache: toolbox.cache.Cache storing the downsized data, features, distances and tours, reused when the input
+    data and parameters are the same. No caching if None
+    :param previous_tour: SOL file of a previous sorting of the first frames of input_im. If it exists, the new frames
+    are inserted into this tour instead of sorting all the frames again (see extend_tour)
+    :param refine_time: With previous_tour only. Maximal duration in seconds of the refinement of the extended tour
+    :param sort_per_slice: If True, every slice is sorted with its own tour, the tours being aligned to a common phase
+    origin (see sort_slices). Otherwise the tour of the first slice sorts the whole stack
+    :param channel_weights: Weight of every channel in the frame-to-frame distances, None for the first channel only
+    :param jobs: With sort_per_slice only. Number of slices sorted at once by a process pool
+    :param work_dir: Working directory of Concorde, where it writes its temporary files. Current directory if None.
+    With sort_per_slice, every slice gets its own temporary directory
     :return: ndarray sorted with respect to last dimension
     """
 
     if show_data:
         om_toolbox.play_movie(input_im)
 
-    if not os.path.exists(tsp_files_exist):
-        downsized_im = om_toolbox.average_downsizing(input_im, y_downsizing_factor, x_downsizing_factor)
+    if sort_per_slice and not os.path.exists(tsp_files_exist):
+        if os.path.exists(previous_tour):
+            logging.error('Incremental sorting of the slices one by one is not supported.')
+            sys.exit(-1)
+        im_out = sort_slices(input_im, concorde_path, y_downsizing_factor=y_downsizing_factor,
+                             x_downsizing_factor=x_downsizing_factor, tsp_path=tsp_path, output_im=output_im,
+                             chunk_size=chunk_size, workers=workers, jobs=jobs, solver=solver, time_limit=time_limit,
+                             n_neighbours=n_neighbours, embedding=embedding, n_components=n_components,
+                             channel_weights=channel_weights, cache=cache)
+    elif os.path.exists(previous_tour) and not os.path.exists(tsp_files_exist):
+        arr_concorde = extend_tour(input_im, om_toolbox.load_tsp_sol_file(previous_tour),
+                                   y_downsizing_factor=y_downsizing_factor, x_downsizing_factor=x_downsizing_factor,
+                                   tsp_path=tsp_path, chunk_size=chunk_size, time_limit=refine_time,
+                                   n_neighbours=n_neighbours, embedding=embedding, n_components=n_components,
+                                   channel_weights=channel_weights, cache=cache)
+        im_out = sort_frames(arr_concorde, input_im, output_im=output_im, chunk_size=chunk_size)
+    elif not os.path.exists(tsp_files_exist):
+        downsized_im, downsized_key = downsize(input_im, y_downsizing_factor, x_downsizing_factor,
+                                               chunk_size=chunk_size, cache=cache)
         if show_data:
             om_toolbox.play_movie(downsized_im)
 
-        diffs = om_toolbox.compute_differences(downsized_im[..., 0, 0, :])
-
-        tsp_file = tsp_path + '_edge_weight.txt'
-        sol_file = tsp_path + '_solution.txt'
+        frames = slice_features(downsized_im, 0, channel_weights)
+        frames_key = downsized_key
+        if channel_weights is not None and cache is not None:
+            frames_key = cache.key('channels', downsized_key, list(channel_weights))
+        features, features_key = frames, frames_key
+        if embedding is not None:
+            def embed():
+                return om_toolbox.embed_frames(frames, n_components=n_components, method=embedding,
+                                               chunk_size=chunk_size)
+            if cache is not None:
+                features_key = cache.key('embedding', frames_key, embedding, n_components)
+                features = cache.get(features_key, embed)
+            else:
+                features = embed()
 
         logging.info(tsp_path)
-        write_tsp(diffs, tsp_file)
+        arr_concorde = solve_tour(features, concorde_path, tsp_path, workers=workers,
+                                  stream_distances=stream_distances, solver=solver, time_limit=time_limit,
+                                  n_neighbours=n_neighbours, cache=cache, frames_key=features_key, work_dir=work_dir)
+        if cache is not None:
+            # read by extend_tour when new frames are inserted into this tour
+            key = tour_frames_key(cache, arr_concorde, input_im, y_downsizing_factor, x_downsizing_factor,
+                                  channel_weights)
+            if not os.path.exists(cache.path(key)):
+                cache.save(key, frames)
 
-        subprocess.call([concorde_path, '-o', sol_file, '-x', tsp_file])
-    else:
-        sol_file = tsp_files_exist
+        if report_agreement and embedding is not None:
+            reference = solve_tour(frames, concorde_path, tsp_path + '_reference', workers=workers,
+                                   stream_distances=stream_distances, solver=solver, time_limit=time_limit,
+                                   n_neighbours=n_neighbours, cache=cache, frames_key=frames_key, work_dir=work_dir)
+            shared_edges, phase_error = tsp_solver.tour_agreement(arr_concorde, reference)
+            logging.info('Agreement with the full resolution tour: {:.1%} shared transitions, mean phase error {:.2%} '
+                         'of the period'.format(shared_edges, phase_error))
 
-    im_out, arr_concorde = get_frame_sorted(sol_file, input_im)
+        im_out = sort_frames(arr_concorde, input_im, output_im=output_im, chunk_size=chunk_size)
+    else:
+        im_out, arr_concorde = get_frame_sorted(tsp_files_exist, input_im, output_im=output_im,
+                                                chunk_size=chunk_size)
 
     if show_data:
         om_toolbox.play_movie(im_out, repeat_delay=100)
 
     return im_out
+
+
+def downsize(input_im, y_downsizing_factor, x_downsizing_factor, chunk_size=om_toolbox.CHUNK_SIZE, cache=None):
+    """
+    Averages blocks of pixels of the data, through the cache if given.
+    :param input_im: Data to downsize
+    :param y_downsizing_factor: Downsizing factor for the lines
+    :param x_downsizing_factor: Downsizing factor for the columns
+    :param chunk_size: Size in bytes of the blocks of data read at once
+    :param cache: toolbox.cache.Cache of the downsized data. No caching if None
+    :return: Downsized data, and its cache key (None without cache)
+    """
+    def compute():
+        return om_toolbox.average_downsizing(input_im, y_downsizing_factor, x_downsizing_factor, chunk_size=chunk_size)
+
+    if cache is None:
+        return compute(), None
+    downsized_key = cache.key('downsized', cache.hash_array(input_im, chunk_size=chunk_size), y_downsizing_factor,
+                              x_downsizing_factor)
+    return cache.get(downsized_key, compute), downsized_key
+
+
+def slice_features(downsized_im, z=0, channel_weights=None):
+    """
+    Frames compared by the TSP of one slice: the pixels of every channel, multiplied by the channel weight, so that the
+    L1 distance between two frames is the weighted sum of the distances of their channels.
+    :param downsized_im: Downsized XYZCT data
+    :param z: Slice index
+    :param channel_weights: Non-negative weight of every channel, None for the first channel only
+    :return: Array (features, nt)
+    """
+    n_c, n_t = downsized_im.shape[3], downsized_im.shape[-1]
+    if channel_weights is None:
+        return downsized_im[..., z, 0, :]
+    channel_weights = np.asarray(channel_weights, dtype=np.float64)
+    if channel_weights.size != n_c or np.any(channel_weights < 0) or not np.any(channel_weights > 0):
+        logging.error('Expecting {} non-negative channel weights, not all zero. Got {}.'
+                      .format(n_c, channel_weights.tolist()))
+        sys.exit(-1)
+    return np.concatenate([channel_weights[c] * np.reshape(downsized_im[..., z, c, :], (-1, n_t))
+                           for c in np.flatnonzero(channel_weights)], axis=0)
+
+
+@profiling.profiled('sort_slices')
+def sort_slices(input_im, concorde_path, y_downsizing_factor=1, x_downsizing_factor=1, tsp_path='', output_im=None,
+                chunk_size=om_toolbox.CHUNK_SIZE, workers=1, jobs=1, solver='concorde', time_limit=30.,
+                n_neighbours=10, embedding=None, n_components=256, channel_weights=None, cache=None):
+    """
+    Sorts every slice of a stack with its own tour, for stacks whose slices were acquired at different times: the
+    phases of a frame differ from one slice to the other. The tours of the slices are solved at once by a process
+    pool, every Concorde job in its own working directory, then each tour is aligned to the one of the previous slice
+    (see tsp_solver.align_tour), neighbouring slices showing similar images at the same phase, so that the sorted
+    frame t of every slice is at the same phase as the one of the first slice. The aligned tours are saved as
+    tsp_path + '_z<slice>_solution.txt'.
+    :param input_im: XYZCT data to sort
+    :param concorde_path: path to the Concorde executable
+    :param y_downsizing_factor: Downsizing factor for the lines
+    :param x_downsizing_factor: Downsizing factor for the columns
+    :param tsp_path: path prefix of the tsp files
+    :param output_im: Array receiving the sorted data, e.g. a memmap. Allocated if None
+    :param chunk_size: Size in bytes of the blocks of data read at once
+    :param workers: Number of threads computing the frame-to-frame distances of each slice
+    :param jobs: Number of slices sorted at once
+    :param solver: 'concorde', 'heuristic' or 'sparse', see run_tsp
+    :param time_limit: Heuristic solvers only. Maximal tour improvement duration in seconds
+    :param n_neighbours: Heuristic solvers only. Number of nearest neighbours of each frame used by the solver
+    :param embedding: None, 'pca' or 'random_projection', see run_tsp
+    :param n_components: Number of features per frame of the embedding
+    :param channel_weights: Weight of every channel in the frame-to-frame distances, see slice_features
+    :param cache: toolbox.cache.Cache storing the downsized data, distances and tours. No caching if None
+    :return: Sorted data
+    """
+    n_z = input_im.shape[2]
+    downsized_im, _ = downsize(input_im, y_downsizing_factor, x_downsizing_factor, chunk_size=chunk_size, cache=cache)
+
+    features = []
+    for z in range(n_z):
+        frames = slice_features(downsized_im, z, channel_weights)
+        if embedding is not None:
+            frames = om_toolbox.embed_frames(frames, n_components=n_components, method=embedding,
+                                             chunk_size=chunk_size)
+        features.append(frames)
+
+    # the Concorde files are written next to tsp_path, whatever the working directory of the jobs
+    tsp_path = os.path.abspath(tsp_path)
+    tasks = [(frames, concorde_path, '{}_z{}'.format(tsp_path, z), workers, solver, time_limit, n_neighbours, cache)
+             for z, frames in enumerate(features)]
+    logging.info('Sorting {} slices, {} at once.'.format(n_z, jobs))
+    if jobs > 1 and n_z > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, n_z)) as executor:
+            tours = list(executor.map(_solve_slice_worker, tasks))
+    else:
+        tours = [_solve_slice_worker(task) for task in tasks]
+
+    with profiling.stage('align_tours'):
+        for z in range(1, n_z):
+            tours[z], distance = tsp_solver.align_tour(tours[z], tours[z - 1],
+                                                       om_toolbox.cross_differences(features[z], features[z - 1]))
+            logging.info('Slice {}: mean distance to the frames of slice {} at the same phase {:.4g}'
+                         .format(z, z - 1, distance))
+    for z, tour in enumerate(tours):
+        om_toolbox.write_tsp_sol_file(tour, '{}_z{}_solution.txt'.format(tsp_path, z))
+
+    if output_im is None:
+        output_im = np.empty(input_im.shape, dtype=input_im.dtype)
+    for z, tour in enumerate(tours):
+        sort_frames(tour, input_im[:, :, z], output_im=output_im[:, :, z], chunk_size=chunk_size)
+
+    return output_im
+
+
+def _solve_slice_worker(args):
+    """
+    Process pool task: solves the tour of one slice, Concorde running in a temporary working directory so that the
+    files it writes there do not collide with those of the other jobs.
+    :param args: Frames, Concorde path, tsp path prefix, threads, solver, time limit, neighbours, cache
+    :return: Tour of the slice
+    """
+    frames, concorde_path, tsp_path, workers, solver, time_limit, n_neighbours, cache = args
+    work_dir = mkdtemp(prefix='concorde_')
+    try:
+        return solve_tour(frames, concorde_path, tsp_path, workers=workers, solver=solver, time_limit=time_limit,
+                          n_neighbours=n_neighbours, cache=cache, work_dir=work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def extend_tour(input_im, previous_tour, y_downsizing_factor=1, x_downsizing_factor=1, tsp_path='',
+                chunk_size=om_toolbox.CHUNK_SIZE, time_limit=5., n_neighbours=10, embedding=None, n_components=256,
+                channel_weights=None, cache=None):
+    """
+    Incremental sorting, e.g. during an acquisition: the first frames of input_im were sorted by a previous run, the
+    frames acquired since then are inserted into its tour (see tsp_solver.insert_frames). Only the new frames are
+    read and downsized, the frames of the previous tour being read from the cache under the key of that tour (see
+    tour_frames_key, recomputed if missing), and only the distances from the new frames to all frames are computed,
+    instead of the whole distance matrix. The extended tour is saved as tsp_path + '_solution.txt' and its frames are
+    cached for the next update.
+    :param input_im: Data to sort, whose first frames were sorted by previous_tour
+    :param previous_tour: Tour of the previous run, through the frames 0 to previous_tour.size - 1
+    :param y_downsizing_factor: Downsizing factor for the lines, the one of the previous run
+    :param x_downsizing_factor: Downsizing factor for the columns, the one of the previous run
+    :param tsp_path: path prefix of the tsp files
+    :param chunk_size: Size in bytes of the blocks of data read at once
+    :param time_limit: Maximal duration of the refinement of the extended tour, in seconds
+    :param n_neighbours: Number of nearest neighbours of each frame considered by the refinement
+    :param embedding: None or 'random_projection', see run_tsp. The PCA features change with the frames, so that the
+    previous tour does not apply to them
+    :param n_components: Number of features per frame of the embedding
+    :param channel_weights: Weight of every channel in the frame-to-frame distances, see slice_features
+    :param cache: toolbox.cache.Cache of the frames of the tours. No caching if None
+    :return: Tour, array of the frame indices in sorted order
+    """
+    n_t = input_im.shape[-1]
+    n_old = previous_tour.size
+    if n_old > n_t or not np.array_equal(np.sort(previous_tour), np.arange(n_old)):
+        logging.error('The previous tour is not a tour through the first {} frames of the data ({} frames).'
+                      .format(n_old, n_t))
+        sys.exit(-1)
+    if embedding not in (None, 'random_projection'):
+        logging.error('Incremental sorting needs pixels or random_projection features, not {}.'.format(embedding))
+        sys.exit(-1)
+
+    def downsize_frames(image):
+        return om_toolbox.average_downsizing(image, y_downsizing_factor, x_downsizing_factor, chunk_size=chunk_size)
+
+    frames_old = None
+    if cache is not None:
+        frames_old = cache.load(tour_frames_key(cache, previous_tour, input_im, y_downsizing_factor,
+                                                x_downsizing_factor, channel_weights))
+    if frames_old is None:
+        logging.info('Frames of the previous tour not found in the cache, downsizing them again.')
+        frames_old = slice_features(downsize_frames(input_im[..., :n_old]), 0, channel_weights)
+    frames = np.concatenate((frames_old, slice_features(downsize_frames(input_im[..., n_old:]), 0, channel_weights)),
+                            axis=-1)
+
+    features = frames
+    if embedding is not None:
+        # the random projection only depends on the frame size: the features of the previous frames do not change
+        features = om_toolbox.embed_frames(frames, n_components=n_components, method=embedding, chunk_size=chunk_size)
+
+    logging.info('Inserting {} new frames into the tour of {} frames.'.format(n_t - n_old, n_old))
+    with profiling.stage('tsp_solver'):
+        arr_concorde = tsp_solver.insert_frames(previous_tour, om_toolbox.FrameDistances(features),
+                                                np.arange(n_old, n_t), n_neighbours=n_neighbours,
+                                                time_limit=time_limit)
+    om_toolbox.write_tsp_sol_file(arr_concorde, tsp_path + '_solution.txt')
+    if cache is not None:
+        cache.save(tour_frames_key(cache, arr_concorde, input_im, y_downsizing_factor, x_downsizing_factor,
+                                   channel_weights), frames)
+    return arr_concorde
+
+
+def tour_frames_key(cache, tour, input_im, y_downsizing_factor, x_downsizing_factor, channel_weights):
+    """
+    Cache key of the frames (slice_features of the downsized data) sorted by a tour. It is derived from the tour and
+    the frame shape, not from the data, so that incremental sorting finds the previous frames without reading them.
+    :param cache: toolbox.cache.Cache
+    :param tour: Tour through the frames
+    :param input_im: Data whose first tour.size frames the tour sorts. Only its frame shape and data type are used
+    :param y_downsizing_factor: Downsizing factor for the lines
+    :param x_downsizing_factor: Downsizing factor for the columns
+    :param channel_weights: Weight of every channel, see slice_features
+    :return: Key
+    """
+    channel_weights = None if channel_weights is None else [float(weight) for weight in channel_weights]
+    return cache.key('tour_frames', cache.hash_array(np.asarray(tour)), input_im.shape[:-1],
+                     np.dtype(input_im.dtype).str, y_downsizing_factor, x_downsizing_factor, channel_weights)
+
+
+def solve_tour(frames, concorde_path, tsp_path, workers=1, stream_distances=False, solver='concorde', time_limit=30.,
+               n_neighbours=10, cache=None, frames_key=None, work_dir=None):
+    """
+    Finds the shortest tour through the frames and saves it as tsp_path + '_solution.txt'.
+    :param frames: Array (features, nt) of the frames to sort
+    :param concorde_path: path to the Concorde executable
+    :param tsp_path: path prefix of the tsp files
+    :param workers: Number of threads computing the frame-to-frame distances
+    :param stream_distances: Concorde only. Writes the distances to the TSP file as they are computed
+    :param solver: 'concorde', 'heuristic' or 'sparse', see run_tsp
+    :param time_limit: Heuristic solvers only. Maximal tour improvement duration in seconds
+    :param n_neighbours: Heuristic solvers only. Number of nearest neighbours of each frame used by the solver
+    :param cache: toolbox.cache.Cache storing the distance matrix and the tour. No caching if None
+    :param frames_key: Cache key of frames. Hashed from frames if None
+    :param work_dir: Working directory of Concorde, where it writes its temporary files. Current directory if None
+    :return: Tour, array of the frame indices in sorted order
+    """
+    tsp_file = tsp_path + '_edge_weight.txt'
+    sol_file = tsp_path + '_solution.txt'
+
+    distances_key = tour_key = None
+    if cache is not None:
+        if frames_key is None:
+            frames_key = cache.hash_array(frames)
+        distances_key = cache.key('distances', frames_key, 'cityblock')
+        tour_key = cache.key('tour', frames_key, 'cityblock', solver, stream_distances, time_limit, n_neighbours)
+        arr_concorde = cache.load(tour_key)
+        if arr_concorde is not None:
+            om_toolbox.write_tsp_sol_file(arr_concorde, sol_file)
+            return arr_concorde
+
+    def differences():
+        if cache is None:
+            return om_toolbox.compute_differences(frames, workers=workers)
+        return cache.get(distances_key, lambda: om_toolbox.compute_differences(frames, workers=workers))
+
+    if solver in ('heuristic', 'sparse'):
+        if solver == 'sparse':
+            # O(nt x n_neighbours) memory: distances outside the neighbour graph are computed when needed
+            neighbours, neighbour_distances = om_toolbox.nearest_neighbours(frames, n_neighbours, workers=workers)
+            diffs = om_toolbox.FrameDistances(frames, neighbours, neighbour_distances)
+        else:
+            neighbours = None
+            diffs = differences()
+        with profiling.stage('tsp_solver'):
+            arr_concorde = tsp_solver.solve(diffs, time_limit=time_limit, n_neighbours=n_neighbours,
+                                            neighbours=neighbours)
+        # kept to apply the solution again with tsp_files_exist
+        om_toolbox.write_tsp_sol_file(arr_concorde, sol_file)
+        if cache is not None:
+            cache.save(tour_key, arr_concorde)
+        return arr_concorde
+    elif solver != 'concorde':
+        logging.error('Unknown TSP solver {}. Can be concorde, heuristic or sparse.'.format(solver))
+        sys.exit(-1)
+
+    if stream_distances:
+        # no distance exceeds the sum over pixels of their intensity range
+        max_distance = np.sum(np.max(frames, axis=-1) - np.min(frames, axis=-1))
+        write_tsp(om_toolbox.iter_differences(frames, workers=workers), tsp_file, n_t=frames.shape[-1],
+                  max_distance=max_distance)
+    else:
+        write_tsp(differences(), tsp_file)
+
+    with profiling.stage('concorde'):
+        subprocess.call([concorde_path, '-o', os.path.abspath(sol_file), '-x', os.path.abspath(tsp_file)],
+                        cwd=work_dir)
+
+    arr_concorde = om_toolbox.load_tsp_sol_file(sol_file)
+    if arr_concorde.size != frames.shape[-1]:
+        logging.error('Discrepancy between concorde SOL file number of time points and input data number of time '
+                      'points ({} / {})'.format(arr_concorde.size, frames.shape[-1]))
+        sys.exit(-1)
+    if cache is not None:
+        cache.save(tour_key, arr_concorde)
+    return arr_concorde
@@ -0,0 +1,87 @@
+"""
+Regression tests of the conversions between the XYZCT and time-major TZCYX layouts, and of the layout records.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from toolbox import convert_layout, om_toolbox
+
+
+@pytest.fixture
+def movie_path(tmp_path):
+    """
+    :return: Path of a random XYZCT NPY movie, without layout record
+    """
+    path = str(tmp_path / 'movie.npy')
+    np.save(path, np.random.RandomState(0).rand(24, 20, 3, 2, 15).astype(np.float32))
+    return path
+
+
+def test_round_trip(movie_path, tmp_path):
+    time_major_path = str(tmp_path / 'movie_tzcyx.npy')
+    back_path = str(tmp_path / 'movie_back.npy')
+    # chunk_size=0: a block per line or frame
+    convert_layout.main(movie_path, output_file_path=time_major_path, chunk_size=0)
+    convert_layout.main(time_major_path, output_file_path=back_path, output_layout='xyzct', chunk_size=0)
+
+    data = np.load(movie_path)
+    time_major = np.load(time_major_path)
+    assert time_major.shape == tuple(data.shape[axis] for axis in om_toolbox.TIME_MAJOR_AXES)
+    np.testing.assert_array_equal(time_major, data.transpose(om_toolbox.TIME_MAJOR_AXES))
+    np.testing.assert_array_equal(np.load(back_path), data)
+
+    assert om_toolbox.resolve_layout(movie_path) == 'xyzct'
+    assert om_toolbox.resolve_layout(time_major_path) == 'tzcyx'
+    assert om_toolbox.resolve_layout(back_path) == 'xyzct'
+    # the recorded layout is read by default
+    np.testing.assert_array_equal(om_toolbox.load_data(time_major_path, mmap_mode='r'), data)
+
+
+def test_outdated_record_deleted(movie_path, tmp_path):
+    path = str(tmp_path / 'out.npy')
+    data = np.load(movie_path)
+    om_toolbox.convert_layout(data, om_toolbox.allocate(data.shape, data.dtype, path, layout='tzcyx'))
+    assert os.path.exists(path + om_toolbox.LAYOUT_SUFFIX)
+    om_toolbox.convert_layout(data, om_toolbox.allocate(data.shape, data.dtype, path))
+    assert not os.path.exists(path + om_toolbox.LAYOUT_SUFFIX)
+    np.testing.assert_array_equal(om_toolbox.load_data(path), data)
+
+
+def test_declared_layout_disagrees(movie_path, tmp_path):
+    time_major_path = str(tmp_path / 'movie_tzcyx.npy')
+    convert_layout.main(movie_path, output_file_path=time_major_path, chunk_size=0)
+    with pytest.raises(SystemExit):
+        om_toolbox.load_data(time_major_path, layout='xyzct')
+
+
+def test_shape_warning(movie_path, tmp_path, caplog):
+    time_major_path = str(tmp_path / 'movie_tzcyx.npy')
+    np.save(time_major_path, np.load(movie_path).transpose(om_toolbox.TIME_MAJOR_AXES))
+    with caplog.at_level(logging.WARNING):
+        om_toolbox.load_data(movie_path)
+    assert not caplog.records
+    # no record: the time-major file is read as XYZCT, with the slices as columns
+    with caplog.at_level(logging.WARNING):
+        om_toolbox.load_data(time_major_path)
+    assert 'Check its layout' in caplog.text
@@ -0,0 +1,80 @@
+"""
+Regression tests of the shift convention and of the derivative of the shear objective.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+"""
+
+import numpy as np
+import pytest
+import scipy.interpolate as interpolate
+
+from toolbox import synthetic_data
+from unshearing import opt_shift, spline_resampling
+
+
+@pytest.mark.parametrize('step', [0.3, 1.3, -0.7, 2., 3.7])
+def test_rows_resampled_at_t_minus_shift(step):
+    ny, nx, nt = 10, 3, 30
+    data = np.random.RandomState(0).rand(ny, nx, nt)
+    data[..., -1] = data[..., 0]
+    nts = np.arange(nt)
+
+    shifts = step * np.arange(ny).reshape((ny, 1, 1))
+    residue, int_interp = spline_resampling.split_shifts(shifts)
+    out = spline_resampling.spline_resampling(spline_resampling.spline_coefficients(data), residue, int_interp)
+
+    for y in range(ny):
+        shift = shifts[y, 0, 0]
+        points = nts + np.ceil(shift) - shift
+        points[-1] = nts[-1]
+        # the time points that the roll by ceil(shift) does not wrap around are evaluated at t - shift
+        unwrapped = (nts - np.ceil(shift) >= 0) & (nts - np.ceil(shift) < nt - 1)
+        for x in range(nx):
+            tck = interpolate.splrep(nts, data[y, x], per=True, k=3)
+            np.testing.assert_allclose(out[y, x], np.roll(interpolate.splev(points, tck), int(np.ceil(shift))),
+                                       rtol=0, atol=1e-13)
+            if np.any(unwrapped):
+                np.testing.assert_allclose(out[y, x, unwrapped], interpolate.splev(nts[unwrapped] - shift, tck),
+                                           rtol=0, atol=1e-13)
+
+
+def test_integer_shifts_roll_the_rows():
+    data = np.random.RandomState(1).rand(5, 2, 12)
+    data[..., -1] = data[..., 0]
+    shifts = 2. * np.arange(5).reshape((5, 1, 1))
+    residue, int_interp = spline_resampling.split_shifts(shifts)
+    out = spline_resampling.spline_resampling(spline_resampling.spline_coefficients(data), residue, int_interp)
+    for y in range(5):
+        np.testing.assert_allclose(out[y], np.roll(data[y], 2 * y, axis=-1), rtol=0, atol=1e-12)
+
+
+# steps with no integer shift on the 24 rows: the derivative is one-sided where a shift crosses an integer
+@pytest.mark.parametrize('step', [0.31, 1.27, -0.73, 2.57])
+def test_min_resampling_derivative(step):
+    movie, permutation = synthetic_data.synthetic_movie((24, 16, 1, 2, 20), shear=0.4, noise=0., dtype=np.float64)
+    sorted_movie = np.empty_like(movie)
+    sorted_movie[..., permutation] = movie
+    shift = opt_shift.Shift(1, 1, sorted_movie, precision=np.float64)
+
+    value, derivative = shift.min_resampling(np.array([step]), derivative=True)
+    assert value == pytest.approx(shift.min_resampling(np.array([step])), rel=1e-12)
+
+    h = 1e-6
+    finite_difference = (shift.min_resampling(np.array([step + h])) -
+                         shift.min_resampling(np.array([step - h]))) / (2 * h)
+    assert derivative[0] == pytest.approx(finite_difference, rel=1e-4)
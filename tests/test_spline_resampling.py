@@ -0,0 +1,88 @@
+"""
+Regression tests of the batched periodic spline resampling against interpolate.splrep / interpolate.splev.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+"""
+
+import numpy as np
+import scipy.interpolate as interpolate
+
+from unshearing import spline_resampling
+
+
+def closed_periods(shape, seed=0):
+    """
+    :param shape: Shape of the data, time as last dimension
+    :param seed: Seed of the random data
+    :return: Random data whose last time point repeats the first one
+    """
+    data = np.random.RandomState(seed).rand(*shape)
+    data[..., -1] = data[..., 0]
+    return data
+
+
+def splev_resampling(data, residue, int_interp):
+    """
+    Reference of spline_resampling: the per-pixel splrep / splev loop of the original Shift.min_resampling.
+    :param data: Closed periods of shape (ny, nx, nt)
+    :param residue: Fractional shifts of shape (ny,)
+    :param int_interp: Integer shifts of shape (ny,)
+    :return: Series of every pixel evaluated at nt_range + residue (last point kept at nt - 1), rolled by int_interp
+    """
+    nt = data.shape[-1]
+    nts = np.arange(nt)
+    out = np.empty_like(data)
+    for y in range(data.shape[0]):
+        points = nts + residue[y]
+        points[-1] = nts[-1]
+        for x in range(data.shape[1]):
+            tck = interpolate.splrep(nts, data[y, x], per=True, k=3)
+            out[y, x] = np.roll(interpolate.splev(points, tck), int_interp[y])
+    return out
+
+
+def test_spline_resampling_matches_splev():
+    data = closed_periods((8, 3, 31))
+    random_state = np.random.RandomState(1)
+    residue = random_state.rand(8)
+    int_interp = random_state.randint(-70, 70, size=8)
+
+    out = spline_resampling.spline_resampling(spline_resampling.spline_coefficients(data), residue[:, None, None],
+                                              int_interp[:, None, None])
+    np.testing.assert_allclose(out, splev_resampling(data, residue, int_interp), rtol=0, atol=1e-13)
+
+
+def test_spline_resampling_padded_buffers():
+    data = closed_periods((4, 5, 20), seed=2)
+    coefficients = spline_resampling.spline_coefficients(data)
+    residue = np.linspace(0., 0.9, 4).reshape((4, 1, 1))
+    int_interp = np.arange(4).reshape((4, 1, 1)) * 3
+
+    expected = spline_resampling.spline_resampling(coefficients, residue, int_interp)
+    out, work = np.empty_like(data), np.empty_like(data)
+    result = spline_resampling.spline_resampling(spline_resampling.pad_coefficients(coefficients), residue, int_interp,
+                                                 padded=True, out=out, work=work)
+    assert result is out
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_spline_coefficients_float32():
+    data = closed_periods((6, 2, 25), seed=3)
+    coefficients = spline_resampling.spline_coefficients(data.astype(np.float32))
+    assert coefficients.dtype == np.float32
+    np.testing.assert_allclose(coefficients, spline_resampling.spline_coefficients(data), rtol=0, atol=1e-5)
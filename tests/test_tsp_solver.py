@@ -0,0 +1,81 @@
+"""
+Regression tests of the in-process TSP solver on synthetic movies, whose true frame order is known.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+"""
+
+import numpy as np
+import pytest
+
+from sorting import tsp_solver
+from toolbox import om_toolbox, synthetic_data
+
+NT = 60
+
+
+@pytest.fixture(scope='module')
+def movie():
+    """
+    :return: Shuffled synthetic movie as float32 frames, and the permutation giving the phase of every frame
+    """
+    data, permutation = synthetic_data.synthetic_movie((32, 32, 1, 1, NT), shear=0.3, seed=0)
+    return data.astype(np.float32), permutation
+
+
+def check_tour(tour, permutation):
+    """
+    :param tour: Frame indices in visiting order
+    :param permutation: Phase of every frame
+    :return: No return, fails if the tour does not visit the phases in order
+    """
+    assert np.array_equal(np.sort(tour), np.arange(NT))
+    shared_edges, phase_error = tsp_solver.tour_agreement(permutation[tour], np.arange(NT))
+    assert shared_edges == 1.
+    assert phase_error < 1e-12
+
+
+@pytest.mark.parametrize('construction', ['greedy', 'nearest_neighbour'])
+def test_heuristic_tour(movie, construction):
+    data, permutation = movie
+    distances = om_toolbox.compute_differences(data)
+    tour = tsp_solver.solve(distances, time_limit=5., construction=construction)
+    check_tour(tour, permutation)
+    assert tsp_solver.tour_length(tour, distances) <= tsp_solver.tour_length(np.argsort(permutation), distances)
+
+
+def test_sparse_tour(movie):
+    data, permutation = movie
+    neighbours, neighbour_distances = om_toolbox.nearest_neighbours(data, 8)
+    distances = om_toolbox.FrameDistances(data, neighbours, neighbour_distances)
+    tour = tsp_solver.solve(distances, time_limit=5., n_neighbours=8, neighbours=neighbours)
+    check_tour(tour, permutation)
+    assert len(distances.cache) <= 8 * NT
+
+
+def test_frame_distances_cache_limit(movie):
+    data = movie[0]
+    matrix = om_toolbox.compute_differences(data)
+    distances = om_toolbox.FrameDistances(data, max_pairs=5)
+    random_state = np.random.RandomState(0)
+    for a, b in random_state.randint(0, NT, size=(50, 2)):
+        assert distances[a, b] == pytest.approx(matrix[a, b], rel=1e-5)
+        assert distances[b, a] == distances[a, b]
+        assert len(distances.cache) <= 5
+    rows = random_state.randint(0, NT, size=7)
+    np.testing.assert_allclose(distances[rows, 3], matrix[rows, 3], rtol=1e-5)
+    np.testing.assert_allclose(distances[rows[0]], matrix[rows[0]], rtol=1e-5)
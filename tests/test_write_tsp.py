@@ -0,0 +1,45 @@
+"""
+Regression tests of the incremental sorting of write_tsp.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+"""
+
+import os
+import numpy as np
+
+from sorting import tsp_solver, write_tsp
+from toolbox import om_toolbox, synthetic_data
+from toolbox.cache import Cache
+
+
+def test_extend_tour_reads_only_the_new_frames(tmp_path):
+    n_old, n_t = 40, 60
+    movie, permutation = synthetic_data.synthetic_movie((32, 32, 1, 1, n_t), shear=0.3, seed=0, dtype=np.float32)
+    cache = Cache(os.path.join(str(tmp_path), 'cache'))
+    tsp_path = os.path.join(str(tmp_path), 'movie_tsp_file')
+
+    write_tsp.run_tsp(movie[..., :n_old], '', 2, 2, tsp_path=tsp_path, solver='heuristic', time_limit=2., cache=cache)
+    previous_tour = om_toolbox.load_tsp_sol_file(tsp_path + '_solution.txt')
+
+    # the frames of the previous tour come from the cache: the previous frames are not read again
+    movie[..., :n_old] = np.nan
+    tour = write_tsp.extend_tour(movie, previous_tour, 2, 2, tsp_path=tsp_path + '_extended', time_limit=2.,
+                                 cache=cache)
+    shared_edges, phase_error = tsp_solver.tour_agreement(permutation[tour], np.arange(n_t))
+    assert shared_edges == 1.
+    assert phase_error < 1e-12
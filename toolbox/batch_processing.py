@@ -0,0 +1,389 @@
+"""
+Sorts and unshears many datasets in one process pool, given a manifest file or glob patterns of input paths.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+Each dataset goes through the stages 'sort' (sorting/periodic_sorting.py) then 'unshear' (unshearing/shear_correction.py,
+on the sorted output). The worker processes are started once and run one stage at a time. A stage is only started if
+the memory estimates of the running stages plus its own fit in the memory budget, one stage always being allowed.
+The completion of every stage is recorded in a JSON state file: running the same batch again skips the finished stages
+whose output still exists, and retries the failed or interrupted ones.
+Each stage writes its run report (see toolbox.profiling) next to its input.
+"""
+
+import numpy as np
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from toolbox import om_toolbox, profiling
+
+STAGES = ('sort', 'unshear')
+
+
+def parsing():
+    """
+    Bash commands
+    :return:
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputs", type=str, nargs='*', default=[],
+                        help="Input data paths or glob patterns, e.g. 'data/*.npy'.")
+    parser.add_argument("--manifest", type=str, default='',
+                        help="Text file listing one input path or glob pattern per line (# starts a comment).")
+    parser.add_argument("--state_file", type=str, default='batch_state.json',
+                        help="JSON file recording the finished stages, to resume the batch. Default=batch_state.json")
+    parser.add_argument("--stages", type=str, nargs='+', default=list(STAGES),
+                        help="Stages to run among sort and unshear. Default=sort unshear")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Maximal number of stages running at once. Default=number of CPUs")
+    parser.add_argument("--max_memory", type=int, default=0,
+                        help="Memory budget in MB of the running stages. Default=available memory")
+    parser.add_argument("--concorde", type=str, default='', help="concorde executable path")
+    parser.add_argument("-y", "--ydownsizing", type=int, default="4", help="Downsizing factor for dimension Y.")
+    parser.add_argument("-x", "--xdownsizing", type=int, default="4", help="Downsizing factor for dimension X.")
+    parser.add_argument("--solver", type=str, default='concorde',
+                        help="TSP solver: concorde, heuristic or sparse. Default=concorde")
+    parser.add_argument("--time_limit", type=float, default=30.,
+                        help="Time limit in seconds of the heuristic solvers. Default=30")
+    parser.add_argument("--n_neighbours", type=int, default=10,
+                        help="Nearest neighbours per frame used by the heuristic solvers. Default=10")
+    parser.add_argument("--no_cache", action='store_true', help="Sorts without the cache of intermediate results.")
+    parser.add_argument("--per_slice", action='store_true',
+                        help="Estimates one shift per slice and channel instead of one shift for the whole stack.")
+    parser.add_argument("--levels", type=int, default=1,
+                        help="Number of coarse-to-fine levels for the shift estimation. Default=1")
+    parser.add_argument("--chunk_size", type=int, default=256,
+                        help="Size in MB of the blocks of data read at once. Default=256")
+    parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
+                                                                          "package. Can be INFO, WARNING, ERROR.")
+    return parser.parse_args()
+
+
+def list_inputs(patterns, manifest=''):
+    """
+    :param patterns: Input paths or glob patterns
+    :param manifest: Text file with one path or glob pattern per line. Ignored if ''
+    :return: Sorted absolute paths of the inputs, without duplicates nor the outputs of other inputs
+    """
+    patterns = list(patterns)
+    if manifest:
+        with open(manifest, 'r') as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    # relative paths are relative to the manifest
+                    patterns.append(os.path.join(os.path.dirname(os.path.abspath(manifest)), line))
+
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            logging.warning('No input matches {}.'.format(pattern))
+        paths.update(os.path.abspath(path) for path in matches)
+    # a pattern like *.npy also matches the results of a previous batch
+    outputs = {output for path in paths for output in output_paths(path).values()}
+    return sorted(paths - outputs)
+
+
+def output_paths(input_path):
+    """
+    :param input_path: Input data path
+    :return: Dictionary of the output path of each stage, next to the input
+    """
+    stem = os.path.basename(os.path.normpath(input_path)).split('.')[0]
+    sorted_path = os.path.join(os.path.dirname(os.path.normpath(input_path)), stem + '_sorted.npy')
+    return {'sort': sorted_path, 'unshear': sorted_path[:-len('.npy')] + '_unsheared.npy'}
+
+
+def data_shape(input_path):
+    """
+    Reads the headers only.
+    :param input_path: NPY file, TIFF file or folder of TIFF files
+    :return: XYZCT shape
+    """
+    if input_path.endswith('.npy'):
+        shape = np.load(input_path, mmap_mode='r').shape
+        return shape[:2] + (1, 1) + shape[2:] if len(shape) == 3 else shape
+    if os.path.isdir(input_path):
+        files_names = sorted(glob.glob(os.path.join(input_path, '*.tif')) +
+                             glob.glob(os.path.join(input_path, '*.tiff')))
+        shape, _ = om_toolbox.tiff_shape(files_names[0], sequence_axis='Z')
+        return shape[:-1] + (shape[-1] * len(files_names),)
+    shape, _ = om_toolbox.tiff_shape(input_path, sequence_axis='T')
+    return shape
+
+
+def memory_estimate(stage, shape, y_downsizing_factor, x_downsizing_factor, chunk_size):
+    """
+    Rough peak memory of a stage: the blocks read at once plus what both scripts hold in memory.
+    :param stage: 'sort' or 'unshear'
+    :param shape: XYZCT shape of the stage input
+    :param y_downsizing_factor: Downsizing factor for the lines
+    :param x_downsizing_factor: Downsizing factor for the columns
+    :param chunk_size: Size in bytes of the blocks of data read at once
+    :return: Memory in bytes
+    """
+    ny, nx, nz, nc, nt = shape
+    downsized = (ny // y_downsizing_factor) * (nx // x_downsizing_factor) * nz * nc * (nt + 1) * 8
+    if stage == 'sort':
+        # downsized frames and float32 distance matrix
+        return 4 * chunk_size + downsized + nt * nt * 4
+    # downsized data, spline coefficients and resampled volume
+    return 4 * chunk_size + 3 * downsized
+
+
+def available_memory():
+    """
+    :return: Available physical memory in bytes (MemAvailable of /proc/meminfo, which counts the page cache that can be
+    reclaimed, unlike the free pages), or None if unknown
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def load_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, state_file):
+    """
+    Writes the state under another name first, so that an interruption never leaves a truncated state file.
+    """
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def run_stage(stage, input_path, output_path, options):
+    """
+    Runs one stage in a worker process.
+    :param stage: 'sort' or 'unshear'
+    :param input_path: Stage input data path
+    :param output_path: Stage output data path
+    :param options: Dictionary of the batch options
+    :return: Duration in seconds
+    """
+    # the worker processes run many stages: each one logs into the folder of its own data
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
+    start = time.time()
+    try:
+        if stage == 'sort':
+            from sorting import periodic_sorting
+            with profiling.run(profiling.default_report_path(input_path, 'sorting')):
+                periodic_sorting.main(input_path, options['concorde'], output_file_path=output_path,
+                                      x_down_sizing_factor=options['x'], y_down_sizing_factor=options['y'],
+                                      logging_level=options['logging_level'], chunk_size=options['chunk_size'],
+                                      solver=options['solver'], time_limit=options['time_limit'],
+                                      n_neighbours=options['n_neighbours'], no_cache=options['no_cache'])
+        else:
+            from unshearing import shear_correction
+            with profiling.run(profiling.default_report_path(input_path, 'unshearing')):
+                shear_correction.main(input_path, output_file_path=output_path, x_down_sizing_factor=options['x'],
+                                      y_down_sizing_factor=options['y'], logging_level=options['logging_level'],
+                                      per_slice=options['per_slice'], levels=options['levels'],
+                                      chunk_size=options['chunk_size'])
+    except SystemExit:
+        # the scripts exit on errors, after logging them
+        raise RuntimeError('{} of {} exited, see the log file next to the data.'.format(stage, input_path))
+    return time.time() - start
+
+
+def run_batch(input_paths, options, state_file='batch_state.json', stages=STAGES, jobs=1, max_memory=None):
+    """
+    :param input_paths: Input data paths
+    :param options: Dictionary of the options of the stages (see parsing)
+    :param state_file: JSON file recording the state of every stage
+    :param stages: Stages to run, in the order of STAGES
+    :param jobs: Maximal number of stages running at once
+    :param max_memory: Memory budget in bytes of the running stages. Available memory if None
+    :return: State dictionary, {input path: {stage: {'status': 'done' or 'failed', ...}}}
+    """
+    stages = [stage for stage in STAGES if stage in stages]
+    if max_memory is None:
+        max_memory = available_memory() or np.inf
+    state = load_state(state_file)
+    chunk_size = options['chunk_size'] * 1024 ** 2
+
+    # next stage to run for each dataset
+    pending = []
+    for input_path in input_paths:
+        outputs = output_paths(input_path)
+        dataset_state = state.setdefault(input_path, {})
+        todo = [stage for stage in stages
+                if not (dataset_state.get(stage, {}).get('status') == 'done' and os.path.exists(outputs[stage]))]
+        if todo:
+            pending.append([input_path, todo])
+        else:
+            logging.info('{}: already done.'.format(input_path))
+    save_state(state, state_file)
+
+    def stage_input(input_path, stage):
+        return input_path if stage == 'sort' else output_paths(input_path)['sort']
+
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        while pending or running:
+            # starts the next stages, the smallest first, while they fit in the budget
+            used = sum(memory for _, _, memory in running.values())
+            busy = {input_path for input_path, _, _ in running.values()}
+            candidates = []
+            for item in pending:
+                input_path, todo = item
+                if input_path in busy or not os.path.exists(stage_input(input_path, todo[0])):
+                    continue
+                try:
+                    shape = data_shape(stage_input(input_path, todo[0]))
+                    memory = memory_estimate(todo[0], shape, options['y'], options['x'], chunk_size)
+                except (OSError, ValueError, IndexError):
+                    # unreadable header: the stage itself reports the error
+                    memory = 0
+                candidates.append((memory, input_path, item))
+            for memory, input_path, item in sorted(candidates, key=lambda candidate: candidate[0]):
+                if len(running) >= jobs or (running and used + memory > max_memory):
+                    break
+                stage = item[1][0]
+                future = executor.submit(run_stage, stage, stage_input(input_path, stage),
+                                         output_paths(input_path)[stage], options)
+                running[future] = (input_path, stage, memory)
+                used += memory
+                pending.remove(item)
+                logging.info('{}: {} started ({} MB estimated).'.format(input_path, stage, memory // 1024 ** 2))
+
+            if not running:
+                for input_path, todo in pending:
+                    logging.error('{}: input of {} not found.'.format(input_path, todo[0]))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                input_path, stage, _ = running.pop(future)
+                try:
+                    duration = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    state[input_path][stage] = {'status': 'failed', 'error': 'worker process died: {}'.format(e)}
+                    logging.error('{}: {} failed, worker process died.'.format(input_path, stage))
+                    continue
+                except Exception as e:
+                    state[input_path][stage] = {'status': 'failed', 'error': str(e)}
+                    logging.error('{}: {} failed: {}'.format(input_path, stage, e))
+                    continue
+                state[input_path][stage] = {'status': 'done', 'output': output_paths(input_path)[stage],
+                                            'duration': duration}
+                logging.info('{}: {} done in {:.1f} s.'.format(input_path, stage, duration))
+                following = stages[stages.index(stage) + 1:]
+                if following:
+                    pending.append([input_path, following])
+            save_state(state, state_file)
+
+            if broken:
+                # a dead worker (e.g. out of memory) breaks the whole pool: the other running stages fail too
+                for future, (input_path, stage, _) in running.items():
+                    state[input_path][stage] = {'status': 'failed', 'error': 'worker pool broken'}
+                running = {}
+                save_state(state, state_file)
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=jobs)
+    finally:
+        executor.shutdown(wait=True)
+
+    return state
+
+
+def main(inputs=(), manifest='', state_file='batch_state.json', stages=STAGES, jobs=1, max_memory=0, concorde_path='',
+         x_down_sizing_factor=4, y_down_sizing_factor=4, solver='concorde', time_limit=30., n_neighbours=10,
+         no_cache=False, per_slice=False, levels=1, chunk_size=256, logging_level='INFO'):
+    """
+
+    :param inputs: Input data paths or glob patterns
+    :param manifest: Text file listing one input path or glob pattern per line. Default=''
+    :param state_file: JSON file recording the finished stages. Default='batch_state.json'
+    :param stages: Stages to run among 'sort' and 'unshear'. Default=both
+    :param jobs: Maximal number of stages running at once. Default=1
+    :param max_memory: Memory budget in MB of the running stages, 0 for the available memory. Default=0
+    :param concorde_path: Concorde path
+    :param x_down_sizing_factor: Downsizing factor for the columns. Default=4
+    :param y_down_sizing_factor: Downsizing factor for the lines. Default=4
+    :param solver: TSP solver, 'concorde', 'heuristic' or 'sparse'. Default='concorde'
+    :param time_limit: Time limit in seconds of the heuristic solvers. Default=30
+    :param n_neighbours: Nearest neighbours per frame used by the heuristic solvers. Default=10
+    :param no_cache: If True, sorts without the cache of intermediate results. Default=False
+    :param per_slice: If True, estimates one shift per slice and channel. Default=False
+    :param levels: Number of coarse-to-fine pyramid levels for the shift estimation. Default=1
+    :param chunk_size: Size in MB of the blocks of data read at once. Default=256
+    :param logging_level: level of info printed to the console. Can be INFO, WARNING, or ERROR.
+    :return:
+    """
+    logging.basicConfig(level=logging_level)
+
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        logging.error('Unknown stages {}. Can be sort or unshear.'.format(unknown))
+        sys.exit(-1)
+
+    input_paths = list_inputs(inputs, manifest)
+    if not input_paths:
+        logging.error('No input data.')
+        sys.exit(-1)
+    logging.info('{} datasets.'.format(len(input_paths)))
+
+    options = {'concorde': concorde_path, 'x': x_down_sizing_factor, 'y': y_down_sizing_factor, 'solver': solver,
+               'time_limit': time_limit, 'n_neighbours': n_neighbours, 'no_cache': no_cache, 'per_slice': per_slice,
+               'levels': levels, 'chunk_size': chunk_size, 'logging_level': logging_level}
+    state = run_batch(input_paths, options, state_file=state_file, stages=stages, jobs=jobs,
+                      max_memory=max_memory * 1024 ** 2 if max_memory else None)
+
+    failed = [input_path for input_path in input_paths
+              if any(state[input_path].get(stage, {}).get('status') != 'done' for stage in stages)]
+    if failed:
+        logging.error('{} datasets not finished: {}'.format(len(failed), ', '.join(failed)))
+        sys.exit(-1)
+    logging.info('Done.')
+
+
+if __name__ == "__main__":
+
+    parse = parsing()
+    main(parse.inputs, manifest=parse.manifest, state_file=parse.state_file, stages=parse.stages, jobs=parse.jobs,
+         max_memory=parse.max_memory, concorde_path=parse.concorde, x_down_sizing_factor=parse.xdownsizing,
+         y_down_sizing_factor=parse.ydownsizing, solver=parse.solver, time_limit=parse.time_limit,
+         n_neighbours=parse.n_neighbours, no_cache=parse.no_cache, per_slice=parse.per_slice, levels=parse.levels,
+         chunk_size=parse.chunk_size, logging_level=parse.logging_level)
@@ -0,0 +1,253 @@
+"""
+Times the sorting and scanning-aberration correction stages on synthetic movies of various sizes and measures their
+accuracy against the ground truth. The results are saved as JSON and can be compared to a previous run.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+Stages: load (NPY file read), downsize, distances, tsp (write_tsp.solve_tour as called by the sorting: distances, TSP
+file and Concorde or the heuristic solver), shift (estimation, including the downsizing of Shift) and reconstruction.
+The shift stages run on the frames sorted with the true permutation, so that their accuracy does not depend on the
+sorting. Accuracy measures:
+- sorting: fraction of the true frame-to-frame transitions in the tour, and mean phase error in periods,
+- shift: absolute error of the estimated shear, in time points per row,
+- reconstruction: RMS error against the noiseless unsheared period, relative to the intensity range (for a negative
+shift the reconstruction runs backwards in time and is compared to the reversed period).
+
+The downsizing of the lines averages lines acquired at different times, which biases the shift estimate when the
+downsized frames have few lines or the period few frames (e.g. 0.42 for a true 0.5 on 128x128x1x1x100 with factor 4).
+The default sizes keep this bias below the accuracy of the estimation: within 0.01 of a true 0.5 with factor 4.
+"""
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import logging
+from tempfile import mkdtemp
+
+from sorting import write_tsp, tsp_solver
+from unshearing import opt_shift
+from toolbox import om_toolbox, synthetic_data
+
+STAGES = ('load', 'downsize', 'distances', 'tsp', 'shift', 'reconstruction')
+GRID = ('256x256x1x1x200', '512x512x1x1x200', '256x256x2x2x200')
+
+
+def parsing():
+    """
+    Bash commands
+    :return:
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", type=str, nargs='+', default=list(GRID),
+                        help="Data sizes YxXxZxCxT. Default={}".format(' '.join(GRID)))
+    parser.add_argument("--shear", type=float, default=0.5,
+                        help="Time points between the acquisitions of two consecutive rows. Default=0.5")
+    parser.add_argument("--noise", type=float, default=0.02,
+                        help="Noise standard deviation relative to the intensity range. Default=0.02")
+    parser.add_argument("-y", "--ydownsizing", type=int, default="4", help="Downsizing factor for dimension Y.")
+    parser.add_argument("-x", "--xdownsizing", type=int, default="4", help="Downsizing factor for dimension X.")
+    parser.add_argument("--concorde", type=str, default='',
+                        help="concorde executable path. The heuristic solver is used if not given")
+    parser.add_argument("--time_limit", type=float, default=10.,
+                        help="Time limit in seconds of the heuristic solver. Default=10")
+    parser.add_argument("--levels", type=int, default=1,
+                        help="Number of coarse-to-fine levels for the shift estimation. Default=1")
+    parser.add_argument("--sample_stride", type=int, default=1,
+                        help="Starts the shift estimation on one column in sample_stride. Default=1 (all the columns)")
+    parser.add_argument("--method", type=str, default='Nelder-Mead',
+                        help="Minimization method of the shift estimation: a scipy.optimize.minimize method "
+                             "(BFGS, L-BFGS-B... use the derivative of the objective) or bracketed-newton. "
+                             "Default=Nelder-Mead")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of threads computing the frame-to-frame distances. Default=1")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data. Default=0")
+    parser.add_argument("-o", "--output", type=str, default='benchmark.json',
+                        help="JSON results file. Default=benchmark.json")
+    parser.add_argument("--baseline", type=str, default='',
+                        help="JSON results of a previous run to compare with.")
+    parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
+                                                                          "package. Can be INFO, WARNING, ERROR.")
+    return parser.parse_args()
+
+
+def parse_shape(text):
+    """
+    :param text: Size as 'YxXxZxCxT'
+    :return: XYZCT shape tuple
+    """
+    shape = tuple(int(size) for size in text.lower().split('x'))
+    if len(shape) != 5:
+        logging.error('Expecting sizes YxXxZxCxT, got {}.'.format(text))
+        sys.exit(-1)
+    return shape
+
+
+def run_case(shape, settings, tmp_data):
+    """
+    Generates one synthetic movie and runs every stage on it.
+    :param shape: XYZCT shape
+    :param settings: Dictionary of the benchmark settings (see parsing)
+    :param tmp_data: Folder of the temporary files
+    :return: Dictionary with the durations in seconds of the stages and the accuracy measures
+    """
+    times = {}
+    movie, permutation = synthetic_data.synthetic_movie(shape, shear=settings['shear'], noise=settings['noise'],
+                                                        seed=settings['seed'])
+    path = os.path.join(tmp_data, 'synthetic.npy')
+    np.save(path, movie)
+    del movie
+
+    start = time.time()
+    movie = om_toolbox.load_data(path)
+    times['load'] = time.time() - start
+
+    start = time.time()
+    downsized = om_toolbox.average_downsizing(movie, settings['y'], settings['x'])
+    times['downsize'] = time.time() - start
+    frames = write_tsp.slice_features(downsized)
+
+    start = time.time()
+    distances = om_toolbox.compute_differences(frames, workers=settings['workers'])
+    times['distances'] = time.time() - start
+
+    start = time.time()
+    tour = write_tsp.solve_tour(frames, settings['concorde'], os.path.join(tmp_data, 'synthetic_tsp_file'),
+                                workers=settings['workers'], solver='concorde' if settings['concorde'] else 'heuristic',
+                                time_limit=settings['time_limit'], work_dir=tmp_data)
+    times['tsp'] = time.time() - start
+    shared_edges, phase_error = tsp_solver.tour_agreement(tour, np.argsort(permutation))
+
+    # true order, so that the shift accuracy does not depend on the sorting
+    im_sorted = np.empty_like(movie)
+    im_sorted[..., permutation] = movie
+    del movie, downsized, distances
+
+    start = time.time()
+    shift_calc = opt_shift.Shift(settings['y'], settings['x'], im_sorted)
+    shift = shift_calc.estimate_shift(np.array([5.3]), method=settings['method'], levels=settings['levels'],
+                                      sample_stride=settings['sample_stride'])[0] / settings['y']
+    times['shift'] = time.time() - start
+
+    start = time.time()
+    reconstructed = shift_calc.reconstruction(np.array([shift]))
+    times['reconstruction'] = time.time() - start
+
+    truth = synthetic_data.ground_truth(shape, seed=settings['seed'])
+    if shift < 0:
+        truth = truth[..., -np.arange(shape[-1]) % shape[-1]]
+    scale = 0.9 * np.iinfo(im_sorted.dtype).max if np.issubdtype(im_sorted.dtype, np.integer) else 1.
+    reconstruction_error = np.sqrt(np.mean((reconstructed / scale - truth) ** 2))
+    input_error = np.sqrt(np.mean((im_sorted / scale - truth) ** 2))
+
+    accuracy = {'tour_shared_edges': float(shared_edges), 'tour_phase_error': float(phase_error),
+                'shift': float(shift), 'shift_error': float(abs(shift - settings['shear'])),
+                'shift_sampling_error': float(shift_calc.step_error / settings['y']),
+                'reconstruction_rms_error': float(reconstruction_error), 'input_rms_error': float(input_error)}
+    return {'shape': list(shape), 'times': times, 'accuracy': accuracy}
+
+
+def compare(results, baseline):
+    """
+    Logs the speed-up of every stage and the accuracy changes against a previous run, for the sizes run by both.
+    :param results: Results of this run
+    :param baseline: Results of the previous run
+    :return: No return
+    """
+    previous = {tuple(case['shape']): case for case in baseline['results']}
+    for case in results['results']:
+        old = previous.get(tuple(case['shape']))
+        if old is None:
+            continue
+        name = 'x'.join(str(size) for size in case['shape'])
+        for stage in STAGES:
+            if stage in old['times'] and case['times'][stage] > 0:
+                logging.info('{} {}: {:.3f} s -> {:.3f} s (x{:.2f})'.format(
+                    name, stage, old['times'][stage], case['times'][stage], old['times'][stage] / case['times'][stage]))
+        for measure, value in case['accuracy'].items():
+            if measure in old['accuracy']:
+                logging.info('{} {}: {:.4g} -> {:.4g}'.format(name, measure, old['accuracy'][measure], value))
+
+
+def main(grid=GRID, shear=0.5, noise=0.02, x_down_sizing_factor=4, y_down_sizing_factor=4,
+         concorde_path='', time_limit=10., levels=1, method='Nelder-Mead', workers=1, seed=0, output='benchmark.json',
+         baseline='', sample_stride=1, logging_level='INFO'):
+    """
+
+    :param grid: Data sizes, as 'YxXxZxCxT' strings
+    :param shear: Time points between the acquisitions of two consecutive rows. Default=0.5
+    :param noise: Noise standard deviation relative to the intensity range. Default=0.02
+    :param x_down_sizing_factor: Downsizing factor for the columns. Default=4
+    :param y_down_sizing_factor: Downsizing factor for the lines. Default=4
+    :param concorde_path: Concorde path. The heuristic solver is used if ''. Default=''
+    :param time_limit: Time limit in seconds of the heuristic solver. Default=10
+    :param levels: Number of coarse-to-fine pyramid levels for the shift estimation. Default=1
+    :param method: Shift estimation minimization method, see opt_shift.Shift.estimate_shift. Default='Nelder-Mead'
+    :param workers: Number of threads computing the frame-to-frame distances. Default=1
+    :param seed: Seed of the synthetic data. Default=0
+    :param output: JSON results file. Default='benchmark.json'
+    :param baseline: JSON results of a previous run to compare with. Default=''
+    :param sample_stride: Above 1, the shift estimation starts on one column in sample_stride. Default=1
+    :param logging_level: level of info printed to the console. Can be INFO, WARNING, or ERROR.
+    :return: Results dictionary
+    """
+    logging.basicConfig(level=logging_level)
+
+    settings = {'shear': shear, 'noise': noise, 'x': x_down_sizing_factor, 'y': y_down_sizing_factor,
+                'concorde': concorde_path, 'time_limit': time_limit, 'levels': levels, 'method': method,
+                'workers': workers, 'seed': seed, 'sample_stride': sample_stride}
+    results = {'settings': settings, 'python': platform.python_version(), 'numpy': np.__version__,
+               'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': []}
+
+    tmp_data = mkdtemp()
+    try:
+        for text in grid:
+            shape = parse_shape(text)
+            logging.info('Benchmarking {}...'.format(text))
+            case = run_case(shape, settings, tmp_data)
+            logging.info('{}: {}'.format(text, ', '.join('{} {:.3f} s'.format(stage, case['times'][stage])
+                                                          for stage in STAGES)))
+            logging.info('{}: {}'.format(text, ', '.join('{} {:.4g}'.format(measure, value)
+                                                          for measure, value in case['accuracy'].items())))
+            results['results'].append(case)
+    finally:
+        shutil.rmtree(tmp_data, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    logging.info('Saved results as {}'.format(output))
+
+    if baseline:
+        with open(baseline, 'r') as f:
+            compare(results, json.load(f))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parse = parsing()
+    main(parse.grid, shear=parse.shear, noise=parse.noise, x_down_sizing_factor=parse.xdownsizing,
+         y_down_sizing_factor=parse.ydownsizing, concorde_path=parse.concorde, time_limit=parse.time_limit,
+         levels=parse.levels, method=parse.method, workers=parse.workers, seed=parse.seed, output=parse.output,
+         baseline=parse.baseline, sample_stride=parse.sample_stride, logging_level=parse.logging_level)
@@ -0,0 +1,146 @@
+"""
+On-disk cache of the intermediate results of the sorting (downsized data, frame features, distance matrices, tours),
+so that re-runs only recompute what changed.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+The entries are NPY files named after a hash of everything they depend on: the content of the input data and the
+parameters of each step. A key is therefore never invalidated, a changed input or parameter simply gives another key.
+Reading an entry updates its modification time, and the least recently used entries are deleted when the cache
+exceeds its size.
+"""
+
+import numpy as np
+import os
+import glob
+import hashlib
+import logging
+
+from toolbox import om_toolbox
+
+
+class Cache:
+    def __init__(self, directory, max_size=4 * 1024 ** 3):
+        """
+        :param directory: Cache directory, created if needed
+        :param max_size: Size in bytes above which the least recently used entries are deleted
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        """
+        :param parts: Hashes of the inputs and parameters of a step, converted to text
+        :return: Key of the result of the step
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            digest.update(repr(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_array(array, chunk_size=om_toolbox.CHUNK_SIZE):
+        """
+        Hashes the content of an array, read block by block along the first axis.
+        :param array: Array, e.g. memory-mapped data
+        :param chunk_size: Size in bytes of the blocks read at once
+        :return: Hexadecimal digest, depending on the values, shape and dtype
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((array.shape, np.dtype(array.dtype).str)).encode('utf-8'))
+        if array.ndim == 0 or array.shape[0] == 0:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        else:
+            for start, stop in om_toolbox.chunks(array.shape[0], array[0].nbytes, chunk_size):
+                digest.update(np.ascontiguousarray(array[start:stop]).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key, mmap_mode=None):
+        """
+        :param key: Entry key
+        :param mmap_mode: Memory-map mode passed to np.load
+        :return: Cached array, or None if the key is not in the cache
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            array = np.load(path, mmap_mode=mmap_mode)
+        except (OSError, ValueError):
+            logging.warning('Ignoring unreadable cache entry {}.'.format(path))
+            return None
+        # the modification time orders the entries by last use
+        os.utime(path)
+        logging.info('Loaded {} from the cache.'.format(key))
+        return array
+
+    def save(self, key, array):
+        """
+        Stores an array, then evicts the least recently used entries if the cache is too large.
+        :param key: Entry key
+        :param array: Array to store
+        :return: No return
+        """
+        path = self.path(key)
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        # written under another name first: an interrupted run never leaves a truncated entry
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache holds at most max_size bytes.
+        :return: No return
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logging.info('Evicted {} from the cache.'.format(path))
+
+    def get(self, key, compute, mmap_mode=None):
+        """
+        :param key: Entry key
+        :param compute: Function without argument computing the array when it is not cached
+        :param mmap_mode: Memory-map mode passed to np.load for cached arrays
+        :return: Cached or computed array
+        """
+        array = self.load(key, mmap_mode=mmap_mode)
+        if array is None:
+            array = compute()
+            self.save(key, array)
+        return array
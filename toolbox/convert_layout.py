@@ -0,0 +1,113 @@
+"""
+Converts data between the XYZCT layout, time last, and the time-major TZCYX layout, in which every frame is contiguous
+on disk.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+In the time-major layout, reading a frame (distances between frames, downsizing) or applying a sort order (a copy of
+whole frames) reads contiguous blocks of the file. The XYZCT layout suits the reconstruction of the scanning aberration
+correction, which reads all the time points of a block of lines. The scripts read and write both layouts (--layout and
+--output_layout options), so that a movie can be converted once and sorted many times. NPY headers cannot tell the
+layouts apart: the layout of time-major files is recorded in a '.layout' file next to them, read by default.
+"""
+
+import sys
+import shutil
+from os.path import join, basename, dirname, abspath
+import argparse
+import logging
+from tempfile import mkdtemp
+
+from toolbox import om_toolbox
+
+
+def parsing():
+    """
+    Bash commands
+    :return:
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file_path", type=str,
+                        help="Input data path, NPY or TIFF. Expected 5D data.")
+    parser.add_argument("-o", "--output_file_path", type=str, default='', help="Output NPY file path.")
+    parser.add_argument("--layout", type=str, default='',
+                        help="Storage layout of the input NPY file: xyzct, or tzcyx (time-major, every frame "
+                             "contiguous). Default=the layout recorded next to the file by the scripts, "
+                             "xyzct if none")
+    parser.add_argument("--output_layout", type=str, default='tzcyx',
+                        help="Storage layout of the output NPY file, xyzct or tzcyx. Default=tzcyx")
+    parser.add_argument("--chunk_size", type=int, default=256,
+                        help="Size in MB of the blocks of data read at once. Default=256")
+    parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
+                                                                          "package. Can be INFO, WARNING, ERROR.")
+    return parser.parse_args()
+
+
+def main(input_file_path, output_file_path='', layout='', output_layout='tzcyx', chunk_size=256,
+         logging_level='INFO'):
+    """
+
+    :param input_file_path: Input data path
+    :param output_file_path: Output NPY file path. Default in input file folder
+    :param layout: Storage layout of the input NPY file, 'xyzct' or 'tzcyx'. Default='' (the layout
+    recorded next to the file, 'xyzct' if none)
+    :param output_layout: Storage layout of the output NPY file, 'xyzct' or 'tzcyx'. Default='tzcyx'
+    :param chunk_size: Size in MB of the blocks of data read at once. Default=256
+    :param logging_level: level of info printed to log file. Can be INFO, WARNING, or ERROR. Log file in input
+    directory.
+    :return:
+    """
+
+    dir_data = dirname(input_file_path)
+    filename = basename(input_file_path)
+    logging.basicConfig(filename=join(dir_data, 'convert_layout.log'), level=logging_level)
+    if output_file_path == '':
+        output_file_path = join(dir_data, filename[:filename.find(".")] + '_' + output_layout + '.npy')
+    if abspath(output_file_path) == abspath(input_file_path):
+        logging.error('The output file path is the input file path {}. Exiting script.'.format(input_file_path))
+        sys.exit(-1)
+
+    # holds the copy of TIFF inputs that cannot be memory-mapped
+    tmp_data = mkdtemp()
+    try:
+        layout = om_toolbox.resolve_layout(input_file_path, layout)
+        im_mapped = om_toolbox.load_data(input_file_path, memmap_path=join(tmp_data, 'tmp.npy'), mmap_mode='r',
+                                         layout=layout)
+        if im_mapped.ndim != 5:
+            logging.error('Expecting array with 5 dimensions. Here the array has {} dimensions ({}). Exiting script.'
+                          .format(im_mapped.ndim, im_mapped.size))
+            sys.exit(-1)
+
+        output_im = om_toolbox.allocate(im_mapped.shape, im_mapped.dtype, output_file_path, layout=output_layout)
+        om_toolbox.convert_layout(im_mapped, output_im, chunk_size=chunk_size * 1024 ** 2)
+        output_im.flush()
+        logging.info('Saved {} data as {}'.format(output_layout, output_file_path))
+
+        del im_mapped, output_im
+    finally:
+        shutil.rmtree(tmp_data, ignore_errors=True)
+
+    logging.info('Done.')
+
+
+if __name__ == "__main__":
+
+    parse = parsing()
+    main(parse.input_file_path, output_file_path=parse.output_file_path, layout=parse.layout,
+         output_layout=parse.output_layout, chunk_size=parse.chunk_size, logging_level=parse.logging_level)
@@ -1,6 +1,6 @@
 """
 Toolbox contains functions to load the data, compute image-to-image difference, downsize images,
-play movies, load SOL files.
+embed frames in a low-dimensional space, play movies, load SOL files.
 
 Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
 Written by Olivia Mariani <olivia.mariani@idiap.ch>,
@@ -27,22 +27,63 @@ import sys
 import glob
 import logging
 import tifffile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from scipy.spatial.distance import cdist
+from scipy import sparse
 
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
+from toolbox import profiling
 
-def load_data(filename):
+# axes order of the 5D data: lines, columns, slices, channels, time
+XYZCT_AXES = 'YXZCT'
+# storage layouts of NPY files: time last, or time-major (TZCYX) with every frame contiguous
+LAYOUTS = ('xyzct', 'tzcyx')
+# transpositions from XYZCT to TZCYX axes, and back
+TIME_MAJOR_AXES = (4, 2, 3, 0, 1)
+XYZCT_FROM_TIME_MAJOR = (3, 4, 1, 2, 0)
+# suffix of the text file recording the layout of a time-major NPY file, next to it
+LAYOUT_SUFFIX = '.layout'
+# default size in bytes of the blocks read at once from (memory-mapped) data
+CHUNK_SIZE = 256 * 1024 ** 2
+# frames and pixels per tile of the frame-to-frame distance computation
+TILE_FRAMES = 64
+TILE_FEATURES = 4096
+
+
+@profiling.profiled('load_data')
+def load_data(filename, memmap_path=None, workers=1, mmap_mode=None, layout=''):
     """
     Can open NPY files or TIFF files (single file or folder).
+    A single TIFF file is read as a time series of its pages, unless its metadata says otherwise. In a folder, every
+    TIFF file is one time point (the pages of a multi-page file are slices), or several if the metadata has a time
+    axis.
     :param filename:
-    :return:
+    :param memmap_path: TIFF only. If not None, the data is written into an NPY memmap at this path instead of memory
+    :param workers: TIFF folder only. Number of threads decoding the files
+    :param mmap_mode: If not None, NPY files and uncompressed single TIFF files are memory-mapped with this mode
+    instead of being read, e.g. 'r'
+    :param layout: NPY only. Storage layout of the file, 'xyzct' (or XYT) or time-major 'tzcyx' (or TYX). Time-major
+    data is returned as an XYZCT view of the stored array, without copy. '' for the layout recorded next to the file
+    (see resolve_layout)
+    :return: 5D data in order XYZCT
     """
 
+    layout = resolve_layout(filename, layout)
     if filename.endswith('.npy'):
-        output_im = np.load(filename)
-        if output_im.ndim == 3:
+        output_im = np.load(filename, mmap_mode=mmap_mode)
+        if layout == 'tzcyx':
+            if output_im.ndim == 3:
+                output_im = output_im[:, np.newaxis, np.newaxis]
+            output_im = output_im.transpose(XYZCT_FROM_TIME_MAJOR)
+        elif output_im.ndim == 3:
             output_im = output_im[..., np.newaxis, np.newaxis, :]
+        check_frame_shape(output_im, layout, filename)
+    elif layout != 'xyzct':
+        logging.error('The {} layout only applies to NPY files.'.format(layout))
+        sys.exit(-1)
     else:
         file_types = ['*.tif', '*.tiff']
         # opens a directory of TIFF files
@@ -52,71 +93,592 @@ def load_data(filename):
                 files_names.extend(glob.glob(os.path.join(filename, files)))
             tif_counter = len(files_names)
             if tif_counter >= 1:
-                sorted_files = np.sort(files_names)
-                output_im = []
-                for i in range(tif_counter):
-                    file_im = os.path.join(filename, sorted_files[i])
-                    im_in = tifffile.imread(file_im)
-                    if i == 0:
-                        output_im = im_in[..., np.newaxis]
-                    else:
-                        output_im = np.concatenate((output_im, im_in[..., np.newaxis]), axis=-1)
-                return output_im
+                return load_tiff_folder(np.sort(files_names), memmap_path=memmap_path, workers=workers)
             else:
                 logging.error('No TIFF files found in {}'.format(filename))
                 sys.exit(-1)
+        elif filename.endswith(('.tif', '.tiff')):
+            if mmap_mode is not None:
+                output_im = memmap_tiff(filename, mmap_mode=mmap_mode, sequence_axis='T')
+                if output_im is not None:
+                    return output_im
+            shape, dtype = tiff_shape(filename, sequence_axis='T')
+            output_im = allocate(shape, dtype, memmap_path)
+            output_im[:] = read_tiff(filename, sequence_axis='T')
         else:
             logging.error('Data type should be NPY or TIFF.')
             sys.exit(-1)
     return output_im
 
 
-def compute_differences(image_in):
-    output = np.reshape(image_in, (image_in.shape[0]*image_in.shape[1]*image_in.shape[2]*image_in.shape[3],
-                                  image_in.shape[-1]))
-    image_in = None
+def load_tiff_folder(files_names, memmap_path=None, workers=1):
+    """
+    Stacks TIFF files along time. The headers are read first to preallocate the output, then the files are decoded
+    straight into it.
+    :param files_names: Sorted TIFF file paths
+    :param memmap_path: If not None, the data is written into an NPY memmap at this path instead of memory
+    :param workers: Number of threads decoding the files
+    :return: 5D data in order XYZCT
+    """
+    shapes = []
+    for file_name in files_names:
+        shape, dtype = tiff_shape(file_name, sequence_axis='Z')
+        if shapes and shape[:-1] != shapes[0][:-1]:
+            logging.error('TIFF file {} has shape {}, expected {} as the first file.'
+                          .format(file_name, shape[:-1], shapes[0][:-1]))
+            sys.exit(-1)
+        shapes.append(shape)
+    time_stops = np.cumsum([shape[-1] for shape in shapes])
+
+    output_im = allocate(shapes[0][:-1] + (int(time_stops[-1]),), dtype, memmap_path)
+
+    def read_file(i):
+        output_im[..., time_stops[i] - shapes[i][-1]:time_stops[i]] = read_tiff(files_names[i], sequence_axis='Z')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() propagates the decoding errors
+        list(executor.map(read_file, range(len(files_names))))
+
+    return output_im
+
+
+def allocate(shape, dtype, memmap_path=None, layout='xyzct'):
+    """
+    :param shape: Data shape, XYZCT for the time-major layout
+    :param dtype: Data type
+    :param memmap_path: If not None, NPY file backing the data. Its layout is recorded next to it (see record_layout)
+    :param layout: 'xyzct', or 'tzcyx' to store every frame contiguously. The array is then the XYZCT view of the
+    TZCYX storage
+    :return: Uninitialized array, or NPY memmap
+    """
+    check_layout(layout)
+    if layout == 'tzcyx':
+        shape = tuple(shape[axis] for axis in TIME_MAJOR_AXES)
+    if memmap_path is None:
+        output_im = np.empty(shape, dtype=dtype)
+    else:
+        output_im = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=dtype, shape=shape)
+        record_layout(memmap_path, layout)
+    return output_im.transpose(XYZCT_FROM_TIME_MAJOR) if layout == 'tzcyx' else output_im
+
+
+def record_layout(filename, layout):
+    """
+    Writes the layout of a time-major NPY file into filename + LAYOUT_SUFFIX, which NPY headers cannot hold. XYZCT
+    files have no record, so that files written before the records are read as XYZCT: an outdated record is deleted.
+    :param filename: NPY file path
+    :param layout: Storage layout of the file
+    :return: No return
+    """
+    layout_path = filename + LAYOUT_SUFFIX
+    if layout == 'xyzct':
+        if os.path.exists(layout_path):
+            os.remove(layout_path)
+        return
+    with open(layout_path, 'w') as f:
+        f.write(layout + '\n')
+
+
+def resolve_layout(filename, layout=''):
+    """
+    :param filename: Data path
+    :param layout: Declared storage layout, '' for the recorded one
+    :return: The declared layout, or the layout recorded by record_layout, 'xyzct' if there is no record. Exits if the
+    declared layout is not the recorded one
+    """
+    recorded = 'xyzct'
+    layout_path = filename + LAYOUT_SUFFIX
+    if os.path.exists(layout_path):
+        with open(layout_path, 'r') as f:
+            recorded = f.read().strip()
+    if layout == '':
+        layout = recorded
+    elif layout != recorded:
+        logging.error('{} is declared {} but its layout is recorded as {} ({}). Exiting script.'
+                      .format(filename, layout, recorded, layout_path))
+        sys.exit(-1)
+    check_layout(layout)
+    return layout
+
+
+def check_frame_shape(input_im, layout, filename=''):
+    """
+    Warns when the shape of data looks like another layout read as this one: frames of fewer lines or columns than
+    channels, or of very few lines or columns (e.g. TZCYX data read as XYZCT has the lines as channels and the slices
+    as columns).
+    :param input_im: XYZCT data
+    :param layout: Layout the data was read with
+    :param filename: Data path, for the message
+    :return: No return
+    """
+    ny, nx, nz, nc = input_im.shape[:4]
+    if min(ny, nx) < max(nc, 8):
+        logging.warning('{} read as {} gives {} frames of {}x{} pixels, {} slices and {} channels. Check its layout.'
+                        .format(filename, layout, input_im.shape[-1], ny, nx, nz, nc))
+
+
+def check_layout(layout):
+    """
+    Exits if the layout is unknown.
+    :param layout: Storage layout name
+    :return: No return
+    """
+    if layout not in LAYOUTS:
+        logging.error('Unknown data layout {}. Can be {}.'.format(layout, ' or '.join(LAYOUTS)))
+        sys.exit(-1)
+
+
+def is_time_major(input_im):
+    """
+    :param input_im: XYZCT data
+    :return: True if every frame of the data is contiguous in memory, e.g. the XYZCT view of TZCYX data
+    """
+    return input_im.ndim == 5 and input_im.transpose(TIME_MAJOR_AXES).flags.c_contiguous
+
+
+def frame_rows(image_in, start, stop, dtype=None):
+    """
+    Reads frames as the rows of a matrix, pixels in XYZC order. The copy reads whole frames from time-major data
+    (see is_time_major), and is avoided when the frames already have the requested data type.
+    :param image_in: Data with time as last dimension
+    :param start: First frame
+    :param stop: Last frame (excluded)
+    :param dtype: Data type of the matrix, that of the data if None
+    :return: C-contiguous array (stop - start, frame size)
+    """
+    frames = np.moveaxis(image_in[..., start:stop], -1, 0)
+    return np.ascontiguousarray(np.reshape(frames, (stop - start, -1)), dtype=dtype)
+
+
+@profiling.profiled('convert_layout')
+def convert_layout(input_im, output_im, chunk_size=CHUNK_SIZE):
+    """
+    Copies XYZCT data into an array of another storage layout (see allocate), by blocks read contiguously from the
+    input: blocks of frames from time-major data, blocks of lines otherwise.
+    :param input_im: XYZCT data, e.g. memory-mapped
+    :param output_im: XYZCT array of the same shape, e.g. the view of a time-major memmap
+    :param chunk_size: Size in bytes of the blocks read at once
+    :return: output_im
+    """
+    if is_time_major(input_im):
+        for start, stop in chunks(input_im.shape[-1], input_im[..., 0].nbytes, chunk_size):
+            output_im[..., start:stop] = input_im[..., start:stop]
+    else:
+        for start, stop in chunks(input_im.shape[0], input_im[0].nbytes, chunk_size):
+            output_im[start:stop] = input_im[start:stop]
+    return output_im
+
+
+def tiff_axes(axes, sequence_axis):
+    """
+    Maps the tifffile axes letters to XYZCT letters.
+    :param axes: tifffile series axes, e.g. 'TZCYX' or 'QYX'
+    :param sequence_axis: Letter given to generic page sequences ('I', 'Q'): 'T' or 'Z'
+    :return: Axes letters among 'YXZCT'
+    """
+    axes = axes.replace('S', 'C').replace('I', sequence_axis).replace('Q', sequence_axis)
+    if len(set(axes)) != len(axes) or not set(axes) <= set(XYZCT_AXES):
+        logging.error('Cannot map the TIFF axes {} to XYZCT.'.format(axes))
+        sys.exit(-1)
+    return axes
+
+
+def tiff_shape(file_name, sequence_axis='T'):
+    """
+    Reads the TIFF header only.
+    :param file_name: TIFF file path
+    :param sequence_axis: Letter given to generic page sequences: 'T' or 'Z'
+    :return: XYZCT shape, dtype
+    """
+    with tifffile.TiffFile(file_name) as tif:
+        series = tif.series[0]
+        axes = tiff_axes(series.axes, sequence_axis)
+        shape = dict(zip(axes, series.shape))
+        return tuple(shape.get(axis, 1) for axis in XYZCT_AXES), series.dtype
+
+
+def read_tiff(file_name, sequence_axis='T'):
+    """
+    :param file_name: TIFF file path
+    :param sequence_axis: Letter given to generic page sequences: 'T' or 'Z'
+    :return: 5D data in order XYZCT
+    """
+    with tifffile.TiffFile(file_name) as tif:
+        series = tif.series[0]
+        axes = tiff_axes(series.axes, sequence_axis)
+        im_in = series.asarray()
+    return to_xyzct(im_in, axes)
+
+
+def memmap_tiff(file_name, mmap_mode='r', sequence_axis='T'):
+    """
+    :param file_name: TIFF file path
+    :param mmap_mode: Memmap mode
+    :param sequence_axis: Letter given to generic page sequences: 'T' or 'Z'
+    :return: 5D memmap view in order XYZCT, or None if the file data is compressed or not contiguous
+    """
+    with tifffile.TiffFile(file_name) as tif:
+        axes = tiff_axes(tif.series[0].axes, sequence_axis)
+    try:
+        im_in = tifffile.memmap(file_name, mode=mmap_mode)
+    except ValueError:
+        logging.warning('TIFF file {} cannot be memory-mapped, reading it instead.'.format(file_name))
+        return None
+    return to_xyzct(im_in, axes)
+
+
+def to_xyzct(im_in, axes):
+    """
+    :param im_in: Data array
+    :param axes: Letters of the axes of im_in, among 'YXZCT'
+    :return: 5D view of im_in in order XYZCT
+    """
+    missing_axes = [axis for axis in XYZCT_AXES if axis not in axes]
+    im_in = np.reshape(im_in, im_in.shape + (1,) * len(missing_axes))
+    axes = axes + ''.join(missing_axes)
+    return np.transpose(im_in, [axes.index(axis) for axis in XYZCT_AXES])
+
+
+@profiling.profiled('compute_differences')
+def compute_differences(image_in, workers=1, dtype=np.float32, output=None):
+    """
+    Computes the L1 distance between every pair of frames, by tiles (see iter_differences).
+    :param image_in: Data with time as last dimension
+    :param workers: Number of threads computing the tiles
+    :param dtype: Distances data type. Integer types round the distances
+    :param output: Array receiving the nt x nt distances, e.g. a memmap to write the matrix to disk. Allocated if None
+    :return: Symmetric matrix of frame-to-frame distances
+    """
+    nt = image_in.shape[-1]
+    if output is None:
+        output = np.zeros((nt, nt), dtype=dtype)
+
+    for start, stop, band in iter_differences(image_in, workers=workers, dtype=dtype):
+        output[start:stop, start:] = band
+        output[start:, start:stop] = band.T
+
+    return output
+
+
+def iter_differences(image_in, workers=1, dtype=np.float32):
+    """
+    Computes the upper triangle of the L1 frame-to-frame distance matrix, one band of TILE_FRAMES rows at a time, so
+    that the matrix can be written out while it is computed. Each band is split into tiles of TILE_FRAMES columns
+    computed by a thread pool, and the tiles accumulate the distances over blocks of TILE_FEATURES pixels that stay in
+    cache. Memory is bounded by the band size.
+    :param image_in: Data with time as last dimension
+    :param workers: Number of threads computing the tiles
+    :param dtype: Distances data type. Integer types round the distances
+    :return: Generator of (start, stop, band), band[i, j] being the distance between the frames start + i and start + j,
+    for start + i < stop and start + j < nt
+    """
+    nt = image_in.shape[-1]
+    frame_size = int(np.prod(image_in.shape[:-1]))
+    # single precision features are enough for float32 distances, and halve the memory traffic
+    features_dtype = np.float32 if np.dtype(dtype) == np.float32 else np.float64
+    integer = np.issubdtype(dtype, np.integer)
+
+    def read_frames(start, stop):
+        return frame_rows(image_in, start, stop, dtype=features_dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, nt, TILE_FRAMES):
+            stop = min(start + TILE_FRAMES, nt)
+            frames = read_frames(start, stop)
+            band = np.empty((stop - start, nt - start), dtype=dtype)
+
+            def compute_tile(tile_start):
+                tile_stop = min(tile_start + TILE_FRAMES, nt)
+                tile_frames = read_frames(tile_start, tile_stop)
+                tile = np.zeros((stop - start, tile_stop - tile_start))
+                for feature in range(0, frame_size, TILE_FEATURES):
+                    tile += cdist(frames[:, feature:feature + TILE_FEATURES],
+                                  tile_frames[:, feature:feature + TILE_FEATURES], 'cityblock')
+                band[:, tile_start - start:tile_stop - start] = np.rint(tile) if integer else tile
 
-    output = pdist(output.T, 'minkowski', p=1)
-    output = squareform(output)
+            # list() propagates the errors of the threads
+            list(executor.map(compute_tile, range(start, nt, TILE_FRAMES)))
+            yield start, stop, band
 
+
+@profiling.profiled('nearest_neighbours')
+def nearest_neighbours(image_in, n_neighbours, workers=1):
+    """
+    Finds the closest frames (L1) of every frame from the bands of iter_differences, holding only the n_neighbours
+    best candidates of each frame instead of the distance matrix.
+    :param image_in: Data with time as last dimension
+    :param n_neighbours: Number of neighbours per frame
+    :param workers: Number of threads computing the distances
+    :return: Neighbour indices and their distances, arrays (nt, n_neighbours), closest first
+    """
+    nt = image_in.shape[-1]
+    n_neighbours = min(n_neighbours, nt - 1)
+    best_distances = np.full((nt, n_neighbours), np.inf)
+    best_indices = np.zeros((nt, n_neighbours), dtype=np.int64)
+
+    def merge(start, stop, distances, indices):
+        distances = np.concatenate((best_distances[start:stop], distances), axis=1)
+        indices = np.concatenate((best_indices[start:stop], indices), axis=1)
+        keep = np.argpartition(distances, n_neighbours - 1, axis=1)[:, :n_neighbours]
+        best_distances[start:stop] = np.take_along_axis(distances, keep, axis=1)
+        best_indices[start:stop] = np.take_along_axis(indices, keep, axis=1)
+
+    for start, stop, band in iter_differences(image_in, workers=workers, dtype=np.float64):
+        band_rows = np.arange(stop - start)
+        band[band_rows, band_rows] = np.inf
+        merge(start, stop, band, np.broadcast_to(np.arange(start, nt), band.shape))
+        # the band frames are also candidates of the following frames (lower triangle)
+        merge(stop, nt, band[:, stop - start:].T, np.broadcast_to(np.arange(start, stop), (nt - stop, stop - start)))
+
+    order = np.argsort(best_distances, axis=1)
+    return np.take_along_axis(best_indices, order, axis=1), np.take_along_axis(best_distances, order, axis=1)
+
+
+def cross_differences(image_a, image_b):
+    """
+    Computes the L1 distance between every frame of a movie and every frame of another one, e.g. two slices of a
+    stack, accumulated over blocks of TILE_FEATURES pixels.
+    :param image_a: Data with time as last dimension
+    :param image_b: Data with time as last dimension, with the frame size of image_a
+    :return: Matrix (nt_a, nt_b) of distances, [i, j] being the distance between frame i of image_a and frame j of
+    image_b
+    """
+    frames_a = np.reshape(image_a, (-1, image_a.shape[-1])).T
+    frames_b = np.reshape(image_b, (-1, image_b.shape[-1])).T
+    output = np.zeros((frames_a.shape[0], frames_b.shape[0]))
+    for feature in range(0, frames_a.shape[1], TILE_FEATURES):
+        output += cdist(np.asarray(frames_a[:, feature:feature + TILE_FEATURES], dtype=np.float64),
+                        np.asarray(frames_b[:, feature:feature + TILE_FEATURES], dtype=np.float64), 'cityblock')
     return output
 
 
-def average_downsizing(input_im, y_downsizing_factor, x_downsizing_factor):
+class FrameDistances:
+    """
+    Frame-to-frame L1 distances computed on demand and indexed like the distance matrix (distances[a, b], with indices
+    or arrays of indices), for movies too long to hold the nt x nt matrix. Single pairs are kept in a least recently
+    used cache of max_pairs pairs, so that the memory stays O(nt x n_neighbours).
     """
-    Downsizes image by averaging data.
-    :param input_im: Input image
+
+    def __init__(self, image_in, neighbours=None, neighbour_distances=None, max_pairs=None):
+        """
+
+        :param image_in: Data with time as last dimension
+        :param neighbours: Optional neighbour indices (nearest_neighbours output), whose distances are cached
+        :param neighbour_distances: Distances of the neighbours
+        :param max_pairs: Maximal number of cached pairs. Default: n_neighbours x nt, with the number of neighbours of
+        neighbours, or 10
+        """
+        nt = image_in.shape[-1]
+        self.shape = (nt, nt)
+        self.frames = frame_rows(image_in, 0, nt, dtype=np.float32)
+        if max_pairs is None:
+            max_pairs = (10 if neighbours is None else max(np.shape(neighbours)[1], 1)) * nt
+        self.max_pairs = max_pairs
+        # pairs (a, b) with a <= b, least recently used first
+        self.cache = OrderedDict()
+        if neighbours is not None:
+            for a, (indices, distances) in enumerate(zip(neighbours, neighbour_distances)):
+                for b, distance in zip(indices.tolist(), distances.tolist()):
+                    self.cache_pair(a, b, distance)
+
+    def cache_pair(self, a, b, distance):
+        """
+        :param a: Frame index
+        :param b: Frame index
+        :param distance: Distance between the frames a and b
+        :return: No return
+        """
+        self.cache[(a, b) if a <= b else (b, a)] = distance
+        if len(self.cache) > self.max_pairs:
+            self.cache.popitem(last=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and len(index) == 2:
+            try:
+                # cached pair of frames, e.g. the moves of tsp_solver
+                key = index if index[0] <= index[1] else (index[1], index[0])
+                distance = self.cache[key]
+            except (KeyError, TypeError, ValueError):
+                pass
+            else:
+                self.cache.move_to_end(key)
+                return distance
+        if not isinstance(index, tuple):
+            index = (index, slice(None))
+        rows, columns = index
+        if isinstance(columns, slice):
+            columns = np.arange(self.shape[1])[columns]
+        if np.ndim(rows) == 0 and np.ndim(columns) == 0:
+            a, b = int(rows), int(columns)
+            distance = float(np.sum(np.fabs(self.frames[a] - self.frames[b]), dtype=np.float64))
+            self.cache_pair(a, b, distance)
+            return distance
+
+        rows, columns = np.broadcast_arrays(np.asarray(rows), np.asarray(columns))
+        output = np.empty(rows.shape)
+        flat_rows, flat_columns, flat_output = rows.ravel(), columns.ravel(), output.reshape(-1)
+        for start, stop in chunks(flat_rows.size, self.frames.shape[1] * 4 * 2):
+            flat_output[start:stop] = np.sum(np.fabs(self.frames[flat_rows[start:stop]] -
+                                                     self.frames[flat_columns[start:stop]]), axis=1, dtype=np.float64)
+        return output
+
+
+@profiling.profiled('embed_frames')
+def embed_frames(image_in, n_components=256, method='pca', chunk_size=CHUNK_SIZE, seed=0):
+    """
+    Compresses every frame into a few features, so that frame-to-frame distances cost O(n_components) instead of
+    O(pixels). The frames are streamed by blocks.
+    'pca' projects the frames on their first principal components, computed by incremental SVD updates over the blocks
+    (two passes over the data). 'random_projection' multiplies the frames by a sparse random matrix (one pass), which
+    approximately preserves the distances whatever the data.
+    :param image_in: Data with time as last dimension
+    :param n_components: Number of features per frame
+    :param method: 'pca' or 'random_projection'
+    :param chunk_size: Size in bytes of the blocks of frames read at once
+    :param seed: Seed of the random projection
+    :return: Features array (n_components, nt), time last like the input data
+    """
+    nt = image_in.shape[-1]
+    frame_size = int(np.prod(image_in.shape[:-1]))
+    n_components = min(n_components, frame_size)
+    # at least n_components frames per block, for the incremental SVD to keep all the components
+    blocks = chunks(nt, frame_size * 8 * 4, max(chunk_size, n_components * frame_size * 8 * 4))
+
+    def read_frames(start, stop):
+        return frame_rows(image_in, start, stop, dtype=np.float64)
+
+    features = np.empty((n_components, nt))
+    if method == 'random_projection':
+        # sparse random projection (Li et al., 2006): entries +-sqrt(s / n_components) with density 1 / s
+        density = 1. / np.sqrt(frame_size)
+        random_state = np.random.RandomState(seed)
+        projection = sparse.random(frame_size, n_components, density=density, format='csr', random_state=random_state,
+                                   data_rvs=lambda n: random_state.choice([-1., 1.], n))
+        projection = projection * np.sqrt(1. / (density * n_components))
+        for start, stop in blocks:
+            features[:, start:stop] = (projection.T @ read_frames(start, stop).T)
+    elif method == 'pca':
+        mean = np.zeros(frame_size)
+        components = np.zeros((0, frame_size))
+        singular_values = np.zeros(0)
+        n_seen = 0
+        for start, stop in blocks:
+            frames = read_frames(start, stop)
+            block_mean = np.mean(frames, axis=0)
+            n_total = n_seen + stop - start
+            # previous components weighted by their singular values, new centred frames, and mean shift correction
+            stacked = [singular_values[:, np.newaxis] * components, frames - block_mean]
+            if n_seen:
+                stacked.append(np.sqrt(n_seen * (stop - start) / n_total) * (mean - block_mean)[np.newaxis])
+            stacked = np.concatenate(stacked)
+            # SVD through the eigenvectors of the small Gram matrix, the frames being much longer than the block
+            eigenvalues, eigenvectors = np.linalg.eigh(stacked @ stacked.T)
+            top = np.argsort(eigenvalues)[::-1][:n_components]
+            singular_values = np.sqrt(np.maximum(eigenvalues[top], 0))
+            top = top[singular_values > singular_values[0] * 1e-10]
+            singular_values = singular_values[:top.size]
+            components = (eigenvectors[:, top].T @ stacked) / singular_values[:, np.newaxis]
+            mean = (n_seen * mean + (stop - start) * block_mean) / n_total
+            n_seen = n_total
+        for start, stop in blocks:
+            features[:components.shape[0], start:stop] = components @ (read_frames(start, stop) - mean).T
+        features[components.shape[0]:] = 0
+    else:
+        logging.error('Unknown frame embedding {}. Can be pca or random_projection.'.format(method))
+        sys.exit(-1)
+
+    return features
+
+
+def chunks(length, item_size, chunk_size=CHUNK_SIZE):
+    """
+    Splits an axis into blocks of at most chunk_size bytes (at least one item per block).
+    :param length: Axis length
+    :param item_size: Size in bytes of one item of the axis (e.g. one frame)
+    :param chunk_size: Maximal size in bytes of a block
+    :return: List of (start, stop) of the blocks
+    """
+    step = max(1, int(chunk_size // max(item_size, 1)))
+    return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+@profiling.profiled('average_downsizing')
+def average_downsizing(input_im, y_downsizing_factor, x_downsizing_factor, chunk_size=CHUNK_SIZE, dtype=np.float64,
+                       mode='crop'):
+    """
+    Downsizes image by averaging data. The input is read by blocks of frames, each block being averaged at once for
+    all slices, channels and frames (see downsize_block).
+    :param input_im: Input image, 5D XYZCT
     :param y_downsizing_factor: Downsizing factor for the lines
     :param x_downsizing_factor: Downsizing factor for the columns
+    :param chunk_size: Size in bytes of the blocks of frames read at once
+    :param dtype: Output data type, None for the input data type. Default=np.float64
+    :param mode: 'crop' or 'pad', for the sizes that are not multiples of the factors (see downsize_block)
     :return: Downsized image
     """
-    shape_image = np.array(input_im.shape, dtype=np.int)
-    if (shape_image[0] / y_downsizing_factor).is_integer():
-        shape_image[0] = int(shape_image[0] / y_downsizing_factor)
-    else:
-        y_downsizing_factor = 1
-        logging.warning('Y division factor {} '
-                        'is not a divider of axis 0 of size {}'
-                        '. Will use 1 instead.'.format(y_downsizing_factor, shape_image[0]))
-    if (shape_image[1] / x_downsizing_factor).is_integer():
-        shape_image[1] = int(shape_image[1] / x_downsizing_factor)
-    else:
-        x_downsizing_factor = 1
-        logging.warning('X division factor {} '
-                        'is not a divider of axis 1 of size size {}'
-                        '. Will use 1 instead.'.format(x_downsizing_factor, shape_image[1]))
-    if input_im.ndim == 5:
-        image_out = np.ones(shape_image)*np.mean(input_im)
-        for t in range(shape_image[-1]):
-            for c in range(shape_image[3]):
-                for z in range(shape_image[2]):
-                    image_out[..., z, c, t] = rebin(input_im[..., z, c, t], image_out[..., z, c, t].shape)
-    else:
+    if input_im.ndim != 5:
         logging.warning('Input must have 5 dimensions. Returning input image without downsizing.')
         return input_im
+    if mode not in ('crop', 'pad'):
+        logging.error('Unknown downsizing mode {}. Can be crop or pad.'.format(mode))
+        sys.exit(-1)
+    ny, nx = input_im.shape[:2]
+    if ny % y_downsizing_factor or nx % x_downsizing_factor:
+        logging.warning('Downsizing factors {}x{} are not dividers of the size {}x{}: the last lines and columns are '
+                        '{}.'.format(y_downsizing_factor, x_downsizing_factor, ny, nx,
+                                     'dropped' if mode == 'crop' else 'averaged with copies of the last ones'))
+
+    dtype = input_im.dtype if dtype is None else np.dtype(dtype)
+    if mode == 'pad':
+        shape_image = (-(-ny // y_downsizing_factor), -(-nx // x_downsizing_factor)) + input_im.shape[2:]
+    else:
+        shape_image = (ny // y_downsizing_factor, nx // x_downsizing_factor) + input_im.shape[2:]
+    # time-major data gives time-major downsized data, whose frames are read contiguously as well
+    image_out = allocate(shape_image, dtype, layout='tzcyx' if is_time_major(input_im) else 'xyzct')
+    # the averages of a block are computed in float64, next to the block itself
+    frame_size = input_im[..., 0].nbytes + input_im[..., 0].size * 8 // (y_downsizing_factor * x_downsizing_factor)
+    for start, stop in chunks(input_im.shape[-1], frame_size, chunk_size):
+        image_out[..., start:stop] = downsize_block(input_im[..., start:stop], y_downsizing_factor, x_downsizing_factor,
+                                                    dtype=dtype, mode=mode)
     return image_out
 
 
+def downsize_block(block, y_downsizing_factor, x_downsizing_factor, dtype=np.float64, mode='crop'):
+    """
+    Averages groups of y_downsizing_factor lines by x_downsizing_factor columns, for all the other axes at once (one
+    reshape and one mean, or two sums for time-major blocks). Can be applied to the blocks of frames of a stream as
+    they are read.
+    :param block: Data with the lines and columns as first axes, e.g. a block of XYZCT frames
+    :param y_downsizing_factor: Downsizing factor for the lines
+    :param x_downsizing_factor: Downsizing factor for the columns
+    :param dtype: Output data type. The means are rounded for integer types. Default=np.float64
+    :param mode: For the sizes that are not multiples of the factors, 'crop' drops the last lines and columns, 'pad'
+    averages them with copies of the last line and column. Default='crop'
+    :return: Downsized block
+    """
+    block = np.asarray(block)
+    ny, nx = block.shape[:2]
+    if mode == 'pad' and (ny % y_downsizing_factor or nx % x_downsizing_factor):
+        padding = ((0, -ny % y_downsizing_factor), (0, -nx % x_downsizing_factor)) + ((0, 0),) * (block.ndim - 2)
+        block = np.pad(block, padding, mode='edge')
+    ny_out, nx_out = block.shape[0] // y_downsizing_factor, block.shape[1] // x_downsizing_factor
+    if is_time_major(block):
+        # the columns are the last axis in memory: lines of contiguous pixels are summed first, then the columns
+        frames = block.transpose(TIME_MAJOR_AXES)[..., :ny_out * y_downsizing_factor, :nx_out * x_downsizing_factor]
+        sums = frames.reshape(frames.shape[:3] + (ny_out, y_downsizing_factor, frames.shape[-1])).sum(
+            axis=4, dtype=np.float64)
+        sums = sums.reshape(sums.shape[:4] + (nx_out, x_downsizing_factor)).sum(axis=-1)
+        out = (sums / (y_downsizing_factor * x_downsizing_factor)).transpose(XYZCT_FROM_TIME_MAJOR)
+    else:
+        block = block[:ny_out * y_downsizing_factor, :nx_out * x_downsizing_factor]
+        # splitting the lines and columns axes is a view, even on a cropped block
+        out = block.reshape((ny_out, y_downsizing_factor, nx_out, x_downsizing_factor) + block.shape[2:]).mean(
+            axis=(1, 3), dtype=np.float64)
+    if np.issubdtype(dtype, np.integer):
+        out = np.rint(out)
+    return out.astype(dtype, copy=False)
+
+
 def rebin(input_im, output_shape):
     """
 
@@ -169,3 +731,16 @@ def load_tsp_sol_file(sol_file_path):
     arr_concorde.pop(0)
     arr_concorde = np.array([np.array(x) for x in arr_concorde])
     return np.hstack(arr_concorde)
+
+
+def write_tsp_sol_file(arr_concorde, sol_file_path):
+    """
+    Writes a tour in the format of the concorde SOL files
+    :param arr_concorde: Frame indices in visiting order
+    :param sol_file_path: SOL file path
+    :return: No return
+    """
+    with open(sol_file_path, 'w') as f:
+        f.write('{}\n'.format(len(arr_concorde)))
+        for start in range(0, len(arr_concorde), 10):
+            f.write(' '.join(str(i) for i in arr_concorde[start:start + 10]) + ' \n')
@@ -0,0 +1,230 @@
+"""
+Instrumentation of the processing stages: wall and CPU time, peak memory, disk input/output and call counts, gathered
+into a JSON report, with an optional cProfile dump.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+The stages are recorded by name, several calls of the same stage adding up. Nested stages are recorded independently,
+the time of a stage including the time of the stages it calls. The CPU time includes the threads and the finished child
+processes (Concorde, reconstruction workers). The bytes read and written are the storage accesses of the process
+(Linux only), which include the pages of memory-mapped files. The peak memory, process_peak_rss, is the largest
+resident size of the process since its start, read at the end of each call: it is not the peak of the stage itself,
+and in the reused worker processes of the batch runner it includes the datasets processed before.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+import contextlib
+import logging
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: no memory and child process figures
+    resource = None
+
+_records = {}
+# figures of the process when the run started
+_start = {}
+
+
+def reset():
+    """
+    Forgets the recorded stages.
+    :return: No return
+    """
+    _records.clear()
+    _start.update(wall_time=time.time(), cpu_time=cpu_time(), io=io_counters())
+
+
+def io_counters():
+    """
+    :return: Bytes read from and written to storage by the process since its start, (None, None) if unknown
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def cpu_time():
+    """
+    :return: CPU time in seconds of the process, its threads and its finished child processes
+    """
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_memory():
+    """
+    :return: Largest resident size in bytes of the process since its start, None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def difference(start, stop):
+    return None if start is None or stop is None else stop - start
+
+
+def record(name, wall, cpu=None, read_bytes=None, written_bytes=None, process_peak=None):
+    """
+    Adds one call to the figures of a stage.
+    :param name: Stage name
+    :param wall: Wall time in seconds
+    :param cpu: CPU time in seconds
+    :param read_bytes: Bytes read from storage
+    :param written_bytes: Bytes written to storage
+    :param process_peak: Peak resident memory in bytes of the process since its start
+    :return: No return
+    """
+    stage = _records.setdefault(name, {'calls': 0, 'wall_time': 0.})
+    stage['calls'] += 1
+    stage['wall_time'] += wall
+    for key, value in (('cpu_time', cpu), ('read_bytes', read_bytes), ('written_bytes', written_bytes)):
+        if value is not None:
+            stage[key] = stage.get(key, 0) + value
+    if process_peak is not None:
+        stage['process_peak_rss'] = max(stage.get('process_peak_rss', 0), process_peak)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records the wall and CPU time and storage input/output of a block of code, and the peak memory of the process at
+    its end.
+    :param name: Stage name
+    """
+    read_start, written_start = io_counters()
+    cpu_start = cpu_time()
+    wall_start = time.time()
+    try:
+        yield
+    finally:
+        wall = time.time() - wall_start
+        cpu = cpu_time() - cpu_start
+        read_stop, written_stop = io_counters()
+        record(name, wall, cpu, difference(read_start, read_stop), difference(written_start, written_stop),
+               peak_memory())
+
+
+def profiled(name):
+    """
+    Decorator recording every call of a function as the stage name.
+    :param name: Stage name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def counted(name):
+    """
+    Decorator counting the calls of a function and their wall time only, for functions called many times such as
+    objective functions.
+    :param name: Stage name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            wall_start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.time() - wall_start)
+        return wrapper
+    return decorator
+
+
+def report():
+    """
+    :return: Dictionary of the recorded stages, with the mean wall time per call, and of the whole run
+    """
+    stages = {}
+    for name, figures in _records.items():
+        stages[name] = dict(figures, wall_time_per_call=figures['wall_time'] / figures['calls'])
+    read_start, written_start = _start['io']
+    read_stop, written_stop = io_counters()
+    return {'stages': stages,
+            'total': {'wall_time': time.time() - _start['wall_time'], 'cpu_time': cpu_time() - _start['cpu_time'],
+                      'process_peak_rss': peak_memory(), 'read_bytes': difference(read_start, read_stop),
+                      'written_bytes': difference(written_start, written_stop)},
+            'argv': sys.argv, 'pid': os.getpid(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def save_report(path):
+    """
+    Writes report() as JSON.
+    :param path: JSON file path
+    :return: No return
+    """
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=1)
+    logging.info('Saved run report as {}'.format(path))
+
+
+def default_report_path(input_path, name):
+    """
+    :param input_path: Input data path
+    :param name: Name of the processing
+    :return: Default report path, next to the input data
+    """
+    stem = os.path.basename(os.path.normpath(input_path)).split('.')[0]
+    return os.path.join(os.path.dirname(os.path.normpath(input_path)), '{}_{}_report.json'.format(stem, name))
+
+
+@contextlib.contextmanager
+def run(report_path='', profile_path=''):
+    """
+    Instruments a whole run: writes the report of its stages, and a cProfile dump if requested, even if the run fails.
+    :param report_path: JSON report path. No report if ''
+    :param profile_path: cProfile output path, to read with pstats or snakeviz. No profiling if ''
+    """
+    reset()
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            logging.info('Saved profile as {}'.format(profile_path))
+        if report_path:
+            save_report(report_path)
+
+
+# a report without run() covers the time since the import
+reset()
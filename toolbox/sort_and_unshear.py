@@ -0,0 +1,220 @@
+"""
+Sorts a periodic movie into one period and corrects its scanning aberration in a single run, reading the input data
+once and without writing then reloading the sorted data.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+Same steps as sorting/periodic_sorting.py followed by unshearing/shear_correction.py. The sorted frames are written once
+into a memmap read by the shift estimation and the reconstruction, which writes the result straight into the output
+NPY file. The sorted memmap is the '_sorted.npy' file itself if it is kept as a checkpoint, a temporary file otherwise.
+"""
+
+import numpy as np
+import sys
+import shutil
+from os.path import join, basename, dirname, exists, abspath
+import argparse
+import logging
+from tempfile import mkdtemp
+
+from sorting import write_tsp
+from unshearing import opt_shift
+from toolbox import om_toolbox, profiling
+from toolbox.cache import Cache
+
+
+def parsing():
+    """
+    Bash commands
+    :return:
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input_file_path", type=str,
+                        help="Input data path. Expected 5D data XYZCT.")
+    parser.add_argument("-o", "--output_file_path", type=str, default='', help="Output file path.")
+    parser.add_argument("--concorde", type=str, help="concorde executable path")
+    parser.add_argument("-y", "--ydownsizing", type=int, default="4", help="Downsizing factor for dimension Y.")
+    parser.add_argument("-x", "--xdownsizing", type=int, default="4", help="Downsizing factor for dimension X.")
+    parser.add_argument("--tsp_file", type=str, default='',
+                        help="Applies the solution from tsp_file to the input file. must have the same number of time "
+                             "points. Default=''")
+    parser.add_argument("--input_shift_file", type=str, default='', help="Previous shift file.")
+    parser.add_argument("--save_sorted", action='store_true',
+                        help="Keeps the sorted data as a checkpoint, next to the input.")
+    parser.add_argument("--solver", type=str, default='concorde',
+                        help="TSP solver: concorde (optimal), heuristic (in-process, for long movies) or sparse "
+                             "(heuristic on the nearest neighbours graph, for very long movies). Default=concorde")
+    parser.add_argument("--n_neighbours", type=int, default=10,
+                        help="Nearest neighbours per frame used by the heuristic solvers. Default=10")
+    parser.add_argument("--time_limit", type=float, default=30.,
+                        help="Time limit in seconds of the heuristic solvers. Default=30")
+    parser.add_argument("--no_cache", action='store_true',
+                        help="Sorts without reading or writing the cache of intermediate results.")
+    parser.add_argument("--per_slice", action='store_true',
+                        help="Estimates one shift per slice and channel instead of one shift for the whole stack.")
+    parser.add_argument("--levels", type=int, default=1,
+                        help="Number of coarse-to-fine levels for the shift estimation. Default=1")
+    parser.add_argument("--method", type=str, default='Nelder-Mead',
+                        help="Minimization method of the shift estimation: a scipy.optimize.minimize method "
+                             "(BFGS, L-BFGS-B... use the derivative of the objective) or bracketed-newton. "
+                             "Default=Nelder-Mead")
+    parser.add_argument("--sample_stride", type=int, default=1,
+                        help="Starts the shift estimation on one column in sample_stride, the sample growing as the "
+                             "estimate converges, until its standard error is small. Default=1 (all the columns)")
+    parser.add_argument("--precision", type=str, default='float32',
+                        help="Floating point type of the computations, float32 or float64. Default=float32")
+    parser.add_argument("--output_dtype", type=str, default='',
+                        help="Data type of the output file, e.g. float64, or input to keep the one of the input "
+                             "(rounded for integer types). Default=the precision")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of threads computing the distances and of processes reconstructing. Default=1")
+    parser.add_argument("--layout", type=str, default='',
+                        help="Storage layout of the input NPY file: xyzct, or tzcyx (time-major, every frame "
+                             "contiguous). Default=the layout recorded next to the file by the scripts, "
+                             "xyzct if none")
+    parser.add_argument("--output_layout", type=str, default='',
+                        help="Storage layout of the output NPY file, xyzct or tzcyx. Default=the input layout")
+    parser.add_argument("--chunk_size", type=int, default=256,
+                        help="Size in MB of the blocks of data read at once. Default=256")
+    parser.add_argument("--report", type=str, default='',
+                        help="JSON report of the run (time, memory, input/output of every stage). "
+                             "Default=<input>_sort_and_unshear_report.json next to the input")
+    parser.add_argument("--profile", type=str, default='',
+                        help="Saves a cProfile dump of the run at this path. Default=''")
+    parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
+                                                                          "package. Can be INFO, WARNING, ERROR.")
+    return parser.parse_args()
+
+
+def main(input_file_path, concorde_path, output_file_path='', x_down_sizing_factor=4, y_down_sizing_factor=4,
+         tsp_file='', input_shift_file='', save_sorted=False, solver='concorde', time_limit=30., n_neighbours=10,
+         no_cache=False, per_slice=False, levels=1, sample_stride=1, method='Nelder-Mead', precision='float32',
+         output_dtype='', workers=1, chunk_size=256, layout='', output_layout='', logging_level='INFO'):
+    """
+
+    :param input_file_path: Input data path
+    :param concorde_path: Concorde path
+    :param output_file_path: Output data path. Default in input file folder
+    :param x_down_sizing_factor: Downsizing factor for the columns. Default=4
+    :param y_down_sizing_factor: Downsizing factor for the lines. Default=4
+    :param tsp_file: If file not empty, applies this solution to the input file. Default=''
+    :param input_shift_file: Shift text file, if the shift was previously calculated (applies previous result)
+    :param save_sorted: If True, the sorted data is kept next to the input as '_sorted.npy'. Default=False
+    :param solver: TSP solver, 'concorde', 'heuristic' or 'sparse'. Default='concorde'
+    :param time_limit: Time limit in seconds of the heuristic solvers. Default=30
+    :param n_neighbours: Nearest neighbours per frame used by the heuristic solvers. Default=10
+    :param no_cache: If True, the cache of intermediate results is not used. Default=False
+    :param per_slice: If True, estimates one shift per slice and channel. Default=False
+    :param levels: Number of coarse-to-fine pyramid levels for the shift estimation. Default=1
+    :param sample_stride: Above 1, the shift estimation starts on one column in sample_stride. Default=1
+    :param method: Shift estimation minimization method, see opt_shift.Shift.estimate_shift. Default='Nelder-Mead'
+    :param precision: Floating point type of the computations, 'float32' or 'float64'. Default='float32'
+    :param output_dtype: Data type of the output, 'input' for the input data type. Default='' (the precision)
+    :param workers: Number of threads computing the distances and of processes reconstructing. Default=1
+    :param chunk_size: Size in MB of the blocks of data read at once. Default=256
+    :param layout: Storage layout of the input NPY file, 'xyzct' or time-major 'tzcyx'. Default='' (the layout
+    recorded next to the file, 'xyzct' if none)
+    :param output_layout: Storage layout of the output NPY file. Default='' (the input layout). The sorted data is
+    always XYZCT, the layout read line by line by the reconstruction
+    :param logging_level: level of info printed to log file. Can be INFO, WARNING, or ERROR. Log file in input
+    directory.
+    :return:
+    """
+
+    dir_data = dirname(input_file_path)
+    filename = basename(input_file_path)
+    stem = filename.split('.')[0]
+    logging.basicConfig(filename=join(dir_data, 'sort_and_unshear.log'), level=logging_level)
+    if output_file_path == '':
+        output_file_path = join(dir_data, stem + '_sorted_unsheared.npy')
+    if abspath(output_file_path) == abspath(input_file_path):
+        logging.error('The output file path is the input file path {}. Exiting script.'.format(input_file_path))
+        sys.exit(-1)
+
+    tmp_data = mkdtemp()
+    try:
+        layout = om_toolbox.resolve_layout(input_file_path, layout)
+        # memory-mapped: the data is only read block by block
+        im_mapped = om_toolbox.load_data(input_file_path, memmap_path=join(tmp_data, 'tmp.npy'), mmap_mode='r',
+                                         layout=layout)
+        if im_mapped.ndim != 5:
+            logging.error('Expecting array with 5 dimensions. Here the array has {} dimensions ({}). Exiting script.'
+                          .format(im_mapped.ndim, im_mapped.size))
+            sys.exit(-1)
+
+        cache = None
+        if not no_cache:
+            cache = Cache(join(dir_data, 'sorting_cache'))
+
+        logging.info('TSP solver starting...')
+        sorted_path = join(dir_data, stem + '_sorted.npy') if save_sorted else join(tmp_data, 'sorted.npy')
+        im_sorted = om_toolbox.allocate(im_mapped.shape, im_mapped.dtype, sorted_path)
+        write_tsp.run_tsp(im_mapped, concorde_path=concorde_path, tsp_path=join(dir_data, stem + '_tsp_file'),
+                          y_downsizing_factor=y_down_sizing_factor, x_downsizing_factor=x_down_sizing_factor,
+                          tsp_files_exist=tsp_file, output_im=im_sorted, chunk_size=chunk_size * 1024 ** 2,
+                          workers=workers, solver=solver, time_limit=time_limit, n_neighbours=n_neighbours, cache=cache,
+                          work_dir=tmp_data)
+        # the reconstruction processes reopen the file
+        im_sorted.flush()
+        del im_mapped
+        if save_sorted:
+            logging.info('Saved sorted data as {}'.format(sorted_path))
+
+        shift = None
+        if exists(input_shift_file):
+            shift = np.loadtxt(input_shift_file)
+
+        logging.info('Scanning aberration correction...')
+        shift_calc = opt_shift.Shift(y_down_sizing_factor, x_down_sizing_factor, im_sorted=im_sorted, shift=shift,
+                                     chunk_size=chunk_size * 1024 ** 2, precision=precision)
+
+        dtype = im_sorted.dtype if output_dtype == 'input' else np.dtype(output_dtype or precision)
+        reconstructed_data = om_toolbox.allocate(im_sorted.shape, dtype, output_file_path,
+                                                 layout=output_layout or layout)
+        reconstructed_data, pixel_shift = shift_calc.aberration_correction(step_init=np.array([5.3]), method=method,
+                                                                           output_im=reconstructed_data,
+                                                                           workers=workers, per_slice=per_slice,
+                                                                           levels=levels,
+                                                                           sample_stride=sample_stride)
+        reconstructed_data.flush()
+        logging.info('Saved data as {}'.format(output_file_path))
+        np.savetxt(output_file_path[:output_file_path.rfind(".")] + '_shift.txt',
+                   np.reshape(pixel_shift, (-1, im_sorted.shape[3])) if np.size(pixel_shift) > 1
+                   else np.ravel(pixel_shift))
+
+        del shift_calc, im_sorted, reconstructed_data
+    finally:
+        shutil.rmtree(tmp_data, ignore_errors=True)
+
+    logging.info('Done.')
+
+
+if __name__ == "__main__":
+
+    parse = parsing()
+    with profiling.run(parse.report or profiling.default_report_path(parse.input_file_path, 'sort_and_unshear'),
+                       parse.profile):
+        main(parse.input_file_path, parse.concorde, output_file_path=parse.output_file_path,
+             x_down_sizing_factor=parse.xdownsizing, y_down_sizing_factor=parse.ydownsizing, tsp_file=parse.tsp_file,
+             input_shift_file=parse.input_shift_file, save_sorted=parse.save_sorted, solver=parse.solver,
+             time_limit=parse.time_limit, n_neighbours=parse.n_neighbours, no_cache=parse.no_cache,
+             per_slice=parse.per_slice, levels=parse.levels, sample_stride=parse.sample_stride, method=parse.method,
+             precision=parse.precision, output_dtype=parse.output_dtype, workers=parse.workers,
+             chunk_size=parse.chunk_size, layout=parse.layout, output_layout=parse.output_layout,
+             logging_level=parse.logging_level)
@@ -0,0 +1,92 @@
+"""
+Synthetic periodic movies of a beating heart with a known frame order and scanning shear, as ground truth for the
+benchmarks.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+The heart is a ring whose radius and wall thickness follow the cardiac cycle, over a fixed textured background. Each
+slice cuts the heart at a different radius and each channel weights the wall and the background differently. A line
+scanning microscope acquires the row y of a frame shear * y time points after its first row: the frames hold one
+period sampled at nt phases, row y of frame t showing the phase (t + shear * y) / nt. The frames are then shuffled,
+as in an ungated acquisition.
+"""
+
+import numpy as np
+
+
+def heart_phantom(shape, phases, seed=0):
+    """
+    :param shape: XYZCT shape (ny, nx, nz, nc, nt)
+    :param phases: Cardiac phase in periods of every row and frame, broadcastable to (ny, 1, 1, 1, nt)
+    :param seed: Seed of the background texture
+    :return: float64 data of the given shape, intensities in [0, 1]
+    """
+    ny, nx, nz, nc = shape[:4]
+    random_state = np.random.RandomState(seed)
+    y = (np.arange(ny) - ny / 2.).reshape((ny, 1, 1, 1, 1)) / max(ny, nx)
+    x = (np.arange(nx) - nx / 2.).reshape((1, nx, 1, 1, 1)) / max(ny, nx)
+    z = np.linspace(-0.5, 0.5, nz).reshape((1, 1, nz, 1, 1)) if nz > 1 else np.zeros((1, 1, 1, 1, 1))
+    c = np.arange(nc).reshape((1, 1, 1, nc, 1))
+
+    # smooth background texture, fixed over time
+    texture = random_state.rand(ny // 8 + 2, nx // 8 + 2)
+    rows = np.minimum(np.arange(ny) // 8, texture.shape[0] - 1)
+    columns = np.minimum(np.arange(nx) // 8, texture.shape[1] - 1)
+    background = 0.2 * texture[np.ix_(rows, columns)].reshape((ny, nx, 1, 1, 1))
+
+    phases = 2. * np.pi * np.asarray(phases)
+    # contraction with a second harmonic, so that the cycle is not symmetric in time
+    contraction = 0.25 * np.sin(phases) + 0.08 * np.sin(2. * phases + 1.)
+    radius = 0.3 * np.sqrt(1. - z ** 2) * (1. - contraction)
+    thickness = 0.05 * (1. + contraction)
+    distance = np.sqrt(y ** 2 + (x * (1. + 0.2 * z)) ** 2)
+    wall = np.exp(-((distance - radius) / thickness) ** 2)
+
+    weight = 1. / (1. + c)
+    return (weight * 0.8 * wall + (1. - weight) * 0.8 * background + weight * background) / 1.2
+
+
+def synthetic_movie(shape, shear=0.5, noise=0.02, seed=0, dtype=np.uint16):
+    """
+    :param shape: XYZCT shape (ny, nx, nz, nc, nt)
+    :param shear: Time points between the acquisitions of two consecutive rows
+    :param noise: Standard deviation of the additive noise, relative to the intensity range
+    :param seed: Seed of the shuffling, noise and texture
+    :param dtype: Integer or float output data type
+    :return: Shuffled sheared movie, and permutation such that movie[..., i] is the sorted frame permutation[i]
+    """
+    ny, nt = shape[0], shape[-1]
+    random_state = np.random.RandomState(seed)
+    phases = (np.arange(nt).reshape((1, 1, 1, 1, nt)) + shear * np.arange(ny).reshape((ny, 1, 1, 1, 1))) / nt
+    movie = heart_phantom(shape, phases, seed=seed)
+    movie += noise * random_state.randn(*shape)
+
+    if np.issubdtype(dtype, np.integer):
+        movie = np.clip(np.rint(movie * 0.9 * np.iinfo(dtype).max), 0, np.iinfo(dtype).max)
+    permutation = random_state.permutation(nt)
+    return movie[..., permutation].astype(dtype), permutation
+
+
+def ground_truth(shape, seed=0):
+    """
+    :param shape: XYZCT shape (ny, nx, nz, nc, nt)
+    :param seed: Seed given to synthetic_movie
+    :return: Noiseless sorted period without shear, all rows at the phase of the first one, intensities in [0, 1]
+    """
+    nt = shape[-1]
+    return heart_phantom(shape, np.arange(nt).reshape((1, 1, 1, 1, nt)) / nt, seed=seed)
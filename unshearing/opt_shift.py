@@ -34,122 +34,369 @@ O. Mariani, A. Ernst, N. Mercader and M. Liebling, "Reconstruction of Image Sequ
 """
 
 import numpy as np
-from scipy.optimize import minimize
-import scipy.interpolate as interpolate
+from scipy.optimize import minimize, OptimizeResult
 import logging
+from multiprocessing import Pool
 
-from toolbox import om_toolbox
+from toolbox import om_toolbox, profiling
+from unshearing import spline_resampling
+
+# scipy.optimize.minimize methods using the derivative of the objective
+GRADIENT_METHODS = ('CG', 'BFGS', 'L-BFGS-B', 'TNC', 'SLSQP', 'Newton-CG')
 
 
 class Shift:
 
-    def __init__(self, y_downsizing_factor, x_downsizing_factor, im_sorted, shift=None):
+    def __init__(self, y_downsizing_factor, x_downsizing_factor, im_sorted, shift=None,
+                 chunk_size=om_toolbox.CHUNK_SIZE, precision=np.float32):
         """
 
         :param y_downsizing_factor: Downsizing factor for the lines
         :param x_downsizing_factor: Downsizing factor for the columns
-        :param im_sorted: Previously sorted image
+        :param im_sorted: Previously sorted image, of any data type. It is never converted as a whole
         :param shift: If not None, will apply the given shift to im_sorted
+        :param chunk_size: Size in bytes of the blocks of im_sorted processed at once
+        :param precision: Floating point type of the computations, np.float32 or np.float64. Default=np.float32
         """
 
-        im_in = np.concatenate((im_sorted, im_sorted[..., 0, np.newaxis]), axis=-1)
-
         self.downsampling_factor_y = y_downsizing_factor
         self.downsampling_factor_x = x_downsizing_factor
         self.shift = shift
-        self.image_out = im_in
+        self.chunk_size = chunk_size
+        self.precision = np.dtype(precision)
+        # buffers of min_resampling, allocated at the first evaluation of each shape and reused afterwards
+        self.buffers = {}
+        # standard error of the last estimated step due to the column sampling (see minimize_sampled)
+        self.step_error = 0.
+        # kept as given (e.g. memmap), the period is closed block by block during the reconstruction
+        self.image_out = im_sorted
 
         if shift is None:
-            im_downsampled = om_toolbox.average_downsizing(im_in, y_downsizing_factor, x_downsizing_factor)
+            im_downsampled = om_toolbox.average_downsizing(im_sorted, y_downsizing_factor, x_downsizing_factor,
+                                                           chunk_size=chunk_size, dtype=self.precision)
+            # time last in memory, whatever the layout of im_sorted: the splines are computed along time
+            im_downsampled = np.ascontiguousarray(np.concatenate((im_downsampled, im_downsampled[..., 0, np.newaxis]),
+                                                                 axis=-1))
             self.image = im_downsampled
-
-    def min_resampling(self, step):
+            # the downsampled data never changes between objective evaluations: its periodic spline representation is
+            # computed (and padded) once and only evaluated at the new shifts in min_resampling
+            with profiling.stage('spline_coefficients'):
+                self.coefficients = spline_resampling.pad_coefficients(
+                    spline_resampling.spline_coefficients(im_downsampled))
+            # coarse-to-fine levels, from self.image to the coarsest level
+            self.pyramid = [self.coefficients]
+
+    def build_pyramid(self, levels):
+        """
+        Adds coarser levels to the pyramid, each one averaging pairs of columns of the previous one. The lines are kept,
+        so that the step has the same meaning at every level: averaging lines would also average their time offsets.
+        :param levels: Total number of levels, including self.image
+        :return: No return
+        """
+        image = self.image
+        for level in range(1, levels):
+            nx = image.shape[1]
+            if nx % 2 or nx < 16:
+                logging.warning('Cannot halve {} columns, pyramid limited to {} levels.'.format(nx, level))
+                break
+            image = om_toolbox.average_downsizing(image, 1, 2, dtype=None)
+            if level >= len(self.pyramid):
+                self.pyramid.append(spline_resampling.pad_coefficients(spline_resampling.spline_coefficients(image)))
+
+    @profiling.counted('min_resampling')
+    def min_resampling(self, step, z=None, c=None, level=0, derivative=False, columns=None, per_column=False):
         """
         Function to minimize
         :param step: shift size
-        :return: Line-to-line difference
+        :param z: If not None, only evaluates the slice z (with channel c)
+        :param c: If not None, only evaluates the channel c (with slice z)
+        :param level: Pyramid level to evaluate, 0 being self.image
+        :param derivative: If True, also returns the derivative with respect to step
+        :param columns: If not None, slice of the columns evaluated, e.g. slice(offset, None, stride) (a view of the
+        coefficients, not a copy). The objective is a sum over the columns: a random subset of them gives an unbiased
+        estimate of it, up to a constant factor
+        :param per_column: If True, returns the line-to-line difference of every evaluated column instead of their sum.
+        Not with derivative
+        :return: Line-to-line difference, and its derivative as a 1 element array if derivative is True
         """
-        im = self.image.astype(np.float)
+        coefficients = self.pyramid[level]
+        if z is not None and c is not None:
+            coefficients = coefficients[:, :, z:z + 1, c:c + 1, :]
+        if columns is not None:
+            coefficients = coefficients[:, columns]
 
-        ny, nx, nz, nc, nt = im.shape
+        ny = coefficients.shape[0]
+        shape = coefficients.shape[:-1] + (coefficients.shape[-1] - 2,)
+        out, work = self.buffer('out', shape), self.buffer('work', shape)
+        diff = self.buffer('diff', (ny - 1,) + shape[1:])
 
         step = step[0]
-        nts = np.arange(0, nt)
+        sign = 1.
         if step < 0:
             step = -step
-            im = im[::-1]
-            nts = len(nts) - nts[::-1] - 1
-
-        out = np.zeros(im.shape, dtype=np.float)
-
-        nt_range = np.arange(0, nt)
-
-        for y in range(ny):
-            int_interp = int((step*y)//1)
-            residue = (step*y) - int_interp
-            interpolation_ordonn = nt_range + residue
-            interpolation_ordonn[-1] = nt_range[-1]
-            for x in range(nx):
-                tck = interpolate.splrep(nts, im[y, x, 0, 0, :], per=True, k=3)
-                out[y, x, 0, 0, :] = interpolate.splev(interpolation_ordonn, tck)
-            out[y, ...] = np.roll(out[y, ...], int_interp, axis=-1)
-
-        mean_out_y = np.sum(np.fabs(np.diff(out, axis=0)))
-
-        return mean_out_y
+            sign = -1.
+            coefficients = coefficients[::-1]
+
+        # one shift per row, broadcast over the X, Z, C axes: all slices and channels share the shift
+        rows = np.arange(ny).reshape((ny, 1, 1, 1, 1))
+        residue, int_interp = spline_resampling.split_shifts(step * rows)
+        if not derivative:
+            spline_resampling.spline_resampling(coefficients, residue, int_interp, padded=True, out=out, work=work)
+            np.subtract(out[1:], out[:-1], out=diff)
+            if per_column:
+                return np.sum(np.fabs(diff, out=diff), axis=(0, 2, 3, 4), dtype=np.float64)
+            return np.sum(np.fabs(diff, out=diff), dtype=np.float64)
+
+        out_derivative = self.buffer('derivative', shape)
+        spline_resampling.spline_resampling(coefficients, residue, int_interp, derivative=True, padded=True, out=out,
+                                            work=work, derivative_out=out_derivative)
+        np.subtract(out[1:], out[:-1], out=diff)
+        signs = np.sign(diff, out=self.buffer('signs', diff.shape))
+        mean_out_y = np.sum(np.fabs(diff, out=diff), dtype=np.float64)
+        # the residue of row y decreases by y when the step increases by 1, the integer shifts are piecewise constant
+        out_derivative *= -rows
+        np.subtract(out_derivative[1:], out_derivative[:-1], out=diff)
+        gradient = sign * np.sum(np.multiply(signs, diff, out=diff), dtype=np.float64)
+
+        return mean_out_y, np.array([gradient])
+
+    def buffer(self, name, shape):
+        """
+        :param name: Buffer name
+        :param shape: Buffer shape
+        :return: Array of the given shape in the computation precision, the same one at every call with these arguments
+        """
+        key = (name, shape)
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape, dtype=self.precision)
+        return self.buffers[key]
+
+    @profiling.profiled('estimate_shift')
+    def estimate_shift(self, step_init=np.array([5.3]), method='Nelder-Mead', levels=1, z=None, c=None,
+                       sample_stride=1):
+        """
+        Minimizes min_resampling. With more than one level, the step is first searched on a grid at the coarsest pyramid
+        level, then refined level by level, each minimization starting from the previous level result. The standard
+        error of the estimate due to the column sampling is kept as self.step_error.
+        :param step_init: Initial step for minimization function
+        :param method: Which minimization method to use: a scipy.optimize.minimize method, the ones of
+        GRADIENT_METHODS using the derivative of the objective, or 'bracketed-newton' (see bracketed_newton). The sum
+        of absolute differences varies locally around its overall trend, so that the methods following the derivative
+        only (BFGS...) need an initial step close to the minimum, such as the one of a coarser pyramid level
+        :param levels: Number of pyramid levels
+        :param z: If not None, only estimates the shift of the slice z (with channel c)
+        :param c: If not None, only estimates the shift of the channel c (with slice z)
+        :param sample_stride: Above 1, the finest level is minimized on a sample of one column in sample_stride
+        first, the sample growing as the estimate converges (see minimize_sampled)
+        :return: Estimated step
+        """
+        self.step_error = 0.
+        if levels <= 1:
+            if sample_stride > 1:
+                return self.minimize_sampled(step_init, method, z, c, stride=sample_stride)
+            return self.minimize(step_init, method, z, c)
+
+        self.build_pyramid(levels)
+        top = len(self.pyramid) - 1
+
+        # the grid spans twice the initial step on both sides, so that a bad initial guess can be recovered from
+        scale = max(np.fabs(np.ravel(step_init)[0]), 1.)
+        grid = np.arange(-2. * scale, 2. * scale + 0.5, 0.5)
+        costs = [self.min_resampling(np.array([step]), z, c, top) for step in grid]
+        step = np.array([grid[np.argmin(costs)]])
+
+        for level in range(top, -1, -1):
+            options = None
+            if method == 'Nelder-Mead':
+                # a small simplex around the previous level estimate
+                options = {'initial_simplex': np.array([step, step + 0.1]), 'xatol': 1e-3, 'fatol': np.inf}
+            if level == 0 and sample_stride > 1:
+                step = self.minimize_sampled(step, method, z, c, stride=sample_stride, options=options,
+                                             initial_step=0.1)
+            else:
+                step = self.minimize(step, method, z, c, level, options=options, initial_step=0.1)
+            logging.info('Pyramid level {}: step {}'.format(level, step[0]))
+
+        return step
+
+    def minimize(self, step_init, method, z=None, c=None, level=0, options=None, initial_step=0.5, columns=None):
+        """
+        Minimizes min_resampling at one pyramid level.
+        :param step_init: Initial step
+        :param method: scipy.optimize.minimize method or 'bracketed-newton'
+        :param z: If not None, only evaluates the slice z (with channel c)
+        :param c: If not None, only evaluates the channel c (with slice z)
+        :param level: Pyramid level
+        :param options: Options of scipy.optimize.minimize
+        :param initial_step: 'bracketed-newton' only. First step along the descent direction
+        :param columns: If not None, slice of the columns evaluated (see min_resampling)
+        :return: Estimated step, as a 1 element array
+        """
+        if method == 'bracketed-newton':
+            res = bracketed_newton(lambda step: self.min_resampling(step, z, c, level, True, columns), step_init,
+                                   initial_step=initial_step)
+        elif method in GRADIENT_METHODS:
+            res = minimize(self.min_resampling, step_init, args=(z, c, level, True, columns), method=method, jac=True,
+                           options=options)
+        else:
+            res = minimize(self.min_resampling, step_init, args=(z, c, level, False, columns), method=method,
+                           options=options)
+        logging.info('{}: step {} ({} evaluations)'.format(method, res.x[0], res.nfev))
+        return res.x
 
-    def reconstruction(self, step):
+    def minimize_sampled(self, step_init, method, z=None, c=None, stride=8, tolerance=0.05, options=None,
+                         initial_step=0.5, seed=0):
+        """
+        Minimizes min_resampling at the finest level on a growing sample of columns: one column in stride, from a
+        random first column, then the stride is halved (the sample keeps its columns and gains as many) after each
+        minimization, which starts from the previous estimate, until the standard error of the estimate due to the
+        sampling (see sampling_error) is below tolerance or all the columns are used. The first minimizations run on
+        few columns while the estimate is far from the minimum, the larger samples only refine it. The objective of a
+        small sample varies more locally than the full one: the methods following the derivative only (GRADIENT_METHODS)
+        need an initial step close to the minimum, such as the one of a coarser pyramid level.
+        :param step_init: Initial step
+        :param method: scipy.optimize.minimize method or 'bracketed-newton'
+        :param z: If not None, only evaluates the slice z (with channel c)
+        :param c: If not None, only evaluates the channel c (with slice z)
+        :param stride: Initial sampling stride of the columns, rounded down to a power of 2
+        :param tolerance: Standard error of the step below which the sample stops growing
+        :param options: Options of scipy.optimize.minimize for the first minimization
+        :param initial_step: 'bracketed-newton' only. First step along the descent direction of the first minimization
+        :param seed: Seed of the first sampled column
+        :return: Estimated step, as a 1 element array. Its standard error is kept as self.step_error
+        """
+        stride = 2 ** int(np.log2(min(stride, self.image.shape[1])))
+        offset = np.random.RandomState(seed).randint(stride)
+        step = np.asarray(step_init, dtype=np.float64)
+        while True:
+            columns = slice(offset % stride, None, stride)
+            step = self.minimize(step, method, z, c, options=options, initial_step=initial_step, columns=columns)
+            if stride == 1:
+                self.step_error = 0.
+                return step
+            self.step_error = self.sampling_error(step, z, c, columns)
+            logging.info('One column in {}: step {} +/- {}'.format(stride, step[0], self.step_error))
+            if self.step_error < tolerance:
+                return step
+            stride //= 2
+            # a small simplex or first step around the previous estimate
+            if method == 'Nelder-Mead':
+                options = {'initial_simplex': np.array([step, step + 0.1]), 'xatol': 1e-3, 'fatol': np.inf}
+            initial_step = 0.1
+
+    def sampling_error(self, step, z=None, c=None, columns=None, width=0.5, points=5):
+        """
+        Standard error of the step minimizing the objective on a random sample of columns, relative to the step
+        minimizing it on all the columns. The objective derivative at the estimate is a sum of independent column
+        terms, whose variance is estimated from the sample with the finite population correction, and is divided by
+        the curvature of the objective. Both come from parabolas fitted to the objective of every column around the
+        step, over a width larger than the local variations of the sum of absolute differences.
+        :param step: Estimated step
+        :param z: If not None, only evaluates the slice z (with channel c)
+        :param c: If not None, only evaluates the channel c (with slice z)
+        :param columns: Slice of the sampled columns, None for all the columns
+        :param width: Largest step difference of the evaluations, on both sides of the step
+        :param points: Number of evaluations
+        :return: Standard error, 0 for all the columns and inf if the objective is not convex at the estimate
+        """
+        offsets = np.linspace(-width, width, points)
+        values = np.array([self.min_resampling(step + offset, z, c, columns=columns, per_column=True)
+                           for offset in offsets])
+        n_columns, n_total = values.shape[1], self.image.shape[1]
+        if n_columns >= n_total:
+            return 0.
+        # one parabola a * offset ** 2 + b * offset + constant per column
+        a, b, _ = np.polyfit(offsets, values, 2)
+        curvature = 2. * np.sum(a)
+        if n_columns < 2 or curvature <= 0:
+            return np.inf
+        return float(np.std(b, ddof=1) * np.sqrt(n_columns * (1. - n_columns / n_total)) / curvature)
+
+    @profiling.profiled('reconstruction')
+    def reconstruction(self, step, output_im=None, workers=1, rows_per_block=None):
         """
         Data resampling to correct for scanning aberration.
-        :param step: Reconstructs the input image with a step size of step in pixels
-        :return:
+        :param step: Reconstructs the input image with a step size of step in pixels. Either one value, or one value per
+        slice and channel (array of shape (nz, nc))
+        :param output_im: Array receiving the reconstruction, same shape as the input image, of any data type (rounded
+        and clipped for integer types). Allocated in the computation precision if None
+        :param workers: Number of processes resampling blocks of rows. Above 1, the input image and output_im must be
+        memmaps
+        :param rows_per_block: Number of rows resampled at once. If None, as many as fit in self.chunk_size
+        :return: Reconstructed data
         """
 
-        im = self.image_out.astype(np.float)
-        ny, nx, nz, nc, nt = im.shape
-        nt_range = np.arange(0, nt)
+        im = self.image_out
+        ny = im.shape[0]
 
-        if step < 0:
-            step = -step
-            im = im[..., ::-1]
+        if rows_per_block is None:
+            # about 8 copies of a block in the computation precision are alive during the resampling
+            rows_per_block = max(1, int(self.chunk_size // (np.prod(im.shape[1:]) * self.precision.itemsize * 8)))
+
+        if output_im is None:
+            output_im = np.zeros(im.shape, dtype=self.precision)
 
-        out = np.zeros(im.shape, dtype=np.float)
+        blocks = [(row_start, min(row_start + rows_per_block, ny)) for row_start in range(0, ny, rows_per_block)]
 
-        for y in range(ny):
-            logging.info('Row {} / {}'.format(y + 1, ny))
-            int_interp = int((step * y)//1)
-            residue = (step * y) - int_interp
-            interpolation_ordonn = nt_range + residue
-            interpolation_ordonn[-1] = nt_range[-1]
-            for x in range(nx):
-                tck = interpolate.splrep(nt_range, im[y, x, 0, 0, :], per=True, k=3)
-                out[y, x, ...] = interpolate.splev(interpolation_ordonn, tck)
-            out[y, ...] = np.roll(out[y, ...], int_interp, axis=-1)
+        if workers > 1 and not (_is_file_memmap(im) and _is_file_memmap(output_im)):
+            logging.warning('Parallel reconstruction needs the input and output data as memmaps. Using 1 worker.')
+            workers = 1
+
+        if workers > 1:
+            input_description = _memmap_description(im)
+            output_description = _memmap_description(output_im)
+            tasks = [(input_description, output_description, step, row_start, row_stop, self.precision)
+                     for row_start, row_stop in blocks]
+            with Pool(workers) as pool:
+                for row_start, row_stop in pool.imap_unordered(_reconstruct_rows_worker, tasks):
+                    logging.info('Rows {}-{} / {}'.format(row_start + 1, row_stop, ny))
+        else:
+            for row_start, row_stop in blocks:
+                logging.info('Rows {}-{} / {}'.format(row_start + 1, row_stop, ny))
+                reconstruct_rows(im, output_im, step, row_start, row_stop, precision=self.precision)
 
-        return out
+        return output_im
 
-    def aberration_correction(self, step_init=np.array([5.3]), method='Nelder-Mead'):
+    def aberration_correction(self, step_init=np.array([5.3]), method='Nelder-Mead', output_im=None, workers=1,
+                              per_slice=False, levels=1, sample_stride=1):
         """
 
         :param step_init: Initial step for minimization function
         :param method: Which minimization method to use
+        :param output_im: Array receiving the reconstruction. Allocated if None
+        :param workers: Number of processes used for the reconstruction
+        :param per_slice: If True, estimates one shift per slice and channel instead of one shift for the whole stack
+        :param levels: Number of coarse-to-fine pyramid levels used for the estimation
+        :param sample_stride: Above 1, the estimation starts on one column in sample_stride (see minimize_sampled)
         :return: reconstructed ndarray
         """
         if self.shift is None:
-            fct_interp = self.min_resampling
             logging.info('Starting period estimation...')
 
-            res = minimize(fct_interp, step_init, method=method)
+            if per_slice:
+                nz, nc = self.image.shape[2:4]
+                shift = np.zeros((nz, nc))
+                for z in range(nz):
+                    for c in range(nc):
+                        step = self.estimate_shift(step_init, method=method, levels=levels, z=z, c=c,
+                                                   sample_stride=sample_stride)
+                        shift[z, c] = step[0]/self.downsampling_factor_y
+                        logging.info('Slice {} channel {}: shift {} +/- {}'.format(
+                            z, c, shift[z, c], self.step_error / self.downsampling_factor_y))
+            else:
+                shift = self.estimate_shift(step_init, method=method, levels=levels,
+                                            sample_stride=sample_stride)/self.downsampling_factor_y
+                logging.info('Shift {} +/- {}'.format(shift[0], self.step_error / self.downsampling_factor_y))
             logging.info('Done.\nStarting reconstruction...')
-            rec = self.reconstruction(res.x[0]/self.downsampling_factor_y)
+            rec = self.reconstruction(shift, output_im=output_im, workers=workers)
             logging.info('Done.')
 
-            return rec[..., :-1], res.x/self.downsampling_factor_y
+            return rec, shift
         else:
             logging.info('Done.\nStarting reconstruction...')
-            rec = self.reconstruction(self.shift)
+            rec = self.reconstruction(self.shift, output_im=output_im, workers=workers)
             logging.info('Done.')
-            return rec[..., :-1], self.shift
+            return rec, self.shift
 
     def main(self, step_init=np.array([5.3]), method='Nelder-Mead'):
         """
@@ -160,4 +407,176 @@ class Shift:
         """
         self.aberration_correction(step_init=step_init, method=method)
 
-    # EOF
+
+def bracketed_newton(function, x_init, initial_step=0.5, xtol=1e-3, newton_width=0.05, max_evaluations=50):
+    """
+    Minimizes a function of one variable from its values and derivative. The minimum is first bracketed by steps of
+    growing length along the descent direction, until the value increases. The bracket is then shrunk around its best
+    point by parabolic steps through the values of the best point and of the bracket ends, or golden section steps,
+    down to newton_width, then by Newton steps on the derivative, the second derivative being estimated from the
+    derivatives at the best point and at the bracket end it points to (secant). The values keep the search from
+    following the local variations of the derivative of a rough objective, the derivative makes the last steps converge
+    quickly.
+    :param function: Function returning the value and the derivative (1 element array) at a 1 element array
+    :param x_init: Initial point, 1 element array
+    :param initial_step: Length of the first step of the bracketing
+    :param xtol: Length of the bracket at which the search stops
+    :param newton_width: Length of the bracket below which the steps use the derivative
+    :param max_evaluations: Maximal number of function evaluations
+    :return: scipy.optimize.OptimizeResult with the best point x, its value fun and the number of evaluations nfev
+    """
+    golden = (3. - np.sqrt(5.)) / 2.
+    evaluations = {}
+
+    def evaluate(x):
+        value, gradient = function(np.array([x]))
+        evaluations[x] = (value, float(np.ravel(gradient)[0]))
+        return value
+
+    # bracketing: f(x_b) <= f(x_a) and f(x_b) < f(x_c)
+    x_a = float(np.ravel(x_init)[0])
+    f_a = evaluate(x_a)
+    direction = -1. if evaluations[x_a][1] > 0 else 1.
+    x_b = x_a + direction * initial_step
+    f_b = evaluate(x_b)
+    if f_b > f_a:
+        x_a, f_a, x_b, f_b = x_b, f_b, x_a, f_a
+    x_c = x_b + (x_b - x_a) / golden / 2.
+    f_c = evaluate(x_c)
+    while f_c <= f_b and len(evaluations) < max_evaluations:
+        x_a, f_a, x_b, f_b = x_b, f_b, x_c, f_c
+        x_c = x_b + (x_b - x_a) / golden / 2.
+        f_c = evaluate(x_c)
+
+    low, high = sorted((x_a, x_c))
+    best = x_b
+    while high - low > xtol and len(evaluations) < max_evaluations:
+        f_low, f_best, f_high = evaluations[low][0], evaluations[best][0], evaluations[high][0]
+        g_best = evaluations[best][1]
+        if high - low > newton_width:
+            # vertex of the parabola through the three points, in the larger interval if it is not usable
+            end = low if best - low > high - best else high
+            numerator = (best - low) ** 2 * (f_best - f_high) - (best - high) ** 2 * (f_best - f_low)
+            denominator = (best - low) * (f_best - f_high) - (best - high) * (f_best - f_low)
+            x = best - numerator / denominator / 2. if denominator != 0 else end
+        else:
+            end = low if g_best > 0 else high
+            g_end = evaluations[end][1]
+            x = best - g_best * (end - best) / (g_end - g_best) if g_best * g_end < 0 else end
+            if not min(best, end) <= x <= max(best, end):
+                x = end
+        # keeps away from the best point and the bracket ends, so that the bracket shrinks
+        end = low if x < best else high
+        margin = 0.1 * abs(end - best)
+        if not min(best, end) + margin <= x <= max(best, end) - margin:
+            x = best + golden * (end - best)
+        if evaluate(x) < f_best:
+            if x < best:
+                high, best = best, x
+            else:
+                low, best = best, x
+        elif x < best:
+            low = x
+        else:
+            high = x
+
+    best = min(evaluations, key=lambda x: evaluations[x][0])
+    return OptimizeResult(x=np.array([best]), fun=evaluations[best][0], nfev=len(evaluations), success=True)
+
+
+def reconstruct_rows(input_im, output_im, step, row_start, row_stop, precision=np.float64):
+    """
+    Resamples the rows row_start to row_stop - 1 of a sorted period, with a shift of step * y time points for row y.
+    All slices and channels are resampled at once.
+    :param input_im: Sorted data, without the closing time point
+    :param output_im: Array receiving the resampled rows, same shape as input_im. Rounded and clipped to the range of
+    integer data types
+    :param step: Shift between two consecutive rows, in time points. One value, or one value per slice and channel
+    :param row_start: First row
+    :param row_stop: Last row (excluded)
+    :param precision: Floating point type of the computations. Default=np.float64
+    :return: No return
+    """
+    nz, nc, nt = input_im.shape[2:]
+    step = slice_steps(step, nz, nc)
+
+    block = np.array(input_im[row_start:row_stop], dtype=precision)
+
+    negative = step < 0
+    if np.any(negative):
+        # reversed closed period f0, f(nt-1), ..., f1, f0 without its closing time point
+        block[:, :, negative] = block[:, :, negative][..., -np.arange(nt) % nt]
+    step = np.abs(step)
+
+    coefficients = spline_resampling.spline_coefficients(block, closed=False)
+
+    shifts = np.arange(row_start, row_stop).reshape((-1, 1, 1, 1, 1)) * step[np.newaxis, np.newaxis, :, :, np.newaxis]
+    residue, int_interp = spline_resampling.split_shifts(shifts)
+    out = spline_resampling.spline_resampling(coefficients, residue, int_interp)
+
+    out = out[..., :-1]
+    if np.issubdtype(output_im.dtype, np.integer):
+        limits = np.iinfo(output_im.dtype)
+        out = np.clip(np.rint(out, out=out), limits.min, limits.max, out=out)
+    output_im[row_start:row_stop, ...] = out
+
+
+def slice_steps(step, nz, nc):
+    """
+    :param step: One shift, or one shift per slice and channel (any shape of size nz * nc)
+    :param nz: Number of slices
+    :param nc: Number of channels
+    :return: Array of shape (nz, nc) with the shift of each slice and channel
+    """
+    step = np.asarray(step, dtype=np.float64).reshape(-1)
+    if step.size == 1:
+        return np.full((nz, nc), step[0])
+    return step.reshape((nz, nc))
+
+
+def _is_file_memmap(array):
+    """
+    :param array: Any array
+    :return: True if array is a memmap that can be reopened from its file by another process
+    """
+    return isinstance(array, np.memmap) and array.filename is not None and (array.flags.c_contiguous or
+                                                                           om_toolbox.is_time_major(array))
+
+
+def _memmap_description(array):
+    """
+    :param array: File memmap, C-contiguous or the XYZCT view of a time-major memmap
+    :return: Arguments to reopen array in another process
+    """
+    return array.filename, array.dtype, array.shape, array.offset, not array.flags.c_contiguous
+
+
+def _open_memmap(description, mode):
+    """
+    :param description: Output of _memmap_description
+    :param mode: Memmap mode
+    :return: Array described
+    """
+    filename, dtype, shape, offset, time_major = description
+    if time_major:
+        shape = tuple(shape[axis] for axis in om_toolbox.TIME_MAJOR_AXES)
+    array = np.memmap(filename, dtype=dtype, mode=mode, shape=shape, offset=offset)
+    return array.transpose(om_toolbox.XYZCT_FROM_TIME_MAJOR) if time_major else array
+
+
+def _reconstruct_rows_worker(args):
+    """
+    Process pool task: reopens the input and output memmaps and resamples one block of rows in place.
+    :param args: Input memmap description, output memmap description, step, first row, last row (excluded), precision
+    :return: First row, last row (excluded)
+    """
+    input_description, output_description, step, row_start, row_stop, precision = args
+    input_im = _open_memmap(input_description, 'r')
+    output_im = _open_memmap(output_description, 'r+')
+
+    reconstruct_rows(input_im, output_im, step, row_start, row_stop, precision=precision)
+    output_im.flush()
+
+    return row_start, row_stop
+
+# EOF
@@ -33,13 +33,15 @@ O. Mariani, A. Ernst, N. Mercader and M. Liebling, "Reconstruction of Image Sequ
 """
 
 import numpy as np
-from os.path import join, basename, dirname, exists
+import sys
+import shutil
+from os.path import join, basename, dirname, exists, abspath
 import argparse
 import logging
 from tempfile import mkdtemp
 
 from unshearing import opt_shift
-from toolbox import om_toolbox
+from toolbox import om_toolbox, profiling
 
 
 def parsing():
@@ -56,13 +58,44 @@ def parsing():
     parser.add_argument("--apply", type=bool, default=False,
                         help="Applies a previous shift.")
     parser.add_argument("--input_shift_file", type=str, default='', help="Previous shift file.")
+    parser.add_argument("--per_slice", action='store_true',
+                        help="Estimates one shift per slice and channel instead of one shift for the whole stack.")
+    parser.add_argument("--levels", type=int, default=1,
+                        help="Number of coarse-to-fine levels for the shift estimation. Default=1")
+    parser.add_argument("--method", type=str, default='Nelder-Mead',
+                        help="Minimization method of the shift estimation: a scipy.optimize.minimize method "
+                             "(BFGS, L-BFGS-B... use the derivative of the objective) or bracketed-newton. "
+                             "Default=Nelder-Mead")
+    parser.add_argument("--sample_stride", type=int, default=1,
+                        help="Starts the shift estimation on one column in sample_stride, the sample growing as the "
+                             "estimate converges, until its standard error is small. Default=1 (all the columns)")
+    parser.add_argument("--precision", type=str, default='float32',
+                        help="Floating point type of the computations, float32 or float64. Default=float32")
+    parser.add_argument("--output_dtype", type=str, default='',
+                        help="Data type of the output file, e.g. float64, or input to keep the one of the input "
+                             "(rounded for integer types). Default=the precision")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used for the reconstruction.")
+    parser.add_argument("--layout", type=str, default='',
+                        help="Storage layout of the input NPY file: xyzct, or tzcyx (time-major, every frame "
+                             "contiguous). Default=the layout recorded next to the file by the scripts, "
+                             "xyzct if none")
+    parser.add_argument("--output_layout", type=str, default='',
+                        help="Storage layout of the output NPY file, xyzct or tzcyx. Default=the input layout")
+    parser.add_argument("--chunk_size", type=int, default=256,
+                        help="Size in MB of the blocks of data read at once. Default=256")
+    parser.add_argument("--report", type=str, default='',
+                        help="JSON report of the run (time, memory, input/output of every stage). "
+                             "Default=<input>_unshearing_report.json next to the input")
+    parser.add_argument("--profile", type=str, default='',
+                        help="Saves a cProfile dump of the run at this path. Default=''")
     parser.add_argument("--logging_level", type=str, default='INFO', help="logging level from the logging python "
                                                                           "package. Can be INFO, WARNING, ERROR.")
     return parser.parse_args()
 
 
 def main(input_file_path, output_file_path='', x_down_sizing_factor=4, y_down_sizing_factor=4, input_shift_file='',
-         logging_level='INFO'):
+         logging_level='INFO', workers=1, per_slice=False, levels=1, chunk_size=256, method='Nelder-Mead',
+         precision='float32', output_dtype='', layout='', output_layout='', sample_stride=1):
     """
 
     :param input_file_path: Input data file path
@@ -72,38 +105,65 @@ def main(input_file_path, output_file_path='', x_down_sizing_factor=4, y_down_si
     :param input_shift_file: Shift text file, if the shift was previously calculated (applies previous result)
     :param logging_level: level of info printed to log file. Can be INFO, WARNING, or ERROR. Log file in input
     directory.
+    :param workers: Number of processes resampling blocks of rows during the reconstruction. Default=1
+    :param per_slice: If True, estimates one shift per slice and channel. Default=False
+    :param levels: Number of coarse-to-fine pyramid levels for the shift estimation. Default=1
+    :param sample_stride: Above 1, the shift estimation starts on one column in sample_stride. Default=1
+    :param chunk_size: Size in MB of the blocks of data read at once. Default=256
+    :param method: Shift estimation minimization method, see opt_shift.Shift.estimate_shift. Default='Nelder-Mead'
+    :param precision: Floating point type of the computations, 'float32' or 'float64'. Default='float32'
+    :param output_dtype: Data type of the output, 'input' for the input data type. Default='' (the precision)
+    :param layout: Storage layout of the input NPY file, 'xyzct' or time-major 'tzcyx'. Default='' (the layout
+    recorded next to the file, 'xyzct' if none)
+    :param output_layout: Storage layout of the output NPY file. Default='' (the input layout)
     :return:
     """
 
     dir_data = dirname(input_file_path)
     filename = basename(input_file_path)
-    tmp_data = mkdtemp()
     logging.basicConfig(filename=join(dir_data, 'unshearing.log'), level=logging_level)
-    tsp = om_toolbox.load_data(input_file_path)
-
-    im_mapped = np.memmap(join(tmp_data, 'rec_tsp.npy'), dtype=np.float64, mode='w+', shape=tsp.shape)
-
-    im_mapped[:] = tsp[:]
-
-    del tsp
-
-    shift = None
-    if exists(input_shift_file):
-        shift = np.loadtxt(input_shift_file)
-
-    logging.info('Scanning aberration correction...')
-
-    shift_calc = opt_shift.Shift(y_down_sizing_factor, x_down_sizing_factor, im_sorted=im_mapped, shift=shift)
-
-    reconstructed_data = np.memmap(join(tmp_data, 'rec_tmp.npy'), dtype=np.float64, mode='w+', shape=im_mapped.shape)
-    reconstructed_data[:], pixel_shift = shift_calc.aberration_correction(step_init=np.array([5.3], dtype=np.float),
-                                                                          method='Nelder-Mead')
-
     if output_file_path == '':
         output_file_path = join(dir_data, filename[:filename.find(".")] + '_unsheared.npy')
-    np.save(output_file_path, reconstructed_data)
+    if abspath(output_file_path) == abspath(input_file_path):
+        logging.error('The output file path is the input file path {}. Exiting script.'.format(input_file_path))
+        sys.exit(-1)
 
-    del im_mapped
+    # holds the copy of TIFF inputs that cannot be memory-mapped
+    tmp_data = mkdtemp()
+    try:
+        layout = om_toolbox.resolve_layout(input_file_path, layout)
+        # memory-mapped: the data is only read block by block
+        im_mapped = om_toolbox.load_data(input_file_path, memmap_path=join(tmp_data, 'rec_tsp.npy'), mmap_mode='r',
+                                         layout=layout)
+
+        shift = None
+        if exists(input_shift_file):
+            shift = np.loadtxt(input_shift_file)
+
+        logging.info('Scanning aberration correction...')
+
+        shift_calc = opt_shift.Shift(y_down_sizing_factor, x_down_sizing_factor, im_sorted=im_mapped, shift=shift,
+                                     chunk_size=chunk_size * 1024 ** 2, precision=precision)
+
+        # the reconstruction is written in place into the output NPY file
+        dtype = im_mapped.dtype if output_dtype == 'input' else np.dtype(output_dtype or precision)
+        reconstructed_data = om_toolbox.allocate(im_mapped.shape, dtype, output_file_path,
+                                                 layout=output_layout or layout)
+        reconstructed_data, pixel_shift = shift_calc.aberration_correction(step_init=np.array([5.3]), method=method,
+                                                                           output_im=reconstructed_data,
+                                                                           workers=workers, per_slice=per_slice,
+                                                                           levels=levels,
+                                                                           sample_stride=sample_stride)
+        reconstructed_data.flush()
+        logging.info('Saved data as {}'.format(output_file_path))
+        # one shift, or one line per slice with one shift per channel; can be applied again with input_shift_file
+        np.savetxt(output_file_path[:output_file_path.rfind(".")] + '_shift.txt',
+                   np.reshape(pixel_shift, (-1, im_mapped.shape[3])) if np.size(pixel_shift) > 1
+                   else np.ravel(pixel_shift))
+
+        del shift_calc, im_mapped, reconstructed_data
+    finally:
+        shutil.rmtree(tmp_data, ignore_errors=True)
 
     logging.info('Done.')
 
@@ -111,7 +171,12 @@ def main(input_file_path, output_file_path='', x_down_sizing_factor=4, y_down_si
 if __name__ == "__main__":
 
     parse = parsing()
-    main(parse.input_file_path, output_file_path=parse.output_file_path, x_down_sizing_factor=parse.xdownsizing,
-         y_down_sizing_factor=parse.ydownsizing, input_shift_file=parse.input_shift_file,
-         logging_level=parse.logging_level)
+    with profiling.run(parse.report or profiling.default_report_path(parse.input_file_path, 'unshearing'),
+                       parse.profile):
+        main(parse.input_file_path, output_file_path=parse.output_file_path, x_down_sizing_factor=parse.xdownsizing,
+             y_down_sizing_factor=parse.ydownsizing, input_shift_file=parse.input_shift_file,
+             logging_level=parse.logging_level, workers=parse.workers, per_slice=parse.per_slice,
+             levels=parse.levels, chunk_size=parse.chunk_size, method=parse.method, precision=parse.precision,
+             output_dtype=parse.output_dtype, layout=parse.layout, output_layout=parse.output_layout,
+             sample_stride=parse.sample_stride)
 
@@ -0,0 +1,176 @@
+"""
+Batched periodic cubic spline resampling of the time axis of periodic movies.
+
+Copyright (c) 2019 Idiap Research Institute, http://www.idiap.ch/
+Written by Olivia Mariani <olivia.mariani@idiap.ch>,
+
+This file is part of LHSAC.
+
+LHSAC is a free software: you can redistribute it and/or modify
+it under the terms of the 3-clause Berkeley Software Distribution (BSD) as
+published by the Open Source Initiative.
+
+LHSAC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+3-clause BSD License for more details.
+
+You should have received a copy of the 3-clause BSD along with LHSAC.
+If not, see <https://opensource.org/licenses/BSD-3-Clause>.
+
+The data is expected to hold one closed period along the last axis (the last time point repeats the first one), as
+built by opt_shift.Shift. On integer nodes, interpolate.splrep(..., per=True, k=3) is then the cardinal cubic B-spline
+interpolant of the first nt - 1 time points, whose coefficients are obtained for all pixels at once by dividing by the
+B-spline sampled kernel in the Fourier domain.
+"""
+
+import numpy as np
+
+
+def spline_coefficients(input_im, closed=True):
+    """
+    Computes the periodic cubic B-spline coefficients of every pixel time series.
+    :param input_im: Data with time as last dimension
+    :param closed: True if the last time point of input_im repeats the first one, False if input_im holds the period
+    only
+    :return: Coefficients array with one coefficient per time point of the period, float32 for float32 or integer
+    data, float64 otherwise
+    """
+    dtype = np.result_type(input_im.dtype, np.float32)
+    period = input_im.shape[-1] - 1 if closed else input_im.shape[-1]
+    freqs = np.arange(period // 2 + 1)
+    kernel = ((4. + 2. * np.cos(2. * np.pi * freqs / period)) / 6.).astype(dtype)
+    coefficients = np.fft.irfft(np.fft.rfft(input_im[..., :period], axis=-1) / kernel, n=period, axis=-1)
+    return coefficients.astype(dtype, copy=False)
+
+
+def pad_coefficients(coefficients):
+    """
+    Adds the periodic neighbours used by spline_resampling: the last coefficient before the first one, the first two
+    after the last one. Coefficients evaluated many times are padded once.
+    :param coefficients: Output of spline_coefficients
+    :return: Padded coefficients, with 3 more coefficients per series
+    """
+    return np.concatenate((coefficients[..., -1:], coefficients, coefficients[..., :2]), axis=-1)
+
+
+def spline_weights(residue):
+    """
+    Cubic B-spline weights of the four coefficients surrounding an evaluation point.
+    :param residue: Fractional part of the evaluation point, in [0, 1)
+    :return: Tuple of the four weights, for the coefficients t - 1, t, t + 1, t + 2
+    """
+    residue2 = residue * residue
+    residue3 = residue2 * residue
+    return ((1. - residue) ** 3 / 6.,
+            (3. * residue3 - 6. * residue2 + 4.) / 6.,
+            (-3. * residue3 + 3. * residue2 + 3. * residue + 1.) / 6.,
+            residue3 / 6.)
+
+
+def spline_weights_derivative(residue):
+    """
+    Derivatives of spline_weights with respect to the residue.
+    :param residue: Fractional part of the evaluation point, in [0, 1)
+    :return: Tuple of the four derivatives, for the coefficients t - 1, t, t + 1, t + 2
+    """
+    residue2 = residue * residue
+    return (-(1. - residue) ** 2 / 2.,
+            (3. * residue2 - 4. * residue) / 2.,
+            (-3. * residue2 + 2. * residue + 1.) / 2.,
+            residue2 / 2.)
+
+
+def split_shifts(shifts):
+    """
+    Splits delays into the arguments of spline_resampling evaluating every series at t - shifts.
+    :param shifts: Delays in time points
+    :return: Tuple of the residues in [0, 1) and of the integer shifts
+    """
+    int_interp = np.ceil(shifts).astype(np.int64)
+    return int_interp - shifts, int_interp
+
+
+def spline_resampling(coefficients, residue, int_interp, derivative=False, padded=False, out=None, work=None,
+                      derivative_out=None):
+    """
+    Evaluates the periodic splines at t + residue for every time point t, then rolls each series by int_interp
+    along time. Gives the same result as interpolate.splev on the evaluation points nt_range + residue (last point
+    kept at nt - 1) followed by np.roll, for all pixels at once. The computations are done in the data type of the
+    coefficients (at least float32), in place in the given buffers.
+    :param coefficients: Output of spline_coefficients, or of pad_coefficients if padded is True
+    :param residue: Fractional shifts, broadcastable to coefficients.shape[:-1] + (1,)
+    :param int_interp: Integer shifts, same shape as residue
+    :param derivative: If True, also returns the derivative of the result with respect to residue
+    :param padded: True if the coefficients were padded by pad_coefficients
+    :param out: Array of shape coefficients.shape[:-1] + (nt,) receiving the result. Allocated if None
+    :param work: Scratch array of the same shape and data type as out. Allocated if None
+    :param derivative_out: Array of the same shape and data type as out receiving the derivative. Allocated if None
+    :return: Resampled data of shape coefficients.shape[:-1] + (nt,), and its derivative if derivative is True
+    """
+    if not padded:
+        coefficients = pad_coefficients(coefficients)
+    nt = coefficients.shape[-1] - 2
+    shape = coefficients.shape[:-1] + (nt,)
+    dtype = np.result_type(coefficients, np.float32)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    if work is None:
+        work = np.empty(shape, dtype=dtype)
+
+    residue = np.asarray(residue, dtype=np.float64)
+    # out is the scratch of the products, before receiving the rolled series
+    weighted_sum(coefficients, spline_weights(residue), work, out)
+    # the last evaluation point is always the last node, which closes the period
+    work[..., -1] = (coefficients[..., 0] + 4. * coefficients[..., 1] + coefficients[..., 2]) / 6.
+    roll_series(work, int_interp, out)
+    if not derivative:
+        return out
+
+    if derivative_out is None:
+        derivative_out = np.empty(shape, dtype=dtype)
+    weighted_sum(coefficients, spline_weights_derivative(residue), work, derivative_out)
+    work[..., -1] = 0.
+    roll_series(work, int_interp, derivative_out)
+    return out, derivative_out
+
+
+def weighted_sum(coefficients, weights, out, product):
+    """
+    Sums the four padded coefficients surrounding every evaluation point, weighted by weights, into out[..., :-1].
+    :param coefficients: Padded coefficients
+    :param weights: Four weights, broadcastable to coefficients.shape[:-1] + (1,)
+    :param out: Array receiving the sums, one time point longer than the period
+    :param product: Scratch array of the shape of out
+    :return: No return
+    """
+    period = out.shape[-1] - 1
+    result, product = out[..., :-1], product[..., :-1]
+    for k, weight in enumerate(weights):
+        # weights in the data type, so that float32 data is not promoted to float64
+        weight = np.asarray(weight, dtype=out.dtype)
+        if k == 0:
+            np.multiply(weight, coefficients[..., 0:period], out=result)
+        else:
+            np.multiply(weight, coefficients[..., k:period + k], out=product)
+            result += product
+
+
+def roll_series(values, shifts, out):
+    """
+    Rolls every series of values along time by its integer shift as np.roll, by slice copies.
+    :param values: Array with time as last dimension
+    :param shifts: Integer shifts, broadcastable to values.shape[:-1] + (1,)
+    :param out: Array of the shape of values receiving the rolled series, not values itself
+    :return: No return
+    """
+    nt = values.shape[-1]
+    shifts = np.asarray(shifts) % nt
+    shifts = shifts.reshape((1,) * (values.ndim - shifts.ndim) + shifts.shape)
+    for index in np.ndindex(shifts.shape[:-1]):
+        shift = int(shifts[index + (0,)])
+        # the axes along which the shift does not vary are copied at once
+        series = tuple(i if size > 1 else slice(None) for i, size in zip(index, shifts.shape[:-1]))
+        out[series + (slice(shift, None),)] = values[series + (slice(0, nt - shift),)]
+        out[series + (slice(0, shift),)] = values[series + (slice(nt - shift, None),)]
+